@@ -48,6 +48,14 @@
 #include <unistd.h>
 #include <stdlib.h>
 
+#include <dirent.h>
+#include <limits.h>
+#include <string.h>
+
+#ifdef __linux__
+    #include <sys/syscall.h>
+#endif
+
 #ifdef __FreeBSD__
     #include <sys/extattr.h>
     #define NO_NANOSECONDS 1
@@ -143,9 +151,13 @@ lstat_wrapper(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "s", &filename))
         return NULL;
 
+    /* Release the GIL, so that several threads can scan directories
+       at the same time. */
+    Py_BEGIN_ALLOW_THREADS
     ret = lstat(filename, &st);
     if (ret == -1)
         ret = errno;
+    Py_END_ALLOW_THREADS
 
     return Py_BuildValue("iKKKKKKKLLLLKLKLK",
                          ret,
@@ -168,6 +180,228 @@ lstat_wrapper(PyObject *self, PyObject *args)
 }
 
 
+/*
+ * List a directory and lstat every entry in it, in one call.
+ *
+ * The directory is opened once, and entries are read with getdents64(2)
+ * on Linux, or readdir(3) elsewhere. Each entry is stat'ed with
+ * fstatat(2) relative to the open directory, so the kernel does not need
+ * to resolve the whole pathname for every entry. The result is sorted by
+ * inode number, which makes later opens of the files faster on many
+ * filesystems.
+ */
+
+struct dir_entry {
+    char *name;
+    int err;
+    struct stat st;
+};
+
+
+struct dir_entries {
+    struct dir_entry *entries;
+    size_t count;
+    size_t allocated;
+};
+
+
+static int
+add_dir_entry(struct dir_entries *list, int dirfd, const char *name)
+{
+    struct dir_entry *e;
+
+    if (strcmp(name, ".") == 0 || strcmp(name, "..") == 0)
+        return 0;
+
+    if (list->count == list->allocated) {
+        size_t n = list->allocated == 0 ? 64 : 2 * list->allocated;
+        e = realloc(list->entries, n * sizeof(*e));
+        if (e == NULL)
+            return ENOMEM;
+        list->entries = e;
+        list->allocated = n;
+    }
+
+    e = &list->entries[list->count];
+    memset(e, 0, sizeof(*e));
+    e->name = strdup(name);
+    if (e->name == NULL)
+        return ENOMEM;
+    if (fstatat(dirfd, name, &e->st, AT_SYMLINK_NOFOLLOW) == -1)
+        e->err = errno;
+    ++list->count;
+    return 0;
+}
+
+
+static void
+free_dir_entries(struct dir_entries *list)
+{
+    size_t i;
+
+    for (i = 0; i < list->count; ++i)
+        free(list->entries[i].name);
+    free(list->entries);
+}
+
+
+#ifdef __linux__
+
+struct linux_dirent64 {
+    unsigned long long d_ino;
+    long long d_off;
+    unsigned short d_reclen;
+    unsigned char d_type;
+    char d_name[];
+};
+
+static int
+read_dir_entries(int dirfd, struct dir_entries *list)
+{
+    char buf[64 * 1024];
+    long n, pos;
+    int ret;
+
+    for (;;) {
+        n = syscall(SYS_getdents64, dirfd, buf, sizeof(buf));
+        if (n == -1)
+            return errno;
+        if (n == 0)
+            return 0;
+        for (pos = 0; pos < n;) {
+            struct linux_dirent64 *d = (struct linux_dirent64 *) (buf + pos);
+            ret = add_dir_entry(list, dirfd, d->d_name);
+            if (ret != 0)
+                return ret;
+            pos += d->d_reclen;
+        }
+    }
+}
+
+#else
+
+static int
+read_dir_entries(int dirfd, struct dir_entries *list)
+{
+    DIR *dir;
+    struct dirent *d;
+    int fd, ret;
+
+    /* closedir closes the file descriptor, so give it its own. */
+    fd = dup(dirfd);
+    if (fd == -1)
+        return errno;
+    dir = fdopendir(fd);
+    if (dir == NULL) {
+        ret = errno;
+        close(fd);
+        return ret;
+    }
+
+    ret = 0;
+    for (;;) {
+        errno = 0;
+        d = readdir(dir);
+        if (d == NULL) {
+            ret = errno;
+            break;
+        }
+        ret = add_dir_entry(list, dirfd, d->d_name);
+        if (ret != 0)
+            break;
+    }
+    closedir(dir);
+    return ret;
+}
+
+#endif
+
+
+/* Entries that could not be stat'ed sort first, then by inode and name. */
+static int
+compare_dir_entries(const void *a, const void *b)
+{
+    const struct dir_entry *ea = a;
+    const struct dir_entry *eb = b;
+
+    if ((ea->err != 0) != (eb->err != 0))
+        return ea->err != 0 ? -1 : 1;
+    if (ea->err == 0 && ea->st.st_ino != eb->st.st_ino)
+        return ea->st.st_ino < eb->st.st_ino ? -1 : 1;
+    return strcmp(ea->name, eb->name);
+}
+
+
+static PyObject *
+listdir2_wrapper(PyObject *self, PyObject *args)
+{
+    const char *dirname;
+    struct dir_entries list = {0};
+    PyObject *result, *item;
+    int dirfd;
+    int ret;
+    size_t i;
+
+    if (!PyArg_ParseTuple(args, "s", &dirname))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    dirfd = open(dirname, O_RDONLY | O_DIRECTORY);
+    if (dirfd == -1) {
+        ret = errno;
+    } else {
+        ret = read_dir_entries(dirfd, &list);
+        close(dirfd);
+        if (ret == 0)
+            qsort(list.entries, list.count, sizeof(*list.entries),
+                  compare_dir_entries);
+    }
+    Py_END_ALLOW_THREADS
+
+    if (ret != 0) {
+        free_dir_entries(&list);
+        return Py_BuildValue("i", ret);
+    }
+
+    result = PyList_New(list.count);
+    if (result == NULL) {
+        free_dir_entries(&list);
+        return NULL;
+    }
+    for (i = 0; i < list.count; ++i) {
+        struct dir_entry *e = &list.entries[i];
+        item = Py_BuildValue("siKKKKKKKLLLLKLKLK",
+                             e->name,
+                             e->err,
+                             (unsigned long long) e->st.st_dev,
+                             (unsigned long long) e->st.st_ino,
+                             (unsigned long long) e->st.st_mode,
+                             (unsigned long long) e->st.st_nlink,
+                             (unsigned long long) e->st.st_uid,
+                             (unsigned long long) e->st.st_gid,
+                             (unsigned long long) e->st.st_rdev,
+                             (long long) e->st.st_size,
+                             (long long) e->st.st_blksize,
+                             (long long) e->st.st_blocks,
+                             (long long) e->st.st_atim.tv_sec,
+                             remove_precision(e->st.st_atim.tv_nsec),
+                             (long long) e->st.st_mtim.tv_sec,
+                             remove_precision(e->st.st_mtim.tv_nsec),
+                             (long long) e->st.st_ctim.tv_sec,
+                             remove_precision(e->st.st_ctim.tv_nsec));
+        if (item == NULL) {
+            Py_DECREF(result);
+            free_dir_entries(&list);
+            return NULL;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+
+    free_dir_entries(&list);
+    return result;
+}
+
+
 static PyObject *
 llistxattr_wrapper(PyObject *self, PyObject *args)
 {
@@ -273,6 +507,367 @@ lsetxattr_wrapper(PyObject *self, PyObject *args)
 }
 
 
+/*
+ * Find the parts of a file that contain data, as opposed to holes,
+ * using lseek(2) with SEEK_DATA and SEEK_HOLE. Only the first size
+ * bytes of the file are considered. Return a list of (offset, length)
+ * tuples, None if the filesystem or platform can't tell, or an errno
+ * value. The file offset is left unchanged.
+ */
+
+static PyObject *
+data_extents(PyObject *self, PyObject *args)
+{
+#if defined(SEEK_DATA) && defined(SEEK_HOLE)
+    int fd;
+    long long size;
+    off_t orig, pos, data, hole = 0;
+    PyObject *list, *item;
+    int ret;
+
+    if (!PyArg_ParseTuple(args, "iL", &fd, &size))
+        return NULL;
+
+    list = PyList_New(0);
+    if (list == NULL)
+        return NULL;
+
+    orig = lseek(fd, 0, SEEK_CUR);
+    if (orig == -1) {
+        Py_DECREF(list);
+        return Py_BuildValue("i", errno);
+    }
+
+    ret = 0;
+    pos = 0;
+    while (pos < size) {
+        Py_BEGIN_ALLOW_THREADS
+        data = lseek(fd, pos, SEEK_DATA);
+        if (data == -1)
+            ret = errno;
+        else {
+            hole = lseek(fd, data, SEEK_HOLE);
+            if (hole == -1)
+                ret = errno;
+        }
+        Py_END_ALLOW_THREADS
+
+        if (ret == ENXIO) {
+            /* No more data before end of file. */
+            ret = 0;
+            break;
+        }
+        if (ret != 0)
+            break;
+        if (data >= size)
+            break;
+        if (hole > size)
+            hole = size;
+
+        item = Py_BuildValue("(LL)", (long long) data,
+                             (long long) (hole - data));
+        if (item == NULL || PyList_Append(list, item) == -1) {
+            Py_XDECREF(item);
+            Py_DECREF(list);
+            lseek(fd, orig, SEEK_SET);
+            return NULL;
+        }
+        Py_DECREF(item);
+        pos = hole;
+    }
+
+    lseek(fd, orig, SEEK_SET);
+
+    if (ret == EINVAL || ret == ENOTSUP) {
+        /* Filesystem does not support finding holes. */
+        Py_DECREF(list);
+        Py_RETURN_NONE;
+    }
+    if (ret != 0) {
+        Py_DECREF(list);
+        return Py_BuildValue("i", ret);
+    }
+    return list;
+#else
+    Py_RETURN_NONE;
+#endif
+}
+
+
+/*
+ * Content-defined chunking with a Rabin-Karp style rolling hash.
+ *
+ * The hash is computed over a sliding window of the last
+ * ROLLING_WINDOW bytes. A chunk boundary is put where the top bits
+ * of the hash are all zero; the number of bits is chosen so that
+ * this happens, on average, every avg_size bytes. Each byte value is
+ * incremented by one before hashing, so that long runs of zero bytes
+ * do not result in a boundary at every possible position, but produce
+ * maximum size chunks instead. Because the hash
+ * only depends on the window, boundaries move with the data when
+ * bytes are inserted or deleted, and unchanged data after the edit
+ * results in the same chunks as before.
+ */
+
+#define ROLLING_WINDOW 48
+#define ROLLING_PRIME 0x100000001b3ULL
+
+static PyObject *
+rabin_boundary(PyObject *self, PyObject *args)
+{
+    const unsigned char *buf;
+    int buflen;
+    long long offset, min_size, avg_size, max_size;
+    unsigned long long h, mask, out_factor;
+    long long len, start, i;
+    int bits;
+
+    if (!PyArg_ParseTuple(args, "s#LLLL", &buf, &buflen, &offset,
+                          &min_size, &avg_size, &max_size))
+        return NULL;
+
+    if (offset < 0 || offset > buflen || min_size < 0 ||
+        avg_size < 1 || max_size < min_size) {
+        PyErr_SetString(PyExc_ValueError, "bad arguments");
+        return NULL;
+    }
+
+    len = buflen - offset;
+    if (len > max_size)
+        len = max_size;
+    if (len <= min_size)
+        return Py_BuildValue("L", len);
+
+    bits = 0;
+    while ((1LL << (bits + 1)) <= avg_size && bits < 63)
+        ++bits;
+    mask = bits == 0 ? 0 : ((1ULL << bits) - 1) << (64 - bits);
+
+    out_factor = 1;
+    for (i = 1; i < ROLLING_WINDOW; ++i)
+        out_factor *= ROLLING_PRIME;
+
+    buf += offset;
+    start = min_size > ROLLING_WINDOW ? min_size - ROLLING_WINDOW : 0;
+
+    Py_BEGIN_ALLOW_THREADS
+    h = 0;
+    for (i = start; i < len; ++i) {
+        if (i - start >= ROLLING_WINDOW)
+            h -= out_factor * (buf[i - ROLLING_WINDOW] + 1);
+        h = h * ROLLING_PRIME + (buf[i] + 1);
+        if (i + 1 >= min_size && (h & mask) == 0) {
+            ++i;
+            break;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    return Py_BuildValue("L", i);
+}
+
+
+/*
+ * Encode and decode file metadata, in the format of encode_metadata
+ * and decode_metadata in obnamlib/metadata.py, which also has the
+ * pure Python versions of these functions.
+ *
+ * The encoded form starts with 18 big-endian 64-bit values: a bit
+ * mask of the fields that are present, twelve integer fields, and
+ * the lengths of five string fields. The strings follow, in order.
+ * Here, the fields are given as a tuple of values in that order,
+ * with None for fields that are not present.
+ */
+
+#define METADATA_INTEGERS 12
+#define METADATA_STRINGS 5
+#define METADATA_FIELDS (METADATA_INTEGERS + METADATA_STRINGS)
+#define METADATA_HEADER ((1 + METADATA_FIELDS) * 8)
+
+/* The bit in the mask for each field. They are the indexes of the
+   fields in obnamlib.metadata_fields, which are not in the same
+   order as in the encoded form. */
+static const int metadata_bits[METADATA_FIELDS] = {
+    0,  /* st_mode */
+    1,  /* st_mtime_sec */
+    2,  /* st_mtime_nsec */
+    14, /* st_atime_sec */
+    15, /* st_atime_nsec */
+    3,  /* st_nlink */
+    4,  /* st_size */
+    5,  /* st_uid */
+    12, /* st_gid */
+    11, /* st_dev */
+    13, /* st_ino */
+    10, /* st_blocks */
+    6,  /* groupname */
+    7,  /* username */
+    8,  /* target */
+    16, /* md5 */
+    9,  /* xattr */
+};
+
+/* Integer fields that are signed. */
+#define METADATA_IS_SIGNED(i) ((i) == 1 || (i) == 3)
+
+static void
+put_uint64(unsigned char *p, unsigned long long value)
+{
+    int i;
+
+    for (i = 7; i >= 0; --i) {
+        p[i] = value & 0xff;
+        value >>= 8;
+    }
+}
+
+static unsigned long long
+get_uint64(const unsigned char *p)
+{
+    unsigned long long value = 0;
+    int i;
+
+    for (i = 0; i < 8; ++i)
+        value = (value << 8) | p[i];
+    return value;
+}
+
+static PyObject *
+encode_metadata(PyObject *self, PyObject *args)
+{
+    PyObject *values;
+    PyObject *value;
+    PyObject *result;
+    unsigned long long numbers[METADATA_FIELDS];
+    unsigned long long flags;
+    unsigned char *p;
+    Py_ssize_t total;
+    int i;
+
+    if (!PyArg_ParseTuple(args, "O!", &PyTuple_Type, &values))
+        return NULL;
+    if (PyTuple_GET_SIZE(values) != METADATA_FIELDS) {
+        PyErr_SetString(PyExc_ValueError, "wrong number of fields");
+        return NULL;
+    }
+
+    flags = 0;
+    total = METADATA_HEADER;
+    for (i = 0; i < METADATA_FIELDS; ++i) {
+        value = PyTuple_GET_ITEM(values, i);
+        numbers[i] = 0;
+        if (value == Py_None)
+            continue;
+        flags |= 1ULL << metadata_bits[i];
+        if (i >= METADATA_INTEGERS) {
+            if (!PyString_Check(value)) {
+                PyErr_SetString(PyExc_TypeError, "string field is not str");
+                return NULL;
+            }
+            numbers[i] = PyString_GET_SIZE(value);
+            total += PyString_GET_SIZE(value);
+        } else if (PyInt_Check(value) || PyLong_Check(value)) {
+            /* PyLong_AsUnsignedLongLong does not accept an int. */
+            PyObject *number = PyNumber_Long(value);
+            if (number == NULL)
+                return NULL;
+            if (METADATA_IS_SIGNED(i))
+                numbers[i] = (unsigned long long) PyLong_AsLongLong(number);
+            else
+                numbers[i] = PyLong_AsUnsignedLongLong(number);
+            Py_DECREF(number);
+            if (PyErr_Occurred())
+                return NULL;
+        } else {
+            PyErr_SetString(PyExc_TypeError, "integer field is not int");
+            return NULL;
+        }
+    }
+
+    result = PyString_FromStringAndSize(NULL, total);
+    if (result == NULL)
+        return NULL;
+    p = (unsigned char *) PyString_AS_STRING(result);
+    put_uint64(p, flags);
+    for (i = 0; i < METADATA_FIELDS; ++i)
+        put_uint64(p + 8 * (i + 1), numbers[i]);
+    p += METADATA_HEADER;
+    for (i = METADATA_INTEGERS; i < METADATA_FIELDS; ++i) {
+        value = PyTuple_GET_ITEM(values, i);
+        if (value != Py_None) {
+            memcpy(p, PyString_AS_STRING(value), numbers[i]);
+            p += numbers[i];
+        }
+    }
+    return result;
+}
+
+static PyObject *
+decode_metadata(PyObject *self, PyObject *args)
+{
+    const unsigned char *buf;
+    int buflen;
+    unsigned long long wanted = ~0ULL;
+    unsigned long long flags;
+    unsigned long long number;
+    unsigned long long offset;
+    long long signed_number;
+    PyObject *values;
+    PyObject *value;
+    int i;
+
+    if (!PyArg_ParseTuple(args, "s#|K", &buf, &buflen, &wanted))
+        return NULL;
+    if (buflen < METADATA_HEADER) {
+        PyErr_SetString(PyExc_ValueError, "encoded metadata is too short");
+        return NULL;
+    }
+
+    values = PyTuple_New(METADATA_FIELDS);
+    if (values == NULL)
+        return NULL;
+
+    flags = get_uint64(buf);
+    offset = METADATA_HEADER;
+    for (i = 0; i < METADATA_FIELDS; ++i) {
+        int present = (flags >> metadata_bits[i]) & 1;
+        number = get_uint64(buf + 8 * (i + 1));
+        if (!present || !((wanted >> metadata_bits[i]) & 1)) {
+            value = Py_None;
+            Py_INCREF(value);
+        } else if (i >= METADATA_INTEGERS) {
+            /* Like slicing in Python, don't go past the end. */
+            unsigned long long start = offset;
+            unsigned long long end = offset + number;
+            if (start > (unsigned long long) buflen)
+                start = buflen;
+            if (end > (unsigned long long) buflen || end < offset)
+                end = buflen;
+            value = PyString_FromStringAndSize((const char *) buf + start,
+                                               end - start);
+        } else if (METADATA_IS_SIGNED(i)) {
+            signed_number = (long long) number;
+            if (signed_number >= LONG_MIN && signed_number <= LONG_MAX)
+                value = PyInt_FromLong((long) signed_number);
+            else
+                value = PyLong_FromLongLong(signed_number);
+        } else if (number <= LONG_MAX) {
+            value = PyInt_FromLong((long) number);
+        } else {
+            value = PyLong_FromUnsignedLongLong(number);
+        }
+        if (value == NULL) {
+            Py_DECREF(values);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(values, i, value);
+        if (i >= METADATA_INTEGERS && present)
+            offset += number;
+    }
+    return values;
+}
+
+
 static PyMethodDef methods[] = {
     {"fadvise_dontneed",  fadvise_dontneed, METH_VARARGS,
      "Call posix_fadvise(2) with POSIX_FADV_DONTNEED argument."},
@@ -280,12 +875,26 @@ static PyMethodDef methods[] = {
      "utimensat(2) wrapper."},
     {"lstat", lstat_wrapper, METH_VARARGS,
      "lstat(2) wrapper; arg is filename, returns tuple."},
+    {"listdir2", listdir2_wrapper, METH_VARARGS,
+     "List directory and lstat its entries; arg is dirname, returns list "
+     "of (name, lstat tuple fields...) sorted by inode, or errno."},
     {"llistxattr", llistxattr_wrapper, METH_VARARGS,
      "llistxattr(2) wrapper; arg is filename, returns tuple."},
     {"lgetxattr", lgetxattr_wrapper, METH_VARARGS,
      "lgetxattr(2) wrapper; arg is filename, returns tuple."},
     {"lsetxattr", lsetxattr_wrapper, METH_VARARGS,
      "lsetxattr(2) wrapper; arg is filename, returns errno."},
+    {"data_extents", data_extents, METH_VARARGS,
+     "Find data (non-hole) parts of a file; args are fd and size, returns "
+     "list of (offset, length), None if unknown, or errno."},
+    {"rabin_boundary", rabin_boundary, METH_VARARGS,
+     "Find next content-defined chunk boundary; args are data, offset, "
+     "min, avg, max sizes; returns length of chunk starting at offset."},
+    {"encode_metadata", encode_metadata, METH_VARARGS,
+     "Encode a tuple of metadata field values; returns string."},
+    {"decode_metadata", decode_metadata, METH_VARARGS,
+     "Decode metadata into a tuple of field values; args are the encoded "
+     "string and optionally a bit mask of the fields wanted."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -49,6 +49,15 @@ DEFAULT_CHUNK_SIZE = 1024 * 1024 # benchmarked on 2011-09-01
 DEFAULT_UPLOAD_QUEUE_SIZE = 128
 DEFAULT_LRU_SIZE = 256
 DEFAULT_CHUNKIDS_PER_GROUP = 1024
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_CHECKSUM_WORKERS = 4
+DEFAULT_SCAN_WORKERS = 4
+DEFAULT_SCAN_QUEUE_SIZE = 256
+DEFAULT_RESTORE_WORKERS = 4
+DEFAULT_RESTORE_WINDOW = 64 * 1024**2
+DEFAULT_RESTORE_FILE_WORKERS = 4
+DEFAULT_PACK_MAX_CHUNK_SIZE = 64 * 1024
+DEFAULT_FILE_ID_CACHE_SIZE = 64 * 1024
 DEFAULT_NAGIOS_WARN_AGE = '27h'
 DEFAULT_NAGIOS_CRIT_AGE = '8d'
 
@@ -85,11 +94,30 @@ from encryption import (generate_symmetric_key,
                         SymmetricKeyCache)
 
 from hooks import Hook, MissingFilterError, FilterHook, HookManager
+from checksummer import (checksum_algorithms,
+                         new_checksummer,
+                         FileChecksummer,
+                         checksum_algorithm_is_available,
+                         format_file_contents,
+                         parse_format_version,
+                         parse_checksum_algorithm)
 from pluginbase import ObnamPlugin
+from workerpool import WorkerJob, WorkerPool, ReadAhead, prefetch
+from chunker import FixedChunker, RabinChunker, new_chunker
+from unchanged_cache import UnchangedFileCache
+from chunk_index_cache import ChunkIndexCache
+from chunkid_pool import ChunkidPool
+from restore_plan import RestorePlan
+from chunk_reader import ChunkReader
+from file_id_cache import FileIdCache
+from tar_writer import TarWriter
+from pathmatch import PathMatcher
 from vfs import VirtualFileSystem, VfsFactory, VfsTests
 from vfs_local import LocalFS
+from packstore import PackStore
 from metadata import (read_metadata, set_metadata, Metadata, metadata_fields,
-                      metadata_verify_fields, encode_metadata, decode_metadata)
+                      metadata_verify_fields, encode_metadata, decode_metadata,
+                      decode_xattr_blob, StatResult)
 from repo_factory import (
     RepositoryFactory,
     UnknownRepositoryFormat,
@@ -124,8 +152,9 @@ from repo_fmt_6 import RepositoryFormat6
 from repo_tree import RepositoryTree
 from chunklist import ChunkList
 from clientlist import ClientList
+from bloomfilter import BloomFilter
 from checksumtree import ChecksumTree
-from clientmetadatatree import ClientMetadataTree
+from clientmetadatatree import ClientMetadataTree, Hole
 from lockmgr import LockManager
 from repo import Repository, LockFail, BadFormat
 from forget_policy import ForgetPolicy
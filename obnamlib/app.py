@@ -15,6 +15,7 @@
 
 
 import cliapp
+import hashlib
 import larch
 import logging
 import os
@@ -24,6 +25,7 @@ import sys
 import time
 import tracing
 import ttystatus
+import weakref
 
 import obnamlib
 
@@ -56,6 +58,44 @@ class App(cliapp.Application):
                              default=obnamlib.DEFAULT_CHUNK_SIZE,
                               group=perf_group)
 
+        self.settings.bytesize(['pack-size'],
+                            'put small chunks into pack files of about '
+                                'this size, instead of a file per chunk; '
+                                'older versions of Obnam can not read '
+                                'packed chunks; 0 means no packs '
+                                 '(default: %default)',
+                             default=0,
+                              group=perf_group)
+
+        self.settings.bytesize(['pack-max-chunk-size'],
+                            'put chunks of at most this size into pack '
+                                'files, if --pack-size is set '
+                                 '(default: %default)',
+                             default=obnamlib.DEFAULT_PACK_MAX_CHUNK_SIZE,
+                              group=perf_group)
+
+        self.settings.string(['chunk-cache-dir'],
+                             'keep a cache of the repository\'s chunk '
+                                'indexes in DIR on the local disk, which '
+                                'speeds up backups and restores from '
+                                'remote repositories (e.g., '
+                                '~/.cache/obnam); default is to have '
+                                'no cache',
+                             metavar='DIR',
+                             group=perf_group)
+
+        self.settings.choice(['checksum-algorithm'],
+                             obnamlib.checksum_algorithms,
+                             'checksum algorithm for finding duplicate '
+                                'data, used when creating a new '
+                                'repository; existing repositories keep '
+                                'the one they were created with; '
+                                'blake2b is faster and more collision '
+                                'resistant than md5, the default, but '
+                                'older versions of Obnam can not use '
+                                'repositories with other algorithms',
+                             group=perf_group)
+
         self.settings.bytesize(['upload-queue-size'],
                             'length of upload queue for B-tree nodes '
                                  '(default: %default)',
@@ -68,6 +108,12 @@ class App(cliapp.Application):
                              default=obnamlib.DEFAULT_LRU_SIZE,
                              group=perf_group)
 
+        self.settings.integer(['file-id-cache-size'],
+                              'number of file ids of pathnames to keep '
+                                 'in memory (default: %default)',
+                              default=obnamlib.DEFAULT_FILE_ID_CACHE_SIZE,
+                              group=perf_group)
+
         self.settings.string_list(['trace'],
                                 'add to filename patters for which trace '
                                 'debugging logging happens')
@@ -132,6 +178,11 @@ class App(cliapp.Application):
 
         self.fsf = obnamlib.VfsFactory()
 
+        # Repositories that are open, for reporting their caches in
+        # memory profiles.
+        self.repositories = weakref.WeakSet()
+        self.last_cache_report = 0
+
         self.pm.load_plugins()
         self.pm.enable_plugins()
         self.hooks.call('plugins-loaded')
@@ -195,7 +246,7 @@ class App(cliapp.Application):
             repofs.connect()
         else:
             repofs.reinit(repopath)
-        return obnamlib.Repository(repofs,
+        repo = obnamlib.Repository(repofs,
                                     self.settings['node-size'],
                                     self.settings['upload-queue-size'],
                                     self.settings['lru-size'],
@@ -205,7 +256,37 @@ class App(cliapp.Application):
                                     self.settings['idpath-skip'],
                                     self.time,
                                     self.settings['lock-timeout'],
-                                    self.settings['client-name'])
+                                    self.settings['client-name'],
+                                    pack_size=self.settings['pack-size'],
+                                    pack_max_chunk_size=
+                                        self.settings['pack-max-chunk-size'],
+                                    checksum_algorithm=
+                                        self.settings['checksum-algorithm'],
+                                    file_id_cache_size=
+                                        self.settings['file-id-cache-size'])
+        self.repositories.add(repo)
+        return repo
+
+    def dump_memory_profile(self, msg): # pragma: no cover
+        cliapp.Application.dump_memory_profile(self, msg)
+        if self.settings['dump-memory-profile'] == 'none':
+            return
+        now = time.time()
+        interval = self.settings['memory-dump-interval']
+        if now < self.last_cache_report + interval:
+            return
+        self.last_cache_report = now
+        for repo in list(self.repositories):
+            if repo.client is not None:
+                logging.debug(repo.client.file_ids.report())
+
+    def open_chunk_cache(self, repo): # pragma: no cover
+        '''Open the local chunk index cache for a repository, if wanted.'''
+        dirname = self.settings['chunk-cache-dir']
+        if dirname:
+            repo_id = hashlib.md5(self.settings['repository']).hexdigest()
+            repo.open_chunk_cache(
+                os.path.join(os.path.expanduser(dirname), repo_id))
 
     def time(self):
         '''Return current time in seconds since epoch.
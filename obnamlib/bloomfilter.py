@@ -0,0 +1,97 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import math
+import struct
+
+import obnamlib
+
+
+class BloomFilter(object):
+
+    '''A set of strings that may have false positives.
+
+    A Bloom filter answers whether a string has been added to it.
+    The answer is always yes for strings that have been added, and
+    usually no for others: the probability of a false positive is
+    about ``error_rate``, as long as at most ``capacity`` strings
+    have been added. Strings can't be removed.
+
+    The filter takes about ten bits per string for a one percent
+    error rate.
+
+    '''
+
+    header_format = '!QQQQ'
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.num_bits = int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2)**2))
+        self.num_hashes = max(1, int(round(
+            float(self.num_bits) / self.capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) / 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        # Double hashing: the i'th hash is h1 + i * h2.
+        h1, h2 = struct.unpack('!QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        '''Add a string to the filter.'''
+        for i in self._indexes(key):
+            self.bits[i / 8] |= 1 << (i % 8)
+        self.count += 1
+
+    def __contains__(self, key):
+        for i in self._indexes(key):
+            if not self.bits[i / 8] & (1 << (i % 8)):
+                return False
+        return True
+
+    @property
+    def is_full(self):
+        '''Have more strings been added than the filter has capacity for?'''
+        return self.count > self.capacity
+
+    def encode(self):
+        '''Return the filter as a string.'''
+        header = struct.pack(self.header_format, self.capacity,
+                             self.num_bits, self.num_hashes, self.count)
+        return header + str(self.bits)
+
+    @classmethod
+    def decode(klass, encoded):
+        '''Return a filter from a string returned by ``encode``.'''
+        header_size = struct.calcsize(klass.header_format)
+        if len(encoded) < header_size:
+            raise obnamlib.Error('Bloom filter is truncated')
+        capacity, num_bits, num_hashes, count = struct.unpack(
+            klass.header_format, encoded[:header_size])
+        bits = bytearray(encoded[header_size:])
+        if len(bits) != (num_bits + 7) / 8:
+            raise obnamlib.Error('Bloom filter has wrong size')
+        bloom = klass.__new__(klass)
+        bloom.capacity = capacity
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.count = count
+        bloom.bits = bits
+        return bloom
+
@@ -0,0 +1,67 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import obnamlib
+
+
+class BloomFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.bloom = obnamlib.BloomFilter(1000)
+
+    def test_is_empty_initially(self):
+        self.assertFalse('foo' in self.bloom)
+        self.assertEqual(self.bloom.count, 0)
+
+    def test_contains_added_strings(self):
+        keys = ['key%d' % i for i in range(1000)]
+        for key in keys:
+            self.bloom.add(key)
+        for key in keys:
+            self.assertTrue(key in self.bloom)
+
+    def test_has_few_false_positives(self):
+        for i in range(1000):
+            self.bloom.add('key%d' % i)
+        false = [i for i in range(10000) if 'other%d' % i in self.bloom]
+        self.assertTrue(len(false) < 300)
+
+    def test_is_full_after_capacity_is_exceeded(self):
+        for i in range(1000):
+            self.bloom.add('key%d' % i)
+        self.assertFalse(self.bloom.is_full)
+        self.bloom.add('one more')
+        self.assertTrue(self.bloom.is_full)
+
+    def test_encodes_and_decodes(self):
+        self.bloom.add('foo')
+        bloom = obnamlib.BloomFilter.decode(self.bloom.encode())
+        self.assertTrue('foo' in bloom)
+        self.assertFalse('bar' in bloom)
+        self.assertEqual(bloom.count, 1)
+        self.assertEqual(bloom.capacity, 1000)
+        self.assertEqual(bloom.num_bits, self.bloom.num_bits)
+        self.assertEqual(bloom.num_hashes, self.bloom.num_hashes)
+
+    def test_decode_of_truncated_filter_fails(self):
+        encoded = self.bloom.encode()
+        self.assertRaises(obnamlib.Error, obnamlib.BloomFilter.decode,
+                          encoded[:10])
+        self.assertRaises(obnamlib.Error, obnamlib.BloomFilter.decode,
+                          encoded[:-1])
+
@@ -0,0 +1,173 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import struct
+
+import obnamlib
+
+
+# BLAKE2b is in hashlib from Python 3.6 on; for older versions, the
+# pyblake2 module provides it.
+try:
+    from hashlib import blake2b as _blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b as _blake2b
+    except ImportError:
+        _blake2b = None
+
+
+def _new_blake2b():
+    if _blake2b is None:
+        raise obnamlib.Error(
+            'Checksum algorithm blake2b needs the pyblake2 Python module')
+    return _blake2b(digest_size=32)
+
+
+_algorithms = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': _new_blake2b,
+}
+
+# Order matters: the first one is the default.
+checksum_algorithms = ['md5', 'sha256', 'blake2b']
+
+_format_key = 'checksum-algorithm: '
+
+# Repositories that do not use MD5 record a different version on the
+# first line of metadata/format. Older versions of Obnam know only
+# MD5 and check only that line, so they refuse to use them, rather
+# than write MD5 checksums into them.
+_checksum_format_versions = {
+    '6': '7',
+}
+
+
+def new_checksummer(algorithm):
+    '''Return a new hashlib-like object for a checksum algorithm.'''
+    if algorithm not in _algorithms:
+        raise obnamlib.Error('Unknown checksum algorithm %s' % algorithm)
+    return _algorithms[algorithm]()
+
+
+class FileChecksummer(object):
+
+    '''Compute the whole-file checksum of a file that may have holes.
+
+    Data is given with ``update``, like for a hashlib object, and the
+    holes of a sparse file with ``hole``. Holes cost nothing: instead
+    of their zero bytes, the checksum covers where they are. A file
+    without holes gets the plain checksum of its contents.
+
+    Adjacent holes are treated as one, so the checksum doesn't depend
+    on how a run of zeroes was split into holes.
+
+    '''
+
+    def __init__(self, algorithm):
+        self._algorithm = algorithm
+        self._data = new_checksummer(algorithm)
+        self._holes = None
+        self._pos = 0
+        self._hole_start = None
+
+    def update(self, data):
+        if data:
+            self._end_hole()
+            self._data.update(data)
+            self._pos += len(data)
+
+    def hole(self, size):
+        if size > 0:
+            if self._hole_start is None:
+                self._hole_start = self._pos
+            self._pos += size
+
+    def _end_hole(self):
+        if self._hole_start is not None:
+            if self._holes is None:
+                self._holes = new_checksummer(self._algorithm)
+            self._holes.update(struct.pack('!QQ', self._hole_start,
+                                           self._pos - self._hole_start))
+            self._hole_start = None
+
+    def digest(self):
+        self._end_hole()
+        if self._holes is None:
+            return self._data.digest()
+        summer = new_checksummer(self._algorithm)
+        summer.update('sparse\n')
+        summer.update(self._data.digest())
+        summer.update(self._holes.digest())
+        summer.update(struct.pack('!Q', self._pos))
+        return summer.digest()
+
+
+def checksum_algorithm_is_available(algorithm):
+    '''Can a checksum algorithm be used here?'''
+    try:
+        new_checksummer(algorithm)
+    except obnamlib.Error:
+        return False
+    return True
+
+
+def format_file_contents(version, checksum_algorithm):
+    '''Return contents for the metadata/format file of a repository.
+
+    Repositories using MD5 do not mention the checksum algorithm, so
+    that they stay usable by older versions of Obnam. Other algorithms
+    are named on a second line, and the first line gets a version
+    that older versions of Obnam don't accept.
+
+    '''
+
+    version = str(version)
+    if checksum_algorithm == checksum_algorithms[0]:
+        return '%s\n' % version
+    if version not in _checksum_format_versions:
+        raise obnamlib.Error(
+            'Repository format %s does not support checksum algorithm %s' %
+            (version, checksum_algorithm))
+    return '%s\n%s%s\n' % (_checksum_format_versions[version],
+                            _format_key, checksum_algorithm)
+
+
+def parse_format_version(format_contents):
+    '''Return repository format version from a metadata/format file.
+
+    The version is returned as a string, the same for a repository
+    using MD5 and one using another checksum algorithm.
+
+    '''
+
+    lines = format_contents.splitlines()
+    line = lines[0].strip() if lines else ''
+    for version, checksum_version in _checksum_format_versions.items():
+        if line == checksum_version:
+            return version
+    return line
+
+
+def parse_checksum_algorithm(format_contents):
+    '''Return checksum algorithm named in a metadata/format file.'''
+    for line in format_contents.splitlines()[1:]:
+        if line.startswith(_format_key):
+            return line[len(_format_key):].strip()
+    return checksum_algorithms[0]
+
@@ -0,0 +1,140 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import unittest
+
+import obnamlib
+
+
+class ChecksummerTests(unittest.TestCase):
+
+    def test_md5_is_default(self):
+        self.assertEqual(obnamlib.checksum_algorithms[0], 'md5')
+
+    def test_computes_md5(self):
+        summer = obnamlib.new_checksummer('md5')
+        summer.update('foo')
+        self.assertEqual(summer.hexdigest(), hashlib.md5('foo').hexdigest())
+
+    def test_computes_sha256(self):
+        summer = obnamlib.new_checksummer('sha256')
+        summer.update('foo')
+        self.assertEqual(summer.hexdigest(),
+                         hashlib.sha256('foo').hexdigest())
+
+    def test_blake2b_has_256_bits_if_available(self):
+        if obnamlib.checksum_algorithm_is_available('blake2b'):
+            summer = obnamlib.new_checksummer('blake2b')
+            self.assertEqual(len(summer.digest()), 32)
+        else:
+            self.assertRaises(obnamlib.Error,
+                              obnamlib.new_checksummer, 'blake2b')
+
+    def test_unknown_algorithm_fails(self):
+        self.assertRaises(obnamlib.Error, obnamlib.new_checksummer, 'foo')
+        self.assertFalse(obnamlib.checksum_algorithm_is_available('foo'))
+
+    def test_format_file_for_md5_has_only_version(self):
+        self.assertEqual(obnamlib.format_file_contents(6, 'md5'), '6\n')
+
+    def test_format_file_names_other_algorithm(self):
+        contents = obnamlib.format_file_contents(6, 'sha256')
+        self.assertEqual(obnamlib.parse_checksum_algorithm(contents),
+                         'sha256')
+
+    def test_format_version_is_same_for_all_algorithms(self):
+        for algorithm in obnamlib.checksum_algorithms:
+            contents = obnamlib.format_file_contents(6, algorithm)
+            self.assertEqual(obnamlib.parse_format_version(contents), '6')
+
+    def test_old_format_file_means_md5(self):
+        self.assertEqual(obnamlib.parse_checksum_algorithm('6\n'), 'md5')
+        self.assertEqual(obnamlib.parse_format_version('6\n'), '6')
+
+    def test_old_reader_accepts_md5_format_file(self):
+        contents = obnamlib.format_file_contents(6, 'md5')
+        first_line = contents.splitlines()[0]
+        self.assertEqual(int(first_line), 6)
+        self.assertEqual(first_line.strip(), '6')
+
+    def test_old_reader_rejects_other_algorithms(self):
+        # Older versions of Obnam compare the first line of the format
+        # file with their own format version, either as an integer or
+        # as a string, and ignore any other lines.
+        for algorithm in obnamlib.checksum_algorithms[1:]:
+            contents = obnamlib.format_file_contents(6, algorithm)
+            first_line = contents.splitlines()[0]
+            self.assertNotEqual(int(first_line), 6)
+            self.assertNotEqual(first_line.strip(), '6')
+
+    def test_unsupported_format_version_with_other_algorithm_fails(self):
+        self.assertRaises(obnamlib.Error,
+                          obnamlib.format_file_contents, 5, 'sha256')
+
+
+
+class FileChecksummerTests(unittest.TestCase):
+
+    def test_file_without_holes_has_plain_checksum(self):
+        summer = obnamlib.FileChecksummer('md5')
+        summer.update('foo')
+        summer.update('bar')
+        self.assertEqual(summer.digest(), hashlib.md5('foobar').digest())
+
+    def test_holes_change_checksum(self):
+        summer = obnamlib.FileChecksummer('md5')
+        summer.update('foo')
+        summer.hole(3)
+        self.assertNotEqual(summer.digest(), hashlib.md5('foo').digest())
+        self.assertNotEqual(summer.digest(),
+                            hashlib.md5('foo\0\0\0').digest())
+
+    def test_checksum_depends_on_where_hole_is(self):
+        a = obnamlib.FileChecksummer('md5')
+        a.update('foo')
+        a.hole(3)
+        a.update('bar')
+        b = obnamlib.FileChecksummer('md5')
+        b.update('fo')
+        b.hole(3)
+        b.update('obar')
+        self.assertNotEqual(a.digest(), b.digest())
+
+    def test_checksum_depends_on_hole_size(self):
+        a = obnamlib.FileChecksummer('md5')
+        a.hole(3)
+        b = obnamlib.FileChecksummer('md5')
+        b.hole(4)
+        self.assertNotEqual(a.digest(), b.digest())
+
+    def test_adjacent_holes_are_joined(self):
+        a = obnamlib.FileChecksummer('md5')
+        a.update('foo')
+        a.hole(1)
+        a.update('')
+        a.hole(2)
+        a.update('bar')
+        b = obnamlib.FileChecksummer('md5')
+        b.update('foo')
+        b.hole(3)
+        b.update('bar')
+        self.assertEqual(a.digest(), b.digest())
+
+    def test_huge_hole_costs_nothing(self):
+        summer = obnamlib.FileChecksummer('md5')
+        summer.hole(2**60)
+        self.assertEqual(len(summer.digest()), 16)
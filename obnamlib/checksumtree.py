@@ -14,6 +14,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import errno
+import os
 import struct
 import tracing
 
@@ -27,8 +29,24 @@ class ChecksumTree(obnamlib.RepositoryTree):
     The checksum might be, for example, an MD5 one (as returned by
     hashlib.md5().digest()). The id would be a chunk id.
 
+    Most checksums looked up during a backup are not in the tree, and
+    finding that out needs B-tree nodes that may have to be fetched
+    from a remote repository. A Bloom filter of all checksums in the
+    tree answers most such lookups without touching the tree. It is
+    saved in the tree's directory when the tree is committed, tagged
+    with the id of the tree's root node, and loaded when needed if
+    the tree has not changed since. Every change to the tree keeps
+    the filter up to date, so it is only built by reading the whole
+    tree if the tree was changed without it, by an older version of
+    Obnam or by one that crashed, and then only once: the new filter
+    is saved at the next commit.
+
     '''
 
+    bloom_basename = 'bloom'
+    bloom_header_format = '!Q'
+    min_bloom_capacity = 64 * 1024
+
     def __init__(self, fs, name, checksum_length, node_size,
                  upload_queue_size, lru_size, hooks):
         tracing.trace('new ChecksumTree name=%s' % name)
@@ -37,6 +55,9 @@ class ChecksumTree(obnamlib.RepositoryTree):
         obnamlib.RepositoryTree.__init__(self, fs, name, key_bytes, node_size,
                                          upload_queue_size, lru_size, hooks)
         self.keep_just_one_tree = True
+        self.checksum_length = checksum_length
+        self.bloom = None
+        self.bloom_root_id = None
 
     def key(self, checksum, chunk_id, client_id):
         return struct.pack(self.fmt, checksum, chunk_id, client_id)
@@ -51,9 +72,23 @@ class ChecksumTree(obnamlib.RepositoryTree):
         self.start_changes()
         key = self.key(checksum, chunk_id, client_id)
         self.tree.insert(key, '')
+        if self.bloom is not None:
+            self.bloom.add(checksum)
+
+    def add_many(self, triples):
+        '''Add many (checksum, chunk_id, client_id) triples at once.'''
+        tracing.trace('adding %d checksums', len(triples))
+        self.insert_sorted((self.key(checksum, chunk_id, client_id), '')
+                           for checksum, chunk_id, client_id in triples)
+        if self.bloom is not None:
+            for checksum, chunk_id, client_id in triples:
+                self.bloom.add(checksum)
 
     def find(self, checksum):
         if self.init_forest() and self.forest.trees:
+            bloom = self.get_bloom()
+            if bloom is not None and checksum not in bloom:
+                return []
             minkey = self.key(checksum, 0, 0)
             maxkey = self.key(checksum, obnamlib.MAX_ID, obnamlib.MAX_ID)
             t = self.forest.trees[-1]
@@ -80,3 +115,105 @@ class ChecksumTree(obnamlib.RepositoryTree):
         else:
             return False
 
+    def start_changes(self, create_tree=True):
+        starting = self.tree is None
+        obnamlib.RepositoryTree.start_changes(self, create_tree=create_tree)
+        if starting and self.tree is not None:
+            # The new tree is a copy of the one with base_root_id. The
+            # filter must match that one, so that the changes made to
+            # it keep the filter valid, and it can be saved at commit.
+            self._use_bloom_for(self.base_root_id)
+
+    def commit(self):
+        writing = self.tree is not None
+        obnamlib.RepositoryTree.commit(self)
+        if writing and self.bloom is not None:
+            root_id = self._newest_root_id()
+            if self.bloom.is_full:
+                self.bloom = self._build_bloom(2 * self.bloom.count)
+            self.bloom_root_id = root_id
+            self._save_bloom()
+
+    def _newest_root_id(self):
+        if self.forest.trees:
+            return self.forest.trees[-1].root.id
+        return None
+
+    def _bloom_filename(self):
+        return os.path.join(self.dirname, self.bloom_basename)
+
+    def get_bloom(self):
+        '''Return Bloom filter of checksums in newest tree.
+
+        Return None if there is no tree yet.
+
+        '''
+
+        if self.tree is None:
+            if not self.init_forest() or not self.forest.trees:
+                return None
+            self._use_bloom_for(self._newest_root_id())
+        return self.bloom
+
+    def _use_bloom_for(self, root_id):
+        '''Make self.bloom match the tree with a given root id.
+
+        The tree must be the newest one in the forest, or a copy of it
+        that has not been changed yet.
+
+        '''
+
+        if self.bloom is not None and self.bloom_root_id == root_id:
+            return
+        saved = self._load_bloom()
+        if saved is not None and saved[0] == root_id:
+            self.bloom = saved[1]
+        else:
+            tracing.trace('%s changed without Bloom filter', self.dirname)
+            capacity = 0
+            if saved is not None:
+                capacity = 2 * saved[1].count
+            self.bloom = self._build_bloom(capacity)
+        self.bloom_root_id = root_id
+
+    def _load_bloom(self):
+        try:
+            encoded = self.fs.cat(self._bloom_filename())
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT: # pragma: no cover
+                raise
+            return None
+        header_size = struct.calcsize(self.bloom_header_format)
+        if len(encoded) < header_size: # pragma: no cover
+            return None
+        (root_id,) = struct.unpack(self.bloom_header_format,
+                                   encoded[:header_size])
+        try:
+            bloom = obnamlib.BloomFilter.decode(encoded[header_size:])
+        except obnamlib.Error, e: # pragma: no cover
+            tracing.trace('ignoring bad Bloom filter: %s', e)
+            return None
+        return root_id, bloom
+
+    def _save_bloom(self):
+        tracing.trace('saving Bloom filter for %s', self.dirname)
+        encoded = (struct.pack(self.bloom_header_format, self.bloom_root_id) +
+                   self.bloom.encode())
+        self.fs.overwrite_file(self._bloom_filename(), encoded)
+
+    def _build_bloom(self, capacity):
+        tracing.trace('building Bloom filter for %s', self.dirname)
+        minkey = self.key('\0' * self.checksum_length, 0, 0)
+        maxkey = self.key('\xff' * self.checksum_length,
+                          obnamlib.MAX_ID, obnamlib.MAX_ID)
+        capacity = max(capacity, self.min_bloom_capacity)
+        while True:
+            bloom = obnamlib.BloomFilter(capacity)
+            t = self.forest.trees[-1]
+            for key, value in t.lookup_range(minkey, maxkey):
+                bloom.add(self.unkey(key)[0])
+                if bloom.is_full:
+                    break
+            if not bloom.is_full:
+                return bloom
+            capacity *= 2
@@ -53,6 +53,14 @@ class ChecksumTreeTests(unittest.TestCase):
         self.tree.add(hashlib.md5('bar').digest(), 5, 6)
         self.assertEqual(sorted(self.tree.find(self.checksum)), [1, 3])
 
+    def test_adds_many_checksums(self):
+        other = hashlib.md5('bar').digest()
+        self.tree.add_many([(other, 5, 6),
+                            (self.checksum, 3, 4),
+                            (self.checksum, 1, 2)])
+        self.assertEqual(sorted(self.tree.find(self.checksum)), [1, 3])
+        self.assertEqual(self.tree.find(other), [5])
+
     def test_removes_checksum(self):
         self.tree.add(self.checksum, 1, 3)
         self.tree.add(self.checksum, 2, 4)
@@ -71,3 +79,64 @@ class ChecksumTreeTests(unittest.TestCase):
         self.tree.add(self.checksum, 0, 1)
         self.assertTrue(self.tree.chunk_is_used(self.checksum, 0))
 
+
+    def new_tree(self):
+        return obnamlib.ChecksumTree(self.tree.fs, 'x', len(self.checksum),
+                                     obnamlib.DEFAULT_NODE_SIZE,
+                                     obnamlib.DEFAULT_UPLOAD_QUEUE_SIZE,
+                                     obnamlib.DEFAULT_LRU_SIZE, self)
+
+    def test_builds_bloom_filter_from_tree(self):
+        self.tree.add(self.checksum, 1, 2)
+        self.tree.commit()
+        tree = self.new_tree()
+        self.assertTrue(self.checksum in tree.get_bloom())
+        self.assertEqual(tree.find(self.checksum), [1])
+
+    def test_saves_bloom_filter_at_commit(self):
+        self.tree.add(self.checksum, 1, 2)
+        self.tree.find(self.checksum)
+        self.tree.commit()
+        self.assertTrue(self.tree.fs.exists('x/bloom'))
+        tree = self.new_tree()
+        tree.init_forest()
+        self.assertEqual(tree._load_bloom()[0], tree._newest_root_id())
+        self.assertEqual(tree.find(self.checksum), [1])
+
+    def test_bloom_filter_is_updated_by_add(self):
+        self.tree.add(self.checksum, 1, 2)
+        self.tree.find(self.checksum)
+        other = hashlib.md5('bar').digest()
+        self.assertFalse(other in self.tree.get_bloom())
+        self.tree.add(other, 3, 4)
+        self.assertTrue(other in self.tree.get_bloom())
+        self.assertEqual(self.tree.find(other), [3])
+
+    def test_has_no_bloom_filter_without_tree(self):
+        self.assertEqual(self.new_tree().get_bloom(), None)
+
+    def test_keeps_saved_bloom_filter_valid_when_only_removing(self):
+        self.tree.add(self.checksum, 1, 2)
+        self.tree.add(self.checksum, 3, 4)
+        self.tree.commit()
+        tree = self.new_tree()
+        tree.remove(self.checksum, 1, 2)
+        tree.commit()
+        tree = self.new_tree()
+        tree.init_forest()
+        self.assertEqual(tree._load_bloom()[0], tree._newest_root_id())
+        self.assertEqual(tree.find(self.checksum), [3])
+
+    def test_rebuilds_bloom_filter_after_change_without_it(self):
+        self.tree.add(self.checksum, 1, 2)
+        self.tree.commit()
+        # Change the tree the way older versions of Obnam do, without
+        # updating the saved filter.
+        other = hashlib.md5('bar').digest()
+        tree = self.new_tree()
+        obnamlib.RepositoryTree.start_changes(tree)
+        tree.tree.insert(tree.key(other, 3, 4), '')
+        obnamlib.RepositoryTree.commit(tree)
+        tree = self.new_tree()
+        self.assertEqual(tree.find(other), [3])
+        self.assertEqual(tree.find(self.checksum), [1])
@@ -0,0 +1,150 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import anydbm
+import logging
+import os
+import struct
+
+
+class ChunkIndexCache(object):
+
+    '''A local cache of the repository's shared chunk indexes.
+
+    Looking up a checksum in the chunksums B-tree, or a chunk id in
+    the chunklist B-tree, may need to fetch B-tree nodes from a remote
+    repository. This cache keeps the results of such lookups on the
+    local disk, so that later lookups, in the same or later runs, are
+    answered locally.
+
+    The cache is valid only for the versions of the B-trees it was
+    filled from. The caller identifies them with a ``stamp`` string,
+    such as the ids of the root nodes of the trees. If the stamp is
+    different when the cache is opened, the cache is emptied.
+
+    When the caller changes the B-trees, it should tell the cache
+    with ``add`` and ``remove``, and call ``set_stamp`` once the
+    changes have been committed. Meanwhile, the cache is marked as
+    invalid on disk, in case the changes are never committed.
+
+    '''
+
+    header_key = 'header'
+
+    def __init__(self, filename, stamp):
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._db = anydbm.open(filename, 'c')
+        self.stamp = stamp
+        if self._db.get(self.header_key) != stamp:
+            logging.debug('Chunk index cache %s is out of date' % filename)
+            self.clear()
+        self.dirty = False
+        self.hits = 0
+
+    def clear(self):
+        '''Empty the cache.'''
+        self._db.close()
+        self._db = anydbm.open(self.filename, 'n')
+        # Some dbm modules ignore the 'n' flag.
+        for key in self._db.keys():
+            del self._db[key]
+        self._db[self.header_key] = self.stamp
+
+    def set_stamp(self, stamp):
+        '''Mark cache as valid for B-trees identified by stamp.'''
+        self.stamp = stamp
+        self._db[self.header_key] = stamp
+        self.dirty = False
+
+    def _checksum_key(self, checksum):
+        return 's' + checksum
+
+    def _chunkid_key(self, chunkid):
+        return 'c' + struct.pack('!Q', chunkid)
+
+    def _cached_chunkids(self, checksum):
+        value = self._db.get(self._checksum_key(checksum))
+        if value is None:
+            return None
+        return list(struct.unpack('!%dQ' % (len(value) / 8), value))
+
+    def find(self, checksum):
+        '''Return cached chunk ids for a checksum, or None.'''
+        chunkids = self._cached_chunkids(checksum)
+        if chunkids is not None:
+            self.hits += 1
+        return chunkids
+
+    def remember_find(self, checksum, chunkids):
+        '''Remember the chunk ids found for a checksum.'''
+        self._db[self._checksum_key(checksum)] = struct.pack(
+            '!%dQ' % len(chunkids), *chunkids)
+
+    def get_checksum(self, chunkid):
+        '''Return cached checksum of a chunk, or None.
+
+        If it is known that the chunk has no checksum, raise KeyError.
+
+        '''
+
+        value = self._db.get(self._chunkid_key(chunkid))
+        if value is None:
+            return None
+        self.hits += 1
+        if value == '':
+            raise KeyError(chunkid)
+        return value
+
+    def remember_checksum(self, chunkid, checksum):
+        '''Remember the checksum of a chunk, or None if it has none.'''
+        self._db[self._chunkid_key(chunkid)] = checksum or ''
+
+    def _invalidate(self):
+        if not self.dirty:
+            self._db[self.header_key] = ''
+            self.dirty = True
+
+    def add(self, checksum, chunkid):
+        '''Record that a chunk has been added to the B-trees.'''
+        self._invalidate()
+        chunkids = self._cached_chunkids(checksum)
+        if chunkids is not None:
+            self.remember_find(checksum, chunkids + [chunkid])
+        self.remember_checksum(chunkid, checksum)
+
+    def remove(self, checksum, chunkid):
+        '''Record that a chunk has been removed from the B-trees.
+
+        ``checksum`` may be None, if it is not known.
+
+        '''
+
+        self._invalidate()
+        keys = [self._chunkid_key(chunkid)]
+        if checksum is not None:
+            keys.append(self._checksum_key(checksum))
+        for key in keys:
+            if key in self._db:
+                del self._db[key]
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
@@ -0,0 +1,103 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class ChunkIndexCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache', 'repo')
+        self.cache = obnamlib.ChunkIndexCache(self.filename, 'stamp')
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tempdir)
+
+    def reopen(self, stamp):
+        self.cache.close()
+        self.cache = obnamlib.ChunkIndexCache(self.filename, stamp)
+
+    def test_knows_nothing_initially(self):
+        self.assertEqual(self.cache.find('checksum'), None)
+        self.assertEqual(self.cache.get_checksum(1), None)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_remembers_found_chunkids(self):
+        self.cache.remember_find('checksum', [1, 2])
+        self.assertEqual(self.cache.find('checksum'), [1, 2])
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_remembers_that_nothing_was_found(self):
+        self.cache.remember_find('checksum', [])
+        self.assertEqual(self.cache.find('checksum'), [])
+
+    def test_remembers_checksum(self):
+        self.cache.remember_checksum(1, 'checksum')
+        self.assertEqual(self.cache.get_checksum(1), 'checksum')
+
+    def test_remembers_missing_checksum(self):
+        self.cache.remember_checksum(1, None)
+        self.assertRaises(KeyError, self.cache.get_checksum, 1)
+
+    def test_is_valid_for_same_stamp(self):
+        self.cache.remember_find('checksum', [1])
+        self.reopen('stamp')
+        self.assertEqual(self.cache.find('checksum'), [1])
+
+    def test_is_emptied_for_other_stamp(self):
+        self.cache.remember_find('checksum', [1])
+        self.reopen('other')
+        self.assertEqual(self.cache.find('checksum'), None)
+
+    def test_add_updates_cached_entries(self):
+        self.cache.remember_find('checksum', [1])
+        self.cache.add('checksum', 2)
+        self.assertEqual(self.cache.find('checksum'), [1, 2])
+        self.assertEqual(self.cache.get_checksum(2), 'checksum')
+
+    def test_add_does_not_guess_uncached_entries(self):
+        self.cache.add('checksum', 2)
+        self.assertEqual(self.cache.find('checksum'), None)
+
+    def test_remove_forgets_entries(self):
+        self.cache.remember_find('checksum', [1])
+        self.cache.remember_checksum(1, 'checksum')
+        self.cache.remove('checksum', 1)
+        self.assertEqual(self.cache.find('checksum'), None)
+        self.assertEqual(self.cache.get_checksum(1), None)
+
+    def test_uncommitted_changes_invalidate_cache(self):
+        self.cache.remember_find('checksum', [1])
+        self.cache.add('checksum', 2)
+        self.assertTrue(self.cache.dirty)
+        self.reopen('stamp')
+        self.assertEqual(self.cache.find('checksum'), None)
+
+    def test_committed_changes_are_kept_with_new_stamp(self):
+        self.cache.remember_find('checksum', [1])
+        self.cache.add('checksum', 2)
+        self.cache.set_stamp('new')
+        self.assertFalse(self.cache.dirty)
+        self.reopen('new')
+        self.assertEqual(self.cache.find('checksum'), [1, 2])
+
@@ -0,0 +1,92 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+
+import obnamlib
+
+
+class ChunkReader(object):
+
+    '''Read any part of a file that is stored as a list of chunks.
+
+    Chunks may be of any size, as with content-defined chunking, so
+    the offset of a chunk in the file is the sum of the sizes of the
+    chunks before it. The size of a chunk is only known once it has
+    been fetched with ``get_chunk``, so reading at some offset first
+    fetches the earlier chunks whose size is not known yet.
+
+    Sizes are kept in ``sizes``, a dict from chunk id to size, which
+    may be shared between readers. The last chunk fetched is kept,
+    so reading a file from start to end fetches each chunk once.
+
+    The list may contain ``Hole`` objects for holes in sparse files,
+    which read as zeroes, without fetching anything.
+
+    '''
+
+    def __init__(self, chunkids, get_chunk, sizes=None):
+        self.chunkids = chunkids
+        self.get_chunk = get_chunk
+        self.sizes = {} if sizes is None else sizes
+        # offsets[i] is the offset of chunkids[i]; it is known once
+        # the sizes of all earlier chunks are.
+        self.offsets = [0]
+        self._last_chunkid = None
+        self._last_data = None
+
+    def read(self, offset, length):
+        '''Return ``length`` bytes at ``offset``, or fewer at the end.'''
+
+        output = []
+        end = offset + length
+        i = self._find(offset)
+        while offset < end and i < len(self.chunkids):
+            if len(self.offsets) == i + 1:
+                self.offsets.append(self.offsets[i] + self._size(i))
+            n = min(end, self.offsets[i + 1]) - offset
+            chunkid = self.chunkids[i]
+            if isinstance(chunkid, obnamlib.Hole):
+                output.append('\0' * n)
+            else:
+                start = offset - self.offsets[i]
+                output.append(self._fetch(chunkid)[start:start + n])
+            offset += n
+            i += 1
+        return ''.join(output)
+
+    def _find(self, offset):
+        '''Return index of chunk at offset, or number of chunks if none.'''
+        while (self.offsets[-1] <= offset and
+               len(self.offsets) <= len(self.chunkids)):
+            i = len(self.offsets) - 1
+            self.offsets.append(self.offsets[-1] + self._size(i))
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    def _size(self, i):
+        chunkid = self.chunkids[i]
+        if isinstance(chunkid, obnamlib.Hole):
+            return chunkid.size
+        if chunkid not in self.sizes:
+            self._fetch(chunkid)
+        return self.sizes[chunkid]
+
+    def _fetch(self, chunkid):
+        if self._last_data is None or chunkid != self._last_chunkid:
+            self._last_data = self.get_chunk(chunkid)
+            self._last_chunkid = chunkid
+            self.sizes[chunkid] = len(self._last_data)
+        return self._last_data
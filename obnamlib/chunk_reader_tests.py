@@ -0,0 +1,83 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import obnamlib
+
+
+class ChunkReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = {
+            1: 'aaa',
+            2: 'b',
+            3: 'cccccc',
+            4: 'dd',
+        }
+        self.fetched = []
+
+    def get_chunk(self, chunkid):
+        self.fetched.append(chunkid)
+        return self.chunks[chunkid]
+
+    def reader(self, chunkids, sizes=None):
+        return obnamlib.ChunkReader(chunkids, self.get_chunk, sizes)
+
+    def test_reads_nothing_from_empty_file(self):
+        self.assertEqual(self.reader([]).read(0, 10), '')
+
+    def test_reads_whole_file(self):
+        self.assertEqual(self.reader([1, 2, 3, 4]).read(0, 100),
+                         'aaabccccccdd')
+
+    def test_reads_across_chunks_of_different_sizes(self):
+        reader = self.reader([1, 2, 3, 4])
+        self.assertEqual(reader.read(2, 3), 'abc')
+        self.assertEqual(reader.read(9, 2), 'cd')
+        self.assertEqual(reader.read(11, 5), 'd')
+
+    def test_reads_nothing_past_end(self):
+        self.assertEqual(self.reader([1, 2]).read(4, 10), '')
+
+    def test_reads_same_chunk_used_twice(self):
+        self.assertEqual(self.reader([4, 1, 4]).read(0, 7), 'ddaaadd')
+
+    def test_fetches_each_chunk_once_when_reading_in_order(self):
+        reader = self.reader([1, 2, 3, 4])
+        for offset in range(0, 12, 2):
+            reader.read(offset, 2)
+        self.assertEqual(self.fetched, [1, 2, 3, 4])
+
+    def test_reads_sparse_file(self):
+        reader = self.reader([obnamlib.Hole(4), 1, obnamlib.Hole(2), 4,
+                              obnamlib.Hole(3)])
+        self.assertEqual(reader.read(0, 100),
+                         '\0\0\0\0aaa\0\0dd\0\0\0')
+        self.assertEqual(self.fetched, [1, 4])
+        self.assertEqual(reader.read(2, 3), '\0\0a')
+        self.assertEqual(reader.read(8, 4), '\0dd\0')
+
+    def test_reads_in_hole_without_fetching(self):
+        reader = self.reader([1, obnamlib.Hole(1024**2), 2])
+        self.assertEqual(reader.read(1000, 10), '\0' * 10)
+        self.assertEqual(reader.read(1024**2 + 2, 10), '\0b')
+        self.assertEqual(self.fetched, [1, 2])
+
+    def test_uses_known_sizes_instead_of_fetching(self):
+        reader = self.reader([1, 2, 3, 4], sizes={1: 3, 2: 1, 3: 6})
+        self.assertEqual(reader.read(10, 2), 'dd')
+        self.assertEqual(self.fetched, [4])
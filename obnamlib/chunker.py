@@ -0,0 +1,110 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import obnamlib
+
+
+class FixedChunker(object):
+
+    '''Split file data into chunks of a fixed size.
+
+    All chunks are of the same size, except the last one, which may
+    be shorter.
+
+    '''
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+
+    def chunks(self, f):
+        '''Generate chunks of data read from an open file.'''
+        while True:
+            data = f.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+
+
+class RabinChunker(object):
+
+    '''Split file data into content-defined chunks.
+
+    Chunk boundaries are found with a rolling hash over the data (see
+    ``rabin_boundary`` in the _obnam extension), so they depend on the
+    content of the data, not its offset in the file. If some bytes are
+    inserted or removed, only the chunks around the change differ, and
+    the rest can be de-duplicated against an earlier backup.
+
+    Chunks are at least ``min_size`` and at most ``max_size`` bytes
+    long, except that the last chunk may be shorter. On random data the
+    average size is about ``avg_size`` bytes, rounded down to a power
+    of two.
+
+    '''
+
+    def __init__(self, min_size, avg_size, max_size):
+        if not 0 < min_size <= avg_size <= max_size:
+            raise obnamlib.Error(
+                'Bad chunk sizes for content-defined chunking: '
+                'need 0 < min (%d) <= average (%d) <= max (%d)' %
+                (min_size, avg_size, max_size))
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.buffer_size = 4 * max_size
+
+    def chunks(self, f):
+        '''Generate chunks of data read from an open file.'''
+
+        buf = ''
+        offset = 0
+        eof = False
+        while True:
+            # Keep at least max_size bytes buffered, so that a chunk
+            # only ends early at a real boundary, or at end of file.
+            # Several chunks' worth is read at a time, so that the
+            # unused end of the buffer is copied only once per refill.
+            if not eof and len(buf) - offset < self.max_size:
+                parts = [buf[offset:]]
+                size = len(parts[0])
+                while not eof and size < self.buffer_size:
+                    data = f.read(self.buffer_size - size)
+                    if data:
+                        parts.append(data)
+                        size += len(data)
+                    else:
+                        eof = True
+                buf = ''.join(parts)
+                offset = 0
+
+            if offset >= len(buf):
+                break
+
+            n = obnamlib._obnam.rabin_boundary(
+                buf, offset, self.min_size, self.avg_size, self.max_size)
+            yield buf[offset:offset + n]
+            offset += n
+
+
+def new_chunker(settings):
+    '''Create a chunker as specified by settings.'''
+
+    chunk_size = int(settings['chunk-size'])
+    if settings['chunker'] == 'rabin':
+        min_size = int(settings['chunk-min-size']) or max(1, chunk_size / 4)
+        max_size = int(settings['chunk-max-size']) or chunk_size * 4
+        return RabinChunker(min_size, chunk_size, max_size)
+    return FixedChunker(chunk_size)
@@ -0,0 +1,104 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import StringIO
+import unittest
+
+import obnamlib
+
+
+def random_data(size, seed=0):
+    r = random.Random(seed)
+    return ''.join(chr(r.randint(0, 255)) for i in xrange(size))
+
+
+class FixedChunkerTests(unittest.TestCase):
+
+    def test_returns_nothing_for_empty_file(self):
+        chunker = obnamlib.FixedChunker(10)
+        self.assertEqual(list(chunker.chunks(StringIO.StringIO(''))), [])
+
+    def test_returns_fixed_size_chunks(self):
+        chunker = obnamlib.FixedChunker(3)
+        f = StringIO.StringIO('abcdefgh')
+        self.assertEqual(list(chunker.chunks(f)), ['abc', 'def', 'gh'])
+
+
+class RabinChunkerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.chunker = obnamlib.RabinChunker(256, 1024, 4096)
+        self.data = random_data(64 * 1024)
+
+    def chunks(self, data):
+        return list(self.chunker.chunks(StringIO.StringIO(data)))
+
+    def test_rejects_bad_sizes(self):
+        self.assertRaises(obnamlib.Error, obnamlib.RabinChunker, 10, 5, 20)
+        self.assertRaises(obnamlib.Error, obnamlib.RabinChunker, 0, 5, 20)
+
+    def test_returns_nothing_for_empty_file(self):
+        self.assertEqual(self.chunks(''), [])
+
+    def test_returns_short_file_as_one_chunk(self):
+        self.assertEqual(self.chunks('hello'), ['hello'])
+
+    def test_chunks_add_up_to_data(self):
+        self.assertEqual(''.join(self.chunks(self.data)), self.data)
+
+    def test_respects_min_and_max_sizes(self):
+        chunks = self.chunks(self.data)
+        for chunk in chunks[:-1]:
+            self.assert_(256 <= len(chunk) <= 4096, len(chunk))
+
+    def test_cuts_at_max_size_if_no_boundary_is_found(self):
+        chunks = self.chunks('\0' * 10000)
+        self.assertEqual([len(x) for x in chunks], [4096, 4096, 1808])
+
+    def test_finds_same_chunks_after_inserted_data(self):
+        old = set(self.chunks(self.data))
+        new = self.chunks('inserted' + self.data)
+        same = [chunk for chunk in new if chunk in old]
+        self.assert_(len(same) >= len(new) - 2)
+
+
+class NewChunkerTests(unittest.TestCase):
+
+    def settings(self, chunker, min_size=0, max_size=0):
+        return {
+            'chunker': chunker,
+            'chunk-size': 1024,
+            'chunk-min-size': min_size,
+            'chunk-max-size': max_size,
+        }
+
+    def test_creates_fixed_chunker(self):
+        chunker = obnamlib.new_chunker(self.settings('fixed'))
+        self.assertEqual(type(chunker), obnamlib.FixedChunker)
+        self.assertEqual(chunker.chunk_size, 1024)
+
+    def test_creates_rabin_chunker_with_default_sizes(self):
+        chunker = obnamlib.new_chunker(self.settings('rabin'))
+        self.assertEqual(type(chunker), obnamlib.RabinChunker)
+        self.assertEqual(chunker.min_size, 256)
+        self.assertEqual(chunker.avg_size, 1024)
+        self.assertEqual(chunker.max_size, 4096)
+
+    def test_creates_rabin_chunker_with_given_sizes(self):
+        chunker = obnamlib.new_chunker(self.settings('rabin', 100, 2000))
+        self.assertEqual(chunker.min_size, 100)
+        self.assertEqual(chunker.max_size, 2000)
@@ -0,0 +1,162 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import binascii
+import struct
+
+
+class ChunkidPool(object):
+
+    '''Checksum/chunkid mappings that are pending an upload to shared trees.
+
+    A backup may add millions of chunks between checkpoints, so the
+    mappings are kept compactly, in an open addressing hash table in
+    one bytearray, instead of a dict of lists. Each slot holds a
+    checksum and a chunk id. A checksum with several chunk ids uses
+    several slots.
+
+    All checksums are assumed to have the same length as the first
+    one. If it is a hexadecimal string, such as one returned by
+    ``Repository.checksum``, it is stored as the binary digest, which
+    takes half the space. Checksums that do not fit the table are kept
+    in a dict instead.
+
+    '''
+
+    initial_slots = 1024
+
+    # Grow the table when more than max_load_percent of it is used.
+    max_load_percent = 70
+
+    id_format = '=Q'
+    id_size = struct.calcsize(id_format)
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._key_size = None
+        self._hex = False
+        self._num_slots = 0
+        self._table = bytearray()
+        self._used = bytearray()
+        self._count = 0
+        self._odd = {}
+
+    def _setup(self, checksum):
+        try:
+            key = binascii.unhexlify(checksum)
+        except TypeError:
+            key = None
+        self._hex = key is not None and binascii.hexlify(key) == checksum
+        self._key_size = len(key) if self._hex else len(checksum)
+        self._slot_size = self._key_size + self.id_size
+        self._resize(self.initial_slots)
+
+    def _key(self, checksum):
+        '''Return table key for checksum, or None if it doesn't fit.'''
+        if self._hex:
+            try:
+                key = binascii.unhexlify(checksum)
+            except TypeError:
+                return None
+            if binascii.hexlify(key) != checksum:
+                return None
+        else:
+            key = checksum
+        if len(key) != self._key_size:
+            return None
+        return key
+
+    def _checksum(self, key):
+        if self._hex:
+            return binascii.hexlify(key)
+        return key
+
+    def _resize(self, num_slots):
+        old = self._table, self._used, self._num_slots
+        self._num_slots = num_slots
+        self._table = bytearray(num_slots * self._slot_size)
+        self._used = bytearray(num_slots)
+        for key, chunkid in self._slots(*old):
+            self._insert(key, chunkid)
+
+    def _insert(self, key, chunkid):
+        mask = self._num_slots - 1
+        i = hash(key) & mask
+        while self._used[i]:
+            i = (i + 1) & mask
+        self._used[i] = 1
+        offset = i * self._slot_size
+        self._table[offset:offset + self._key_size] = key
+        struct.pack_into(self.id_format, self._table,
+                         offset + self._key_size, chunkid)
+
+    def _slots(self, table, used, num_slots):
+        '''Generate (key, chunkid) for each used slot in a table.'''
+        for i in xrange(num_slots):
+            if used[i]:
+                offset = i * self._slot_size
+                key = str(table[offset:offset + self._key_size])
+                chunkid = struct.unpack_from(
+                    self.id_format, table, offset + self._key_size)[0]
+                yield key, chunkid
+
+    def add(self, chunkid, checksum):
+        if self._key_size is None:
+            self._setup(checksum)
+        key = self._key(checksum)
+        if key is None:
+            if checksum not in self._odd:
+                self._odd[checksum] = []
+            self._odd[checksum].append(chunkid)
+            return
+        if (self._count + 1) * 100 > self._num_slots * self.max_load_percent:
+            self._resize(self._num_slots * 2)
+        self._insert(key, chunkid)
+        self._count += 1
+
+    def get(self, checksum):
+        if self._key_size is None:
+            return []
+        key = self._key(checksum)
+        if key is None:
+            return list(self._odd.get(checksum, []))
+
+        result = []
+        mask = self._num_slots - 1
+        i = hash(key) & mask
+        while self._used[i]:
+            offset = i * self._slot_size
+            if self._table[offset:offset + self._key_size] == key:
+                result.append(struct.unpack_from(
+                    self.id_format, self._table, offset + self._key_size)[0])
+            i = (i + 1) & mask
+        return result
+
+    def __contains__(self, checksum):
+        return bool(self.get(checksum))
+
+    def __len__(self):
+        return self._count + sum(len(x) for x in self._odd.itervalues())
+
+    def __iter__(self):
+        for key, chunkid in self._slots(self._table, self._used,
+                                        self._num_slots):
+            yield chunkid, self._checksum(key)
+        for checksum in self._odd.keys():
+            for chunkid in self._odd[checksum]:
+                yield chunkid, checksum
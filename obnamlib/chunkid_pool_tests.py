@@ -0,0 +1,83 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import unittest
+
+import obnamlib
+
+
+class ChunkidPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = obnamlib.ChunkidPool()
+        self.pool.initial_slots = 4
+
+    def checksum(self, i):
+        return hashlib.md5(str(i)).hexdigest()
+
+    def test_is_empty_initially(self):
+        self.assertEqual(list(self.pool), [])
+        self.assertEqual(len(self.pool), 0)
+        self.assertFalse(self.checksum(0) in self.pool)
+        self.assertEqual(self.pool.get(self.checksum(0)), [])
+
+    def test_finds_added_chunk(self):
+        self.pool.add(1, self.checksum(1))
+        self.assertTrue(self.checksum(1) in self.pool)
+        self.assertEqual(self.pool.get(self.checksum(1)), [1])
+
+    def test_finds_many_chunks_after_growing(self):
+        for i in range(100):
+            self.pool.add(i, self.checksum(i))
+        self.assertEqual(len(self.pool), 100)
+        for i in range(100):
+            self.assertEqual(self.pool.get(self.checksum(i)), [i])
+        self.assertEqual(self.pool.get(self.checksum(100)), [])
+
+    def test_finds_all_chunks_with_same_checksum(self):
+        for i in range(10):
+            self.pool.add(i, self.checksum(i % 3))
+        self.assertEqual(sorted(self.pool.get(self.checksum(0))),
+                         [0, 3, 6, 9])
+
+    def test_handles_checksums_of_different_lengths(self):
+        for i in range(10):
+            self.pool.add(i, self.checksum(i))
+        self.pool.add(10, 'short')
+        for i in range(11, 20):
+            self.pool.add(i, self.checksum(i))
+        self.assertEqual(self.pool.get('short'), [10])
+        self.assertEqual(len(self.pool), 20)
+
+    def test_handles_checksums_that_are_not_hexadecimal(self):
+        for i in range(10):
+            self.pool.add(i, 'checksum%d' % i)
+        self.assertEqual(self.pool.get('checksum3'), [3])
+        self.assertEqual(sorted(self.pool)[3], (3, 'checksum3'))
+
+    def test_iterates_over_all_chunks(self):
+        pairs = [(i, self.checksum(i % 7)) for i in range(50)]
+        for chunkid, checksum in pairs:
+            self.pool.add(chunkid, checksum)
+        self.assertEqual(sorted(self.pool), sorted(pairs))
+
+    def test_clear_removes_everything(self):
+        for i in range(10):
+            self.pool.add(i, self.checksum(i))
+        self.pool.clear()
+        self.assertEqual(list(self.pool), [])
+        self.assertEqual(self.pool.get(self.checksum(1)), [])
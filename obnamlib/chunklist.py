@@ -51,6 +51,12 @@ class ChunkList(obnamlib.RepositoryTree):
         self.start_changes()
         self.tree.insert(self.key(chunk_id), checksum)
 
+    def add_many(self, pairs):
+        '''Add many (chunk_id, checksum) pairs at once.'''
+        tracing.trace('adding %d chunks', len(pairs))
+        self.insert_sorted((self.key(chunk_id), checksum)
+                           for chunk_id, checksum in pairs)
+
     def get_checksum(self, chunk_id):
         if self.init_forest() and self.forest.trees:
             t = self.forest.trees[-1]
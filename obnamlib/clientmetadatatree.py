@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import hashlib
 import logging
 import os
@@ -24,6 +25,42 @@ import tracing
 import obnamlib
 
 
+class Hole(object):
+
+    '''A hole in a sparse file, in a list of chunk ids.
+
+    A hole reads as ``size`` zero bytes, but is not stored as a chunk.
+    ``offset`` is where the hole starts in the file, so that the map of
+    data and holes in a file can be known without reading its chunks.
+    It must be set for holes stored in a repository.
+
+    '''
+
+    def __init__(self, size, offset=None):
+        self.size = size
+        self.offset = offset
+
+    def __eq__(self, other):
+        return (isinstance(other, Hole) and self.size == other.size and
+                self.offset == other.offset)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self): # pragma: no cover
+        return 'Hole(%r, %r)' % (self.size, self.offset)
+
+    def zeroes(self, block_size=1024**2):
+        '''Generate the hole's contents, in blocks of zero bytes.'''
+        block = '\0' * min(self.size, block_size)
+        remaining = self.size
+        while remaining > 0:
+            if remaining < len(block):
+                block = block[:remaining]
+            yield block
+            remaining -= len(block)
+
+
 class ClientMetadataTree(obnamlib.RepositoryTree):
 
     '''Store per-client metadata about files.
@@ -47,6 +84,11 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
     FILE_METADATA_ENCODED = 0 # subkey value for encoded obnamlib.Metadata().
 
+    # A Hole in the list of chunks of a file is stored as this value,
+    # which is never used as a chunk id, followed by the offset and size
+    # of the hole.
+    HOLE_MARKER = obnamlib.MAX_ID
+
     # References to chunks in this generation.
     # Main key is the chunk id, subkey type is always 0, subkey is file id
     # for file that uses the chunk.
@@ -62,16 +104,42 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
     GEN_FILE_COUNT = 4      # subkey type for count of files+dirs in generation
     GEN_TOTAL_DATA = 5      # subkey type for sum of all file sizes in gen
 
+    # The generation metadata of committed generations is also kept in
+    # a file in the client directory, so that listing generations and
+    # finding the tree for a generation id does not need lookups in the
+    # trees of all generations. Each line has the id of the root node of
+    # a tree, followed by the values of the GEN_INDEX_FIELDS subkeys in
+    # that tree, or '-' for missing ones. The index is written at each
+    # commit. Trees whose root is not in the index are looked up in the
+    # usual way, so an index that is out of date is harmless.
+    GENERATION_INDEX = 'generations'
+    GENERATION_INDEX_VERSION = 'obnam generation index 1'
+    GEN_INDEX_FIELDS = [GEN_ID, GEN_STARTED, GEN_ENDED, GEN_IS_CHECKPOINT,
+                        GEN_FILE_COUNT, GEN_TOTAL_DATA]
+
+    # Index of file contents, for finding a file with the same contents
+    # as a new file. The main key is the size of the file, subkey type
+    # is always 0, subkey is a hash of the start of the file. The value
+    # is the pathname of a file that had such contents when it was put
+    # into the index. The index is not updated when files change or are
+    # removed, so users need to check that the file still matches.
+    PREFIX_CONTENTS = 3
+
     # Maximum values for the subkey type field, and the subkey field.
     # Both have a minimum value of 0.
 
     TYPE_MAX = 255
     SUBKEY_MAX = struct.pack('!Q', obnamlib.MAX_ID)
 
+    # Number of directories for which prefetch_dir keeps the metadata
+    # of their files.
+    PREFETCH_DIRS = 4
+
     def __init__(self, fs, client_dir, node_size, upload_queue_size, lru_size,
-                 repo):
+                 repo, file_id_cache_size=obnamlib.DEFAULT_FILE_ID_CACHE_SIZE):
         tracing.trace('new ClientMetadataTree, client_dir=%s' % client_dir)
         self.current_time = repo.current_time
+        self.file_ids = obnamlib.FileIdCache(file_id_cache_size)
         key_bytes = len(self.hashkey(0, self.default_file_id(''), 0, 0))
         obnamlib.RepositoryTree.__init__(self, fs, client_dir, key_bytes,
                                          node_size, upload_queue_size,
@@ -83,7 +151,13 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
     def init_caches(self):
         self.known_generations = {}
-        self.file_ids = {}
+        self.generation_index = None
+        self.file_ids.clear()
+        # (tree, file_id, index of next FILE_CHUNKS key) for the file
+        # that chunk ids were last appended to, so the next append does
+        # not need to count the keys.
+        self.chunks_end = None
+        self.prefetched = collections.OrderedDict()
 
     def default_file_id(self, filename):
         '''Return hash of filename suitable for use as main key.'''
@@ -157,23 +231,40 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         parts = struct.unpack('!BQBQ', key)
         return parts[1], parts[3]
 
+    def contents_key(self, size, prefix_hash):
+        '''Generate a key for the file contents index.'''
+        return self.hashkey(self.PREFIX_CONTENTS, self.int2bin(size),
+                            0, prefix_hash)
+
     def get_file_id(self, tree, pathname):
         '''Return id for file in a given generation.'''
 
-        if tree in self.file_ids:
-            if pathname in self.file_ids[tree]:
-                return self.file_ids[tree][pathname]
-        else:
-            self.file_ids[tree] = {}
+        file_id = self.file_ids.get(tree, pathname)
+        if file_id is not None:
+            return file_id
 
         default_file_id = self.default_file_id(pathname)
+
+        # The file usually has the same id as in another generation.
+        file_id = self.file_ids.guess(pathname)
+        if file_id is not None:
+            key = self.fskey(default_file_id, self.FILE_NAME, file_id)
+            try:
+                value = tree.lookup(key)
+            except KeyError:
+                pass
+            else:
+                if value == pathname:
+                    self.file_ids.add(tree, pathname, file_id)
+                    return file_id
+
         minkey = self.fskey(default_file_id, self.FILE_NAME, 0)
         maxkey = self.fskey(default_file_id, self.FILE_NAME, obnamlib.MAX_ID)
         for key, value in tree.lookup_range(minkey, maxkey):
             def_id, file_id = self.fs_unkey(key)
             assert def_id == default_file_id, \
                 'def=%s other=%s' % (repr(def_id), repr(default_file_id))
-            self.file_ids[tree][value] = file_id
+            self.file_ids.add(tree, value, file_id)
             if value == pathname:
                 return file_id
 
@@ -222,6 +313,71 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
                     if hasattr(self, attr):
                         self._insert_count(genid, subkey, getattr(self, attr))
         obnamlib.RepositoryTree.commit(self)
+        if self.forest:
+            self._write_generation_index()
+
+    def _generation_index_filename(self):
+        return os.path.join(self.dirname, self.GENERATION_INDEX)
+
+    def _read_generation_index(self):
+        '''Return the generation index, as a dict keyed by root node id.'''
+        if self.generation_index is None:
+            self.generation_index = {}
+            filename = self._generation_index_filename()
+            if self.fs.exists(filename):
+                data = self.fs.cat(filename)
+                try:
+                    self.generation_index = self._decode_generation_index(
+                        data)
+                except ValueError:
+                    logging.warning('Ignoring bad generation index %s' %
+                                    filename)
+        return self.generation_index
+
+    def _decode_generation_index(self, data):
+        lines = data.splitlines()
+        if not lines or lines[0] != self.GENERATION_INDEX_VERSION:
+            raise ValueError('unknown generation index version')
+        index = {}
+        for line in lines[1:]:
+            words = line.split()
+            if len(words) != len(self.GEN_INDEX_FIELDS) + 1:
+                raise ValueError('bad generation index line %s' % repr(line))
+            values = [None if word == '-' else int(word) for word in words]
+            index[values[0]] = dict(zip(self.GEN_INDEX_FIELDS, values[1:]))
+        return index
+
+    def _write_generation_index(self):
+        tracing.trace('writing generation index')
+        index = {}
+        lines = [self.GENERATION_INDEX_VERSION]
+        for t in self.forest.trees:
+            entry = dict((what, self._lookup_gen_value(t, what))
+                         for what in self.GEN_INDEX_FIELDS)
+            index[t.root.id] = entry
+            values = [t.root.id] + [entry[what]
+                                    for what in self.GEN_INDEX_FIELDS]
+            lines.append(' '.join('-' if value is None else str(value)
+                                  for value in values))
+        self.fs.overwrite_file(self._generation_index_filename(),
+                               '\n'.join(lines) + '\n')
+        self.generation_index = index
+
+    def _lookup_gen_value(self, tree, what):
+        '''Look up a generation metadata value, or return None.
+
+        Committed trees are looked up in the generation index first.
+
+        '''
+
+        if tree is not self.tree:
+            entry = self._read_generation_index().get(tree.root.id)
+            if entry is not None:
+                return entry[what]
+        try:
+            return self._lookup_int(tree, self.genkey(what))
+        except KeyError:
+            return None
 
     def init_forest(self, *args, **kwargs):
         self.init_caches()
@@ -234,11 +390,12 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
     def find_generation(self, genid):
 
         def fill_cache():
-            key = self.genkey(self.GEN_ID)
             for t in self.forest.trees:
-                t_genid = self._lookup_int(t, key)
+                t_genid = self._lookup_gen_value(t, self.GEN_ID)
+                if t_genid is None:
+                    raise KeyError('Generation id missing from tree')
+                self.known_generations[t_genid] = t
                 if t_genid == genid:
-                    self.known_generations[genid] = t
                     return t
 
         if self.forest:
@@ -253,7 +410,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         if self.forest:
             genids = []
             for t in self.forest.trees:
-                genid = self._get_generation_id_or_None(t)
+                genid = self._lookup_gen_value(t, self.GEN_ID)
                 if genid is not None:
                     genids.append(genid)
             return genids
@@ -278,11 +435,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
     def get_is_checkpoint(self, genid):
         tree = self.find_generation(genid)
-        key = self.genkey(self.GEN_IS_CHECKPOINT)
-        try:
-            return self._lookup_int(tree, key)
-        except KeyError:
-            return 0
+        return self._lookup_gen_value(tree, self.GEN_IS_CHECKPOINT) or 0
 
     def remove_generation(self, genid):
         tracing.trace('genid=%s', genid)
@@ -290,6 +443,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         if tree == self.tree:
             self.tree = None
         self.forest.remove_tree(tree)
+        del self.known_generations[genid]
 
     def get_generation_id(self, tree):
         return self._lookup_int(tree, self.genkey(self.GEN_ID))
@@ -301,10 +455,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
             return None
 
     def _lookup_time(self, tree, what):
-        try:
-            return self._lookup_int(tree, self.genkey(what))
-        except KeyError:
-            return None
+        return self._lookup_gen_value(tree, what)
 
     def get_generation_times(self, genid):
         tree = self.find_generation(genid)
@@ -316,11 +467,7 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
     def _lookup_count(self, genid, count_type):
         tree = self.find_generation(genid)
-        key = self.genkey(count_type)
-        try:
-            return self._lookup_int(tree, key)
-        except KeyError:
-            return None
+        return self._lookup_gen_value(tree, count_type)
 
     def _insert_count(self, genid, count_type, count):
         tree = self.find_generation(genid)
@@ -368,8 +515,58 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
                 self.tree.insert(key, basename)
                 tracing.trace('added to parent')
 
+    def prefetch_dir(self, genid, dirname):
+        '''Read the metadata of all files in a directory at once.
+
+        Later calls to get_metadata for the files are answered from
+        memory, without looking up their file ids and metadata one
+        by one. Metadata is kept for the PREFETCH_DIRS directories
+        that were prefetched last.
+
+        '''
+
+        tree = self.find_generation(genid)
+        if (tree, dirname) in self.prefetched:
+            return
+
+        batch = {}
+        try:
+            dir_id = self.get_file_id(tree, dirname)
+        except KeyError:
+            pass
+        else:
+            minkey = self.fskey(dir_id, self.DIR_CONTENTS, 0)
+            maxkey = self.fskey(dir_id, self.DIR_CONTENTS, self.SUBKEY_MAX)
+            children = []
+            for key, basename in tree.lookup_range(minkey, maxkey):
+                parent_id, file_id = self.fs_unkey(key)
+                children.append((file_id, basename))
+
+            # Look up the metadata in key order, so that consecutive
+            # lookups mostly hit the same, already cached, B-tree nodes.
+            children.sort()
+            for file_id, basename in children:
+                pathname = os.path.join(dirname, basename)
+                self.file_ids.add(tree, pathname, file_id)
+                key = self.fskey(file_id, self.FILE_METADATA,
+                                 self.FILE_METADATA_ENCODED)
+                try:
+                    batch[pathname] = tree.lookup(key)
+                except KeyError: # pragma: no cover
+                    pass
+
+        self.prefetched[(tree, dirname)] = batch
+        while len(self.prefetched) > self.PREFETCH_DIRS:
+            self.prefetched.popitem(last=False)
+
+    def _prefetched_batch(self, tree, filename):
+        return self.prefetched.get((tree, os.path.dirname(filename)))
+
     def get_metadata(self, genid, filename):
         tree = self.find_generation(genid)
+        batch = self._prefetched_batch(tree, filename)
+        if batch is not None and filename in batch:
+            return batch[filename]
         file_id = self.get_file_id(tree, filename)
         key = self.fskey(file_id, self.FILE_METADATA,
                          self.FILE_METADATA_ENCODED)
@@ -386,12 +583,17 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
                           self.FILE_METADATA_ENCODED)
         self.tree.insert(key2, encoded_metadata)
 
+        batch = self._prefetched_batch(self.tree, filename)
+        if batch is not None:
+            batch[filename] = encoded_metadata
+
     def remove(self, filename):
         tracing.trace('filename=%s', filename)
 
         file_id = self.get_file_id(self.tree, filename)
         genid = self.get_generation_id(self.tree)
         self.file_count -= 1
+        self.chunks_end = None
 
         try:
             encoded_metadata = self.get_metadata(genid, filename)
@@ -410,6 +612,8 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
         # Remove chunk refs.
         for chunkid in self.get_file_chunks(genid, filename):
+            if isinstance(chunkid, Hole):
+                continue
             key = self.chunk_key(chunkid, file_id)
             self.tree.remove_range(key, key)
 
@@ -422,6 +626,10 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         default_file_id = self.default_file_id(filename)
         key = self.fskey(default_file_id, self.FILE_NAME, file_id)
         self.tree.remove_range(key, key)
+        self.file_ids.forget(self.tree, filename)
+        batch = self._prefetched_batch(self.tree, filename)
+        if batch is not None:
+            batch.pop(filename, None)
 
         # Also remove from parent's contents.
         parent = os.path.dirname(filename)
@@ -456,7 +664,28 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         chunkids = []
         for key, value in pairs:
             chunkids.extend(self._decode_chunks(value))
-        return chunkids
+        return self._find_holes(chunkids)
+
+    def _flatten_holes(self, chunkids):
+        result = []
+        for chunkid in chunkids:
+            if isinstance(chunkid, Hole):
+                result.extend([self.HOLE_MARKER, chunkid.offset, chunkid.size])
+            else:
+                result.append(chunkid)
+        return result
+
+    def _find_holes(self, encoded_ids):
+        result = []
+        i = 0
+        while i < len(encoded_ids):
+            if encoded_ids[i] == self.HOLE_MARKER:
+                result.append(Hole(encoded_ids[i+2], offset=encoded_ids[i+1]))
+                i += 3
+            else:
+                result.append(encoded_ids[i])
+                i += 1
+        return result
 
     def _encode_chunks(self, chunkids):
         fmt = '!' + ('Q' * len(chunkids))
@@ -468,11 +697,6 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         fmt = '!' + ('Q' * count)
         return struct.unpack(fmt, encoded)
 
-    def _insert_chunks(self, tree, file_id, i, chunkids):
-        key = self.fskey(file_id, self.FILE_CHUNKS, i)
-        encoded = self._encode_chunks(chunkids)
-        tree.insert(key, encoded)
-
     def set_file_chunks(self, filename, chunkids):
         tracing.trace('filename=%s', filename)
         tracing.trace('chunkids=%s', repr(chunkids))
@@ -481,12 +705,16 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
         minkey = self.fskey(file_id, self.FILE_CHUNKS, 0)
         maxkey = self.fskey(file_id, self.FILE_CHUNKS, self.SUBKEY_MAX)
 
+        old_ids = []
         for key, value in self.tree.lookup_range(minkey, maxkey):
-            for chunkid in self._decode_chunks(value):
+            old_ids.extend(self._decode_chunks(value))
+        for chunkid in self._find_holes(old_ids):
+            if not isinstance(chunkid, Hole):
                 k = self.chunk_key(chunkid, file_id)
                 self.tree.remove_range(k, k)
 
         self.tree.remove_range(minkey, maxkey)
+        self.chunks_end = (self.tree, file_id, 0)
 
         self.append_file_chunks(filename, chunkids)
 
@@ -496,17 +724,47 @@ class ClientMetadataTree(obnamlib.RepositoryTree):
 
         file_id = self.set_file_id(filename)
 
-        minkey = self.fskey(file_id, self.FILE_CHUNKS, 0)
-        maxkey = self.fskey(file_id, self.FILE_CHUNKS, self.SUBKEY_MAX)
-        i = self.tree.count_range(minkey, maxkey)
-
-        while chunkids:
-            some = chunkids[:self.chunkids_per_key]
-            self._insert_chunks(self.tree, file_id, i, some)
-            for chunkid in some:
-                self.tree.insert(self.chunk_key(chunkid, file_id), '')
+        if self.chunks_end is not None and \
+           self.chunks_end[:2] == (self.tree, file_id):
+            i = self.chunks_end[2]
+        else:
+            minkey = self.fskey(file_id, self.FILE_CHUNKS, 0)
+            maxkey = self.fskey(file_id, self.FILE_CHUNKS, self.SUBKEY_MAX)
+            i = self.tree.count_range(minkey, maxkey)
+
+        pairs = [(self.chunk_key(chunkid, file_id), '')
+                 for chunkid in set(chunkids)
+                 if not isinstance(chunkid, Hole)]
+
+        # A hole takes three values, which may end up in different keys.
+        # That's OK, since get_file_chunks joins all keys before
+        # looking for holes.
+        encoded_ids = self._flatten_holes(chunkids)
+        for start in range(0, len(encoded_ids), self.chunkids_per_key):
+            some = encoded_ids[start:start + self.chunkids_per_key]
+            pairs.append((self.fskey(file_id, self.FILE_CHUNKS, i),
+                          self._encode_chunks(some)))
             i += 1
-            chunkids = chunkids[self.chunkids_per_key:]
+        self.chunks_end = (self.tree, file_id, i)
+
+        # Insert in key order, so that consecutive keys mostly go into
+        # the same, already modified, leaf node.
+        pairs.sort()
+        for key, value in pairs:
+            self.tree.insert(key, value)
+
+    def set_contents_index(self, filename, size, prefix_hash):
+        '''Remember that a file has contents of given size and prefix hash.'''
+        tracing.trace('filename=%s', filename)
+        self.tree.insert(self.contents_key(size, prefix_hash), filename)
+
+    def find_by_contents(self, genid, size, prefix_hash):
+        '''Return pathname that had given size and prefix hash, or None.'''
+        tree = self.find_generation(genid)
+        try:
+            return tree.lookup(self.contents_key(size, prefix_hash))
+        except KeyError:
+            return None
 
     def chunk_in_use(self, gen_id, chunk_id):
         '''Is a chunk used by a generation?'''
@@ -23,6 +23,22 @@ import unittest
 import obnamlib
 
 
+class HoleTests(unittest.TestCase):
+
+    def test_generates_zeroes(self):
+        hole = obnamlib.Hole(10)
+        self.assertEqual(''.join(hole.zeroes(block_size=3)), '\0' * 10)
+
+    def test_generates_nothing_for_empty_hole(self):
+        self.assertEqual(list(obnamlib.Hole(0).zeroes()), [])
+
+    def test_compares_by_size_and_offset(self):
+        self.assertEqual(obnamlib.Hole(1, 2), obnamlib.Hole(1, 2))
+        self.assertNotEqual(obnamlib.Hole(1, 2), obnamlib.Hole(2, 2))
+        self.assertNotEqual(obnamlib.Hole(1, 2), obnamlib.Hole(1, 3))
+        self.assertNotEqual(obnamlib.Hole(1), 1)
+
+
 class ClientMetadataTreeTests(unittest.TestCase):
 
     def current_time(self):
@@ -31,18 +47,21 @@ class ClientMetadataTreeTests(unittest.TestCase):
     def setUp(self):
         self.now = None
         self.tempdir = tempfile.mkdtemp()
-        fs = obnamlib.LocalFS(self.tempdir)
+        self.fs = obnamlib.LocalFS(self.tempdir)
         self.hooks = obnamlib.HookManager()
         self.hooks.new('repository-toplevel-init')
-        self.client = obnamlib.ClientMetadataTree(fs, 'clientid',
-                                   obnamlib.DEFAULT_NODE_SIZE,
-                                   obnamlib.DEFAULT_UPLOAD_QUEUE_SIZE,
-                                   obnamlib.DEFAULT_LRU_SIZE, self)
+        self.client = self.new_client()
         self.file_size = 123
         self.file_metadata = obnamlib.Metadata(st_mode=stat.S_IFREG | 0666,
                                                st_size=self.file_size)
         self.file_encoded = obnamlib.encode_metadata(self.file_metadata)
 
+    def new_client(self):
+        return obnamlib.ClientMetadataTree(self.fs, 'clientid',
+                                   obnamlib.DEFAULT_NODE_SIZE,
+                                   obnamlib.DEFAULT_UPLOAD_QUEUE_SIZE,
+                                   obnamlib.DEFAULT_LRU_SIZE, self)
+
     def tearDown(self):
         shutil.rmtree(self.tempdir)
 
@@ -256,6 +275,52 @@ class ClientMetadataTreeTests(unittest.TestCase):
         self.client.find_generation(genid)
         self.assertEqual(self.client.find_generation(genid), tree)
 
+    def test_uses_generation_index_after_commit(self):
+        self.now = 1
+        self.client.start_generation()
+        genid = self.client.get_generation_id(self.client.tree)
+        self.client.set_current_generation_is_checkpoint(True)
+        self.now = 2
+        self.client.commit()
+
+        def fail(tree, key):
+            raise AssertionError('tree lookup not expected')
+
+        other = self.new_client()
+        other.init_forest()
+        other._lookup_int = fail
+        self.assertEqual(other.list_generations(), [genid])
+        self.assertEqual(other.get_generation_times(genid), (1, 2))
+        self.assert_(other.get_is_checkpoint(genid))
+        self.assertEqual(other.get_generation_file_count(genid), 0)
+
+    def test_ignores_out_of_date_generation_index(self):
+        self.client.start_generation()
+        genid1 = self.client.get_generation_id(self.client.tree)
+        self.client.commit()
+        filename = 'clientid/' + self.client.GENERATION_INDEX
+        old_index = self.fs.cat(filename)
+        self.client.start_generation()
+        genid2 = self.client.get_generation_id(self.client.tree)
+        self.client.commit()
+        self.fs.overwrite_file(filename, old_index)
+
+        other = self.new_client()
+        other.init_forest()
+        self.assertEqual(other.list_generations(), [genid1, genid2])
+        self.assertNotEqual(other.find_generation(genid2), None)
+
+    def test_ignores_bad_generation_index(self):
+        self.client.start_generation()
+        genid = self.client.get_generation_id(self.client.tree)
+        self.client.commit()
+        self.fs.overwrite_file('clientid/' + self.client.GENERATION_INDEX,
+                               'garbage\n')
+
+        other = self.new_client()
+        other.init_forest()
+        self.assertEqual(other.list_generations(), [genid])
+
     def test_find_generation_raises_keyerror_for_empty_forest(self):
         self.client.init_forest()
         self.assertRaises(KeyError, self.client.find_generation, 0)
@@ -330,6 +395,34 @@ class ClientMetadataTreeFileOpsTests(unittest.TestCase):
         self.assertRaises(KeyError, self.client.get_metadata,
                           self.clientid, '/foo')
 
+    def test_prefetch_dir_returns_same_metadata(self):
+        self.client.create('/foo', self.dir_encoded)
+        self.client.create('/foo/bar', self.file_encoded)
+        self.client.prefetch_dir(self.clientid, '/foo')
+        self.assertEqual(self.client.get_metadata(self.clientid, '/foo/bar'),
+                         self.file_encoded)
+
+    def test_prefetch_dir_of_nonexistent_dir_works(self):
+        self.client.prefetch_dir(self.clientid, '/foo')
+        self.assertRaises(KeyError, self.client.get_metadata,
+                          self.clientid, '/foo/bar')
+
+    def test_prefetched_metadata_is_updated_by_set_metadata(self):
+        self.client.create('/foo', self.dir_encoded)
+        self.client.create('/foo/bar', self.file_encoded)
+        self.client.prefetch_dir(self.clientid, '/foo')
+        self.client.set_metadata('/foo/bar', self.dir_encoded)
+        self.assertEqual(self.client.get_metadata(self.clientid, '/foo/bar'),
+                         self.dir_encoded)
+
+    def test_prefetched_metadata_is_forgotten_by_remove(self):
+        self.client.create('/foo', self.dir_encoded)
+        self.client.create('/foo/bar', self.file_encoded)
+        self.client.prefetch_dir(self.clientid, '/foo')
+        self.client.remove('/foo/bar')
+        self.assertRaises(KeyError, self.client.get_metadata,
+                          self.clientid, '/foo/bar')
+
     def test_creates_directory_and_files_and_subdirs(self):
         self.client.create('/foo', self.dir_encoded)
         self.client.create('/foo/foobar', self.file_encoded)
@@ -385,6 +478,46 @@ class ClientMetadataTreeFileOpsTests(unittest.TestCase):
         self.assertEqual(self.client.get_file_chunks(self.clientid, '/foo'),
                          [1, 2, 3, 4, 5, 6])
 
+    def test_appends_many_groups_without_counting_keys(self):
+        self.client.chunkids_per_key = 2
+        self.client.set_file_chunks('/foo', [])
+
+        def fail(minkey, maxkey):
+            raise AssertionError('count_range not expected')
+
+        self.client.tree.count_range = fail
+        for i in range(0, 12, 3):
+            self.client.append_file_chunks('/foo', [i, i + 1, i + 2])
+        self.assertEqual(self.client.get_file_chunks(self.clientid, '/foo'),
+                         range(12))
+
+    def test_appends_file_chunks_to_two_files_in_turn(self):
+        self.client.chunkids_per_key = 2
+        self.client.set_file_chunks('/foo', [1, 2, 3])
+        self.client.set_file_chunks('/bar', [10])
+        self.client.append_file_chunks('/foo', [4])
+        self.client.append_file_chunks('/bar', [11, 12])
+        self.client.append_file_chunks('/foo', [5])
+        self.assertEqual(self.client.get_file_chunks(self.clientid, '/foo'),
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(self.client.get_file_chunks(self.clientid, '/bar'),
+                         [10, 11, 12])
+
+    def test_appends_file_chunks_after_removing_file(self):
+        self.client.set_file_chunks('/foo', [1, 2])
+        self.client.remove('/foo')
+        self.client.append_file_chunks('/foo', [3])
+        self.assertEqual(self.client.get_file_chunks(self.clientid, '/foo'),
+                         [3])
+
+    def test_appends_same_chunk_twice(self):
+        self.client.append_file_chunks('/foo', [1, 1, 2])
+        self.assertEqual(self.client.get_file_chunks(self.clientid, '/foo'),
+                         [1, 1, 2])
+        self.assertEqual(
+            sorted(self.client.list_chunks_in_generation(self.clientid)),
+            [1, 2])
+
     def test_generation_has_no_chunk_refs_initially(self):
         minkey = self.client.chunk_key(0, 0)
         maxkey = self.client.chunk_key(obnamlib.MAX_ID, obnamlib.MAX_ID)
@@ -426,6 +559,32 @@ class ClientMetadataTreeFileOpsTests(unittest.TestCase):
         self.assertEqual(list(self.client.tree.lookup_range(minkey, maxkey)),
                          [(self.client.chunk_key(1, file_id), '')])
 
+    def test_stores_holes_in_chunk_list(self):
+        chunkids = [1, obnamlib.Hole(12345, 100), 2,
+                    obnamlib.Hole(6, 12545)]
+        self.client.set_file_chunks('/foo', chunkids)
+        self.assertEqual(self.client.get_file_chunks(self.clientid, '/foo'),
+                         chunkids)
+
+    def test_holes_are_not_chunk_refs(self):
+        self.client.set_file_chunks('/foo', [obnamlib.Hole(12345, 0)])
+        self.assertEqual(
+            self.client.list_chunks_in_generation(self.clientid), [])
+
+    def test_finds_nothing_by_contents_initially(self):
+        self.assertEqual(
+            self.client.find_by_contents(self.clientid, 123, 'prefix'),
+            None)
+
+    def test_finds_file_by_contents(self):
+        self.client.set_contents_index('/foo', 123, 'prefix')
+        self.assertEqual(
+            self.client.find_by_contents(self.clientid, 123, 'prefix'),
+            '/foo')
+        self.assertEqual(
+            self.client.find_by_contents(self.clientid, 124, 'prefix'),
+            None)
+
     def test_remove_removes_chunk_refs(self):
         self.client.set_file_chunks('/foo', [1, 2])
         self.client.remove('/foo')
@@ -0,0 +1,94 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import collections
+
+
+class FileIdCache(object):
+
+    '''A size-bounded cache of file ids, for ClientMetadataTree.
+
+    The cache maps pathnames to file ids. Files usually keep their
+    file id from one generation to the next, so there is one entry per
+    pathname, not one per pathname per generation. Each entry lists
+    the generation trees the file id is known to be right for.
+    ``guess`` returns the id from another tree, and the caller can
+    check it and then ``add`` it for the new tree.
+
+    At most ``max_entries`` pathnames are kept. After that, the least
+    recently used ones are dropped.
+
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, tree, pathname):
+        '''Return file id of pathname in tree, or None if not known.'''
+        entry = self._entries.get(pathname)
+        if entry is not None and tree in entry[1]:
+            self.hits += 1
+            # Move entry to the most recently used end.
+            del self._entries[pathname]
+            self._entries[pathname] = entry
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def guess(self, pathname):
+        '''Return file id of pathname in some other tree, or None.'''
+        entry = self._entries.get(pathname)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def add(self, tree, pathname, file_id):
+        '''Remember the file id of pathname in tree.'''
+        entry = self._entries.pop(pathname, None)
+        if entry is None or entry[0] != file_id:
+            entry = (file_id, (tree,))
+        elif tree not in entry[1]:
+            entry = (file_id, entry[1] + (tree,))
+        self._entries[pathname] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def forget(self, tree, pathname):
+        '''Forget the file id of pathname in tree.'''
+        entry = self._entries.get(pathname)
+        if entry is not None and tree in entry[1]:
+            trees = tuple(t for t in entry[1] if t is not tree)
+            if trees:
+                self._entries[pathname] = (entry[0], trees)
+            else:
+                del self._entries[pathname]
+
+    def clear(self):
+        '''Forget everything. The counters are kept.'''
+        self._entries.clear()
+
+    def report(self):
+        '''Return a one-line summary of cache size and use.'''
+        return ('file id cache: %d entries (max %d), %d hits, %d misses' %
+                (len(self._entries), self.max_entries, self.hits,
+                 self.misses))
@@ -0,0 +1,87 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import obnamlib
+
+
+class FileIdCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = obnamlib.FileIdCache(3)
+        self.tree1 = object()
+        self.tree2 = object()
+
+    def test_is_empty_initially(self):
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.get(self.tree1, '/foo'), None)
+        self.assertEqual(self.cache.guess('/foo'), None)
+
+    def test_finds_added_file_id(self):
+        self.cache.add(self.tree1, '/foo', 'id')
+        self.assertEqual(self.cache.get(self.tree1, '/foo'), 'id')
+
+    def test_does_not_find_file_id_in_other_tree(self):
+        self.cache.add(self.tree1, '/foo', 'id')
+        self.assertEqual(self.cache.get(self.tree2, '/foo'), None)
+        self.assertEqual(self.cache.guess('/foo'), 'id')
+
+    def test_shares_entry_between_trees(self):
+        self.cache.add(self.tree1, '/foo', 'id')
+        self.cache.add(self.tree2, '/foo', 'id')
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get(self.tree1, '/foo'), 'id')
+        self.assertEqual(self.cache.get(self.tree2, '/foo'), 'id')
+
+    def test_replaces_entry_with_different_file_id(self):
+        self.cache.add(self.tree1, '/foo', 'id1')
+        self.cache.add(self.tree2, '/foo', 'id2')
+        self.assertEqual(self.cache.get(self.tree1, '/foo'), None)
+        self.assertEqual(self.cache.get(self.tree2, '/foo'), 'id2')
+
+    def test_drops_least_recently_used_entries(self):
+        for name in ['/a', '/b', '/c']:
+            self.cache.add(self.tree1, name, name)
+        self.cache.get(self.tree1, '/a')
+        self.cache.add(self.tree1, '/d', '/d')
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get(self.tree1, '/a'), '/a')
+        self.assertEqual(self.cache.get(self.tree1, '/b'), None)
+
+    def test_forgets_file_id_in_one_tree(self):
+        self.cache.add(self.tree1, '/foo', 'id')
+        self.cache.add(self.tree2, '/foo', 'id')
+        self.cache.forget(self.tree2, '/foo')
+        self.assertEqual(self.cache.get(self.tree1, '/foo'), 'id')
+        self.assertEqual(self.cache.get(self.tree2, '/foo'), None)
+        self.cache.forget(self.tree1, '/foo')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_counts_hits_and_misses(self):
+        self.cache.add(self.tree1, '/foo', 'id')
+        self.cache.get(self.tree1, '/foo')
+        self.cache.get(self.tree1, '/bar')
+        self.cache.get(self.tree2, '/foo')
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_clear_keeps_counters(self):
+        self.cache.add(self.tree1, '/foo', 'id')
+        self.cache.get(self.tree1, '/foo')
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.hits, 1)
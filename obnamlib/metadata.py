@@ -17,6 +17,7 @@
 import errno
 import grp
 import logging
+import operator
 import os
 import pwd
 import stat
@@ -36,6 +37,12 @@ metadata_fields = metadata_verify_fields + (
     'st_atime_nsec', 'md5',
 )
 
+_get_metadata_fields = operator.attrgetter(*metadata_fields)
+
+# The fields of metadata_fields that come from an lstat result.
+_stat_fields = tuple(x for x in metadata_fields if x.startswith('st_'))
+_get_stat_fields = operator.attrgetter(*_stat_fields)
+
 
 class Metadata(object):
 
@@ -77,11 +84,20 @@ class Metadata(object):
     The 'xattr' field optionally stores extended attributes encoded as
     a binary blob.
 
+    There are millions of these during a backup or restore, so they
+    have slots instead of a dict for their attributes, and only the
+    fields above can be set.
+
     '''
 
+    __slots__ = metadata_fields
+
     def __init__(self, **kwargs):
-        for field in metadata_fields:
-            setattr(self, field, None)
+        (self.st_mode, self.st_mtime_sec, self.st_mtime_nsec,
+         self.st_nlink, self.st_size, self.st_uid, self.groupname,
+         self.username, self.target, self.xattr, self.st_blocks,
+         self.st_dev, self.st_gid, self.st_ino, self.st_atime_sec,
+         self.st_atime_nsec, self.md5) = _no_metadata
         for field, value in kwargs.iteritems():
             setattr(self, field, value)
 
@@ -100,16 +116,63 @@ class Metadata(object):
         return 'Metadata(%s)' % fields
 
     def __cmp__(self, other):
-        for field in metadata_fields:
-            ours = getattr(self, field)
-            theirs = getattr(other, field)
-            if ours == theirs:
-                continue
-            if ours < theirs:
-                return -1
-            if ours > theirs:
-                return +1
-        return 0
+        return cmp(_get_metadata_fields(self), _get_metadata_fields(other))
+
+
+_no_metadata = (None,) * len(metadata_fields)
+
+
+class StatResult(object):
+
+    '''The result of lstat(2), as returned by LocalFS.
+
+    Like Metadata, but with the lstat fields that are not backed up,
+    and without the ones that do not come from lstat.
+
+    '''
+
+    __slots__ = ('st_dev', 'st_ino', 'st_mode', 'st_nlink', 'st_uid',
+                 'st_gid', 'st_rdev', 'st_size', 'st_blksize', 'st_blocks',
+                 'st_atime_sec', 'st_atime_nsec', 'st_mtime_sec',
+                 'st_mtime_nsec', 'st_ctime_sec', 'st_ctime_nsec')
+
+    def __init__(self, st_dev=None, st_ino=None, st_mode=None,
+                 st_nlink=None, st_uid=None, st_gid=None, st_rdev=None,
+                 st_size=None, st_blksize=None, st_blocks=None,
+                 st_atime_sec=None, st_atime_nsec=None, st_mtime_sec=None,
+                 st_mtime_nsec=None, st_ctime_sec=None, st_ctime_nsec=None):
+        self.st_dev = st_dev
+        self.st_ino = st_ino
+        self.st_mode = st_mode
+        self.st_nlink = st_nlink
+        self.st_uid = st_uid
+        self.st_gid = st_gid
+        self.st_rdev = st_rdev
+        self.st_size = st_size
+        self.st_blksize = st_blksize
+        self.st_blocks = st_blocks
+        self.st_atime_sec = st_atime_sec
+        self.st_atime_nsec = st_atime_nsec
+        self.st_mtime_sec = st_mtime_sec
+        self.st_mtime_nsec = st_mtime_nsec
+        self.st_ctime_sec = st_ctime_sec
+        self.st_ctime_nsec = st_ctime_nsec
+
+    def __eq__(self, other):
+        return (isinstance(other, StatResult) and
+                _get_stat_result_fields(self) ==
+                    _get_stat_result_fields(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self): # pragma: no cover
+        fields = ', '.join('%s=%s' % (k, getattr(self, k))
+                           for k in self.__slots__)
+        return 'StatResult(%s)' % fields
+
+
+_get_stat_result_fields = operator.attrgetter(*StatResult.__slots__)
 
 
 # Caching versions of username/groupname lookups.
@@ -178,7 +241,8 @@ def get_xattrs_as_blob(fs, filename): # pragma: no cover
              value_blob))
 
 
-def set_xattrs_from_blob(fs, filename, blob): # pragma: no cover
+def decode_xattr_blob(blob):
+    '''Return list of (name, value) pairs from get_xattrs_as_blob.'''
     sizesize = struct.calcsize('!Q')
     name_blob_size = struct.unpack('!Q', blob[:sizesize])[0]
     name_blob = blob[sizesize : sizesize + name_blob_size]
@@ -189,10 +253,16 @@ def set_xattrs_from_blob(fs, filename, blob): # pragma: no cover
     lengths_size = sizesize * len(names)
     lengths = struct.unpack(fmt, value_blob[:lengths_size])
 
+    pairs = []
     pos = lengths_size
     for i, name in enumerate(names):
-        value = value_blob[pos:pos + lengths[i]]
+        pairs.append((name, value_blob[pos:pos + lengths[i]]))
         pos += lengths[i]
+    return pairs
+
+
+def set_xattrs_from_blob(fs, filename, blob): # pragma: no cover
+    for name, value in decode_xattr_blob(blob):
         fs.lsetxattr(filename, name, value)
 
 
@@ -200,9 +270,15 @@ def read_metadata(fs, filename, st=None, getpwuid=None, getgrgid=None):
     '''Return object detailing metadata for a filesystem entry.'''
     metadata = Metadata()
     stat_result = st or fs.lstat(filename)
-    for field in metadata_fields:
-        if field.startswith('st_') and hasattr(stat_result, field):
-            setattr(metadata, field, getattr(stat_result, field))
+    try:
+        values = _get_stat_fields(stat_result)
+    except AttributeError:
+        # Not all filesystems have all fields.
+        values = tuple(getattr(stat_result, x, None) for x in _stat_fields)
+    (metadata.st_mode, metadata.st_mtime_sec, metadata.st_mtime_nsec,
+     metadata.st_nlink, metadata.st_size, metadata.st_uid,
+     metadata.st_blocks, metadata.st_dev, metadata.st_gid, metadata.st_ino,
+     metadata.st_atime_sec, metadata.st_atime_nsec) = values
 
     if stat.S_ISLNK(stat_result.st_mode):
         metadata.target = fs.readlink(filename)
@@ -282,101 +358,91 @@ metadata_format = struct.Struct('!Q' +  # flags
                                 'Q' +   # len of xattr
                                 '')
 
-def encode_metadata(metadata):
+# The order of the fields in encoded metadata, and the bit for each
+# field in the flags that say which fields are present. The first
+# fields are integers, the rest are strings.
+_encoded_fields = ('st_mode', 'st_mtime_sec', 'st_mtime_nsec',
+                   'st_atime_sec', 'st_atime_nsec', 'st_nlink', 'st_size',
+                   'st_uid', 'st_gid', 'st_dev', 'st_ino', 'st_blocks',
+                   'groupname', 'username', 'target', 'md5', 'xattr')
+_num_encoded_integers = 12
+_encoded_bits = tuple(1 << metadata_fields.index(field)
+                      for field in _encoded_fields)
+_all_encoded_bits = sum(_encoded_bits)
+_get_encoded_values = operator.attrgetter(*_encoded_fields)
+
+
+def _py_encode_metadata_values(values):
     flags = 0
-    for i, name in enumerate(obnamlib.metadata_fields):
-        if getattr(metadata, name) is not None:
-            flags |= (1 << i)
+    for bit, value in zip(_encoded_bits, values):
+        if value is not None:
+            flags |= bit
+    integers = [value or 0 for value in values[:_num_encoded_integers]]
+    strings = [value or '' for value in values[_num_encoded_integers:]]
+    packed = metadata_format.pack(flags, *(integers +
+                                           [len(s) for s in strings]))
+    return packed + ''.join(strings)
+
+
+def _py_decode_metadata_values(encoded, wanted=_all_encoded_bits):
+    items = metadata_format.unpack_from(encoded)
+    flags = items[0]
+    offset = metadata_format.size
+    values = []
+    for i, bit in enumerate(_encoded_bits):
+        item = items[i + 1]
+        if not flags & bit or not wanted & bit:
+            values.append(None)
+        elif i < _num_encoded_integers:
+            values.append(item)
+        else:
+            values.append(encoded[offset:offset + item])
+        if i >= _num_encoded_integers and flags & bit:
+            offset += item
+    return tuple(values)
 
+
+# Use the C versions from the _obnam extension, if it is there.
+try:
+    _encode_metadata_values = obnamlib._obnam.encode_metadata
+    _decode_metadata_values = obnamlib._obnam.decode_metadata
+except Exception:
+    _encode_metadata_values = _py_encode_metadata_values
+    _decode_metadata_values = _py_decode_metadata_values
+
+
+def encode_metadata(metadata):
+    values = _get_encoded_values(metadata)
     try:
-        packed = metadata_format.pack(flags,
-                                      metadata.st_mode or 0,
-                                      metadata.st_mtime_sec or 0,
-                                      metadata.st_mtime_nsec or 0,
-                                      metadata.st_atime_sec or 0,
-                                      metadata.st_atime_nsec or 0,
-                                      metadata.st_nlink or 0,
-                                      metadata.st_size or 0,
-                                      metadata.st_uid or 0,
-                                      metadata.st_gid or 0,
-                                      metadata.st_dev or 0,
-                                      metadata.st_ino or 0,
-                                      metadata.st_blocks or 0,
-                                      len(metadata.groupname or ''),
-                                      len(metadata.username or ''),
-                                      len(metadata.target or ''),
-                                      len(metadata.md5 or ''),
-                                      len(metadata.xattr or ''))
+        return _encode_metadata_values(values)
     except TypeError, e: # pragma: no cover
         logging.error('ERROR: Packing error due to %s' % str(e))
-        logging.error('ERROR: st_mode=%s' % repr(metadata.st_mode))
-        logging.error('ERROR: st_mtime_sec=%s' % repr(metadata.st_mtime_sec))
-        logging.error('ERROR: st_mtime_nsec=%s' % repr(metadata.st_mtime_nsec))
-        logging.error('ERROR: st_atime_sec=%s' % repr(metadata.st_atime_sec))
-        logging.error('ERROR: st_atime_nsec=%s' % repr(metadata.st_atime_nsec))
-        logging.error('ERROR: st_nlink=%s' % repr(metadata.st_nlink))
-        logging.error('ERROR: st_size=%s' % repr(metadata.st_size))
-        logging.error('ERROR: st_uid=%s' % repr(metadata.st_uid))
-        logging.error('ERROR: st_gid=%s' % repr(metadata.st_gid))
-        logging.error('ERROR: st_dev=%s' % repr(metadata.st_dev))
-        logging.error('ERROR: st_ino=%s' % repr(metadata.st_ino))
-        logging.error('ERROR: st_blocks=%s' % repr(metadata.st_blocks))
-        logging.error('ERROR: groupname=%s' % repr(metadata.groupname))
-        logging.error('ERROR: username=%s' % repr(metadata.username))
-        logging.error('ERROR: target=%s' % repr(metadata.target))
-        logging.error('ERROR: md5=%s' % repr(metadata.md5))
-        logging.error('ERROR: xattr=%s' % repr(metadata.xattr))
+        for field, value in zip(_encoded_fields, values):
+            logging.error('ERROR: %s=%s' % (field, repr(value)))
         raise
-    return (packed +
-             (metadata.groupname or '') +
-             (metadata.username or '') +
-             (metadata.target or '') +
-             (metadata.md5 or '') +
-             (metadata.xattr or ''))
 
 
-def decode_metadata(encoded):
+def decode_metadata(encoded, fields=None):
+    '''Decode metadata encoded with encode_metadata.
 
-    items = metadata_format.unpack_from(encoded)
-    flags = items[0]
-    pos = [1, metadata_format.size]
-    metadata = obnamlib.Metadata()
-
-    def is_present(field):
-        i = obnamlib.metadata_fields.index(field)
-        return (flags & (1 << i)) != 0
-
-    def decode(field, num_items, inc_offset, getvalue):
-        if is_present(field):
-            value = getvalue(pos[0], pos[1])
-            setattr(metadata, field, value)
-            if inc_offset:
-                pos[1] += len(value)
-        pos[0] += num_items
-
-    def decode_integer(field):
-        decode(field, 1, False, lambda i, o: items[i])
-
-    def decode_string(field):
-        decode(field, 1, True, lambda i, o: encoded[o:o + items[i]])
-
-    decode_integer('st_mode')
-    decode_integer('st_mtime_sec')
-    decode_integer('st_mtime_nsec')
-    decode_integer('st_atime_sec')
-    decode_integer('st_atime_nsec')
-    decode_integer('st_nlink')
-    decode_integer('st_size')
-    decode_integer('st_uid')
-    decode_integer('st_gid')
-    decode_integer('st_dev')
-    decode_integer('st_ino')
-    decode_integer('st_blocks')
-    decode_string('groupname')
-    decode_string('username')
-    decode_string('target')
-    decode_string('md5')
-    decode_string('xattr')
+    If fields is given, only the fields named in it are decoded, and
+    the others are left as None. This is quicker, if the caller only
+    needs a few fields.
 
-    return metadata
+    '''
 
+    if fields is None:
+        values = _decode_metadata_values(encoded)
+    else:
+        wanted = 0
+        for field in fields:
+            wanted |= 1 << metadata_fields.index(field)
+        values = _decode_metadata_values(encoded, wanted)
+    metadata = Metadata.__new__(Metadata)
+    (metadata.st_mode, metadata.st_mtime_sec, metadata.st_mtime_nsec,
+     metadata.st_atime_sec, metadata.st_atime_nsec, metadata.st_nlink,
+     metadata.st_size, metadata.st_uid, metadata.st_gid, metadata.st_dev,
+     metadata.st_ino, metadata.st_blocks, metadata.groupname,
+     metadata.username, metadata.target, metadata.md5,
+     metadata.xattr) = values
+    return metadata
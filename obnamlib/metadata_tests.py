@@ -125,6 +125,24 @@ class MetadataTests(unittest.TestCase):
         m2 = obnamlib.Metadata(st_size=2)
         self.assert_(m2 > m1)
 
+    def test_rejects_unknown_fields(self):
+        self.assertRaises(AttributeError, obnamlib.Metadata, st_foo=1)
+
+
+class StatResultTests(unittest.TestCase):
+
+    def test_sets_fields_in_lstat_order(self):
+        st = obnamlib.StatResult(*range(16))
+        self.assertEqual(st.st_dev, 0)
+        self.assertEqual(st.st_mode, 2)
+        self.assertEqual(st.st_ctime_nsec, 15)
+
+    def test_compares_all_fields(self):
+        self.assertEqual(obnamlib.StatResult(st_size=1),
+                         obnamlib.StatResult(st_size=1))
+        self.assertNotEqual(obnamlib.StatResult(st_size=1),
+                            obnamlib.StatResult(st_size=1, st_ctime_sec=2))
+
 
 class ReadMetadataTests(unittest.TestCase):
 
@@ -155,6 +173,16 @@ class ReadMetadataTests(unittest.TestCase):
                              getattr(self.fakefs, field),
                              field)
 
+    def test_reads_stat_result_with_missing_fields(self):
+        del self.fakefs.st_atime_nsec
+        del self.fakefs.st_mtime_nsec
+        metadata = obnamlib.read_metadata(self.fakefs, 'foo',
+                                          getpwuid=self.fakefs.getpwuid,
+                                          getgrgid=self.fakefs.getgrgid)
+        self.assertEqual(metadata.st_mtime_sec, 7)
+        self.assertEqual(metadata.st_mtime_nsec, None)
+        self.assertEqual(metadata.st_atime_nsec, None)
+
     def test_reads_username_as_None_if_lookup_fails(self):
         metadata = obnamlib.read_metadata(self.fakefs, 'foo',
                                           getpwuid=self.fakefs.fail_getpwuid,
@@ -304,3 +332,34 @@ class MetadataCodingTests(unittest.TestCase):
         decoded = obnamlib.decode_metadata(encoded)
         self.equal(metadata, decoded)
 
+
+    def test_round_trip_for_negative_times(self):
+        metadata = obnamlib.metadata.Metadata(st_mtime_sec=-1,
+                                              st_atime_sec=-2**63)
+        encoded = obnamlib.encode_metadata(metadata)
+        decoded = obnamlib.decode_metadata(encoded)
+        self.equal(metadata, decoded)
+
+    def test_decodes_only_wanted_fields(self):
+        metadata = obnamlib.metadata.Metadata(st_mode=1, st_size=2,
+                                              username='user', md5='sum')
+        encoded = obnamlib.encode_metadata(metadata)
+        decoded = obnamlib.decode_metadata(encoded, ['st_size', 'md5'])
+        self.assertEqual(decoded.st_size, 2)
+        self.assertEqual(decoded.md5, 'sum')
+        self.assertEqual(decoded.st_mode, None)
+        self.assertEqual(decoded.username, None)
+
+    def test_python_codec_agrees_with_extension(self):
+        if not hasattr(obnamlib._obnam, 'decode_metadata'):
+            return
+        m = obnamlib.metadata
+        values = (0100644, -5, 999999999, 3, None, 1, 2**40, 1000, None,
+                  2**64 - 1, 12345, 8, 'group', None, '', 'x' * 16,
+                  '\0\1\2')
+        encoded = m._py_encode_metadata_values(values)
+        self.assertEqual(obnamlib._obnam.encode_metadata(values), encoded)
+        self.assertEqual(m._py_decode_metadata_values(encoded), values)
+        self.assertEqual(obnamlib._obnam.decode_metadata(encoded), values)
+        self.assertEqual(obnamlib._obnam.decode_metadata(encoded, 1 << 6),
+                         m._py_decode_metadata_values(encoded, 1 << 6))
@@ -0,0 +1,410 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import errno
+import os
+import random
+import struct
+import threading
+import tracing
+
+import obnamlib
+
+
+class PackStore(object):
+
+    '''Store chunks by appending them to large pack files.
+
+    Writing each chunk into a file of its own results in huge numbers
+    of tiny files, when backing up many small files. Instead, chunks
+    are collected in memory, and written out as one pack file once
+    there is ``pack_size`` bytes of them.
+
+    A pack has a random 32-bit number. Its chunks are numbered
+    from zero, in the order they were added, and that number is
+    the chunk's slot in the pack. The chunk id of a packed chunk
+    encodes the pack number and slot, with ``tag`` in the highest
+    16 bits, so that packed chunks can be told apart from chunks in
+    files of their own. Ids with that tag must not be used for other
+    chunks.
+
+    Each pack has an index file, which gives the offset and length of
+    each slot in the pack's data file, so that a chunk can be read
+    with a ranged read. The index also says which version of the data
+    file is current: when chunks are removed, and most of a pack is
+    no longer used, the remaining chunks are copied to a new version
+    of the data file, keeping their slots and thus chunk ids.
+
+    Each chunk is passed through ``encode`` on its own, before it is
+    put into a pack, and through ``decode`` when read back, so that
+    chunks may be compressed and encrypted. The index is encoded as a
+    whole.
+
+    Chunks are written when a pack gets full, and pending removals
+    are done, by ``flush``. Chunks that are put or removed meanwhile
+    are still visible via ``get``, ``exists``, and ``list_chunk_ids``.
+    A full pack is written without holding the store's lock, so that
+    other threads can meanwhile read chunks and fill the next pack.
+
+    '''
+
+    tag = 0xfffe
+    max_slots = 2**16
+    max_pack_number = 2**32 - 1
+
+    header_format = '!QQ'
+    slot_format = '!QQ'
+    removed_offset = obnamlib.MAX_ID
+
+    def __init__(self, fs, dirname, pack_size, encode=None, decode=None):
+        self.fs = fs
+        self.dirname = dirname
+        self.pack_size = pack_size
+        self.encode = encode or (lambda data: data)
+        self.decode = decode or (lambda data: data)
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._start_lock = threading.Lock()
+        self._indexes = {}
+        self._writing = {}
+        self._removed = {}
+        self._pending_number = None
+        self._pending = []
+        self._pending_bytes = 0
+
+    @classmethod
+    def is_packed(klass, chunk_id):
+        '''Does a chunk id refer to a chunk in a pack?'''
+        return chunk_id >> 48 == klass.tag
+
+    def _chunk_id(self, number, slot):
+        return (self.tag << 48) | (number << 16) | slot
+
+    def _split_chunk_id(self, chunk_id):
+        return (chunk_id >> 16) & self.max_pack_number, chunk_id & 0xffff
+
+    def _index_filename(self, number):
+        return os.path.join(self.dirname, '%08x.idx' % number)
+
+    def _data_filename(self, number, version):
+        return os.path.join(self.dirname, '%08x.%d' % (number, version))
+
+    def _encode_index(self, version, slots):
+        parts = [struct.pack(self.header_format, version, len(slots))]
+        for offset, length in slots:
+            parts.append(struct.pack(self.slot_format, offset, length))
+        return self.encode(''.join(parts))
+
+    def _decode_index(self, encoded):
+        data = self.decode(encoded)
+        header_size = struct.calcsize(self.header_format)
+        slot_size = struct.calcsize(self.slot_format)
+        version, count = struct.unpack_from(self.header_format, data)
+        slots = [struct.unpack_from(self.slot_format, data,
+                                    header_size + i * slot_size)
+                 for i in range(count)]
+        return version, slots
+
+    def _read_index(self, number):
+        with self._lock:
+            if number in self._indexes:
+                return self._indexes[number]
+        index = self._decode_index(self.fs.cat(self._index_filename(number)))
+        with self._lock:
+            # A pack written meanwhile must not be hidden by its
+            # empty index, which we may have read just before that.
+            return self._indexes.setdefault(number, index)
+
+    def _write_index(self, number, version, slots):
+        self.fs.overwrite_file(self._index_filename(number),
+                               self._encode_index(version, slots))
+        self._indexes[number] = (version, slots)
+
+    def _missing(self, chunk_id, exception=IOError):
+        return exception(errno.ENOENT, os.strerror(errno.ENOENT),
+                         'packed chunk %x' % chunk_id)
+
+    def put(self, data):
+        '''Add a chunk to the store, and return its chunk id.
+
+        This may be called from several threads at once.
+
+        '''
+
+        encoded = self.encode(data)
+        full = None
+        while True:
+            with self._lock:
+                if self._pending_number is not None:
+                    chunk_id = self._chunk_id(self._pending_number,
+                                              len(self._pending))
+                    self._pending.append(encoded)
+                    self._pending_bytes += len(encoded)
+                    if (self._pending_bytes >= self.pack_size or
+                        len(self._pending) == self.max_slots):
+                        full = self._take_pending()
+                    break
+            self._start_pack()
+        if full is not None:
+            self._write_pack(*full)
+        tracing.trace('chunkid=%s', chunk_id)
+        return chunk_id
+
+    def _start_pack(self):
+        # Only one thread reserves a new pack number at a time; the
+        # others wait for it, since they need the new pack as well.
+        with self._start_lock:
+            with self._lock:
+                if self._pending_number is not None:
+                    return
+            number = self._reserve_pack_number()
+            with self._lock:
+                self._pending_number = number
+                self._pending = []
+                self._pending_bytes = 0
+
+    def _reserve_pack_number(self):
+        # Creating the index file reserves the pack number, so that
+        # other clients backing up at the same time do not use it.
+        while True:
+            number = random.randint(0, self.max_pack_number)
+            try:
+                self.fs.write_file(self._index_filename(number),
+                                   self._encode_index(0, []))
+            except OSError, e: # pragma: no cover
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            return number
+
+    def _take_pending(self):
+        # Called with the lock held. The chunks stay visible via
+        # self._writing until _write_pack has written them.
+        number = self._pending_number
+        pending = self._pending
+        self._writing[number] = pending
+        self._pending_number = None
+        self._pending = []
+        self._pending_bytes = 0
+        return number, pending
+
+    def _write_pack(self, number, pending):
+        # Called without the lock held.
+        slots = []
+        offset = 0
+        for encoded in pending:
+            if encoded is None:
+                slots.append((self.removed_offset, 0))
+            else:
+                slots.append((offset, len(encoded)))
+                offset += len(encoded)
+        tracing.trace('writing pack %08x with %d chunks', number, len(slots))
+        try:
+            self.fs.write_file(self._data_filename(number, 0),
+                               ''.join(x for x in pending if x is not None))
+            self.fs.overwrite_file(self._index_filename(number),
+                                   self._encode_index(0, slots))
+        finally:
+            with self._lock:
+                self._indexes[number] = (0, slots)
+                del self._writing[number]
+                self._written.notify_all()
+
+    def _pending_chunk(self, chunk_id):
+        '''Return chunk that has not been written yet, or None.'''
+        number, slot = self._split_chunk_id(chunk_id)
+        if number == self._pending_number:
+            pending = self._pending
+        else:
+            pending = self._writing.get(number, [])
+        if slot < len(pending):
+            return pending[slot]
+        return None
+
+    def _find(self, chunk_id):
+        number, slot = self._split_chunk_id(chunk_id)
+        if slot in self._removed.get(number, []):
+            return None
+        try:
+            version, slots = self._read_index(number)
+        except (IOError, OSError), e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        if slot >= len(slots) or slots[slot][0] == self.removed_offset:
+            return None
+        offset, length = slots[slot]
+        return self._data_filename(number, version), offset, length
+
+    def get(self, chunk_id):
+        '''Return the contents of a chunk.'''
+
+        with self._lock:
+            encoded = self._pending_chunk(chunk_id)
+        if encoded is not None:
+            return self.decode(encoded)
+
+        found = self._find(chunk_id)
+        if found is None:
+            raise self._missing(chunk_id)
+        filename, offset, length = found
+        try:
+            encoded = self.fs.cat_range(filename, offset, length)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            # The pack may have been repacked since we read its index.
+            number, slot = self._split_chunk_id(chunk_id)
+            with self._lock:
+                self._indexes.pop(number, None)
+            found = self._find(chunk_id)
+            if found is None:
+                raise self._missing(chunk_id)
+            filename, offset, length = found
+            encoded = self.fs.cat_range(filename, offset, length)
+        return self.decode(encoded)
+
+    def exists(self, chunk_id):
+        '''Does a chunk exist in the store?'''
+        with self._lock:
+            if self._pending_chunk(chunk_id) is not None:
+                return True
+        return self._find(chunk_id) is not None
+
+    def remove(self, chunk_id):
+        '''Remove a chunk from the store.
+
+        The removal happens at the next ``flush``. Raise OSError if
+        the chunk does not exist.
+
+        '''
+
+        tracing.trace('chunk_id=%s', chunk_id)
+        number, slot = self._split_chunk_id(chunk_id)
+        with self._lock:
+            if self._pending_chunk(chunk_id) is not None:
+                if number == self._pending_number:
+                    self._pending_bytes -= len(self._pending[slot])
+                    self._pending[slot] = None
+                else:
+                    # The pack is being written; remove it at flush.
+                    self._removed.setdefault(number, set()).add(slot)
+                return
+        if self._find(chunk_id) is None:
+            raise self._missing(chunk_id, OSError)
+        number, slot = self._split_chunk_id(chunk_id)
+        with self._lock:
+            self._removed.setdefault(number, set()).add(slot)
+
+    def list_chunk_ids(self):
+        '''Return ids of all chunks in the store.'''
+
+        packs = {}
+        if self.fs.exists(self.dirname):
+            for basename in self.fs.listdir(self.dirname):
+                if basename.endswith('.idx'):
+                    number = int(basename[:-len('.idx')], 16)
+                    packs[number] = self._list_pack(number)
+        with self._lock:
+            pending = dict(self._writing)
+            if self._pending_number is not None:
+                pending[self._pending_number] = self._pending
+            for number, chunks in pending.iteritems():
+                removed = self._removed.get(number, set())
+                packs[number] = [
+                    self._chunk_id(number, slot)
+                    for slot, encoded in enumerate(chunks)
+                    if encoded is not None and slot not in removed]
+        result = []
+        for number in sorted(packs):
+            result.extend(packs[number])
+        return result
+
+    def _list_pack(self, number):
+        version, slots = self._read_index(number)
+        removed = self._removed.get(number, set())
+        return [self._chunk_id(number, slot)
+                for slot, (offset, length) in enumerate(slots)
+                if offset != self.removed_offset and slot not in removed]
+
+    def flush(self):
+        '''Write the pack being filled, and do pending removals.'''
+        full = None
+        with self._lock:
+            if self._pending_number is not None:
+                full = self._take_pending()
+        if full is not None:
+            self._write_pack(*full)
+        with self._lock:
+            while self._writing:
+                self._written.wait()
+            removed = self._removed
+            self._removed = {}
+        for number in sorted(removed):
+            self._remove_slots(number, removed[number])
+
+    def discard(self):
+        '''Forget chunks and removals that have not been flushed.'''
+        with self._lock:
+            if self._pending_number is not None:
+                try:
+                    self.fs.remove(self._index_filename(self._pending_number))
+                except OSError: # pragma: no cover
+                    pass
+            self._pending_number = None
+            self._pending = []
+            self._pending_bytes = 0
+            self._removed = {}
+
+    def _remove_slots(self, number, removed):
+        version, slots = self._read_index(number)
+        total_bytes = max([offset + length
+                           for offset, length in slots
+                           if offset != self.removed_offset] + [0])
+        slots = [(self.removed_offset, 0) if slot in removed else x
+                 for slot, x in enumerate(slots)]
+        live = [x for x in slots if x[0] != self.removed_offset]
+        old_data = self._data_filename(number, version)
+
+        if not live:
+            tracing.trace('removing empty pack %08x', number)
+            self.fs.remove(old_data)
+            self.fs.remove(self._index_filename(number))
+            del self._indexes[number]
+            return
+
+        live_bytes = sum(length for offset, length in live)
+        if live_bytes * 2 > total_bytes:
+            self._write_index(number, version, slots)
+            return
+
+        tracing.trace('repacking %08x', number)
+        data = self.fs.cat(old_data)
+        new_slots = []
+        parts = []
+        new_offset = 0
+        for offset, length in slots:
+            if offset == self.removed_offset:
+                new_slots.append((offset, length))
+            else:
+                parts.append(data[offset:offset + length])
+                new_slots.append((new_offset, length))
+                new_offset += length
+        self.fs.write_file(self._data_filename(number, version + 1),
+                           ''.join(parts))
+        self._write_index(number, version + 1, new_slots)
+        self.fs.remove(old_data)
+
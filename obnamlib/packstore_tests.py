@@ -0,0 +1,193 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import obnamlib
+
+
+class SlowDataWriteFS(object):
+
+    '''Wrap a VirtualFileSystem, making pack data writes wait.'''
+
+    def __init__(self, fs):
+        self.fs = fs
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        self.timed_out = False
+
+    def __getattr__(self, name):
+        return getattr(self.fs, name)
+
+    def write_file(self, filename, data):
+        if not filename.endswith('.idx'):
+            self.writing.set()
+            self.timed_out = not self.release.wait(5)
+        self.fs.write_file(filename, data)
+
+
+class PackStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fs = obnamlib.LocalFS(self.tempdir)
+        self.store = self.new_store()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_store(self, pack_size=10):
+        return obnamlib.PackStore(self.fs, 'chunks/packs', pack_size,
+                                  encode=lambda data: data[::-1],
+                                  decode=lambda data: data[::-1])
+
+    def data_files(self):
+        return [x for x in self.fs.listdir('chunks/packs')
+                if not x.endswith('.idx')]
+
+    def test_has_no_chunks_initially(self):
+        self.assertEqual(self.store.list_chunk_ids(), [])
+
+    def test_chunk_ids_are_packed(self):
+        chunk_id = self.store.put('foo')
+        self.assertTrue(obnamlib.PackStore.is_packed(chunk_id))
+        self.assertFalse(obnamlib.PackStore.is_packed(12765))
+
+    def test_gets_pending_chunk(self):
+        chunk_id = self.store.put('foo')
+        self.assertEqual(self.data_files(), [])
+        self.assertTrue(self.store.exists(chunk_id))
+        self.assertEqual(self.store.get(chunk_id), 'foo')
+        self.assertEqual(self.store.list_chunk_ids(), [chunk_id])
+
+    def test_writes_pack_when_full(self):
+        foo = self.store.put('foo')
+        bar = self.store.put('bar-bar-bar')
+        self.assertEqual(len(self.data_files()), 1)
+        self.assertNotEqual(foo, bar)
+
+        store = self.new_store()
+        self.assertEqual(store.get(foo), 'foo')
+        self.assertEqual(store.get(bar), 'bar-bar-bar')
+        self.assertEqual(sorted(store.list_chunk_ids()), sorted([foo, bar]))
+
+    def test_uses_store_while_writing_full_pack(self):
+        fs = SlowDataWriteFS(self.fs)
+        store = obnamlib.PackStore(fs, 'chunks/packs', 10)
+        foo = store.put('foo')
+        writer = threading.Thread(target=store.put, args=['bar-bar-bar'])
+        writer.start()
+        fs.writing.wait()
+        try:
+            self.assertEqual(store.get(foo), 'foo')
+            self.assertTrue(store.exists(foo))
+            self.assertEqual(len(store.list_chunk_ids()), 2)
+            baz = store.put('baz')
+            self.assertEqual(store.get(baz), 'baz')
+        finally:
+            fs.release.set()
+            writer.join()
+        self.assertFalse(fs.timed_out)
+        store.flush()
+        other = obnamlib.PackStore(self.fs, 'chunks/packs', 10)
+        self.assertEqual(len(other.list_chunk_ids()), 3)
+        self.assertEqual(other.get(foo), 'foo')
+
+    def test_stores_encoded_chunks(self):
+        self.store.put('foo')
+        self.store.flush()
+        filename = 'chunks/packs/%s' % self.data_files()[0]
+        self.assertEqual(self.fs.cat(filename), 'oof')
+
+    def test_flush_writes_pending_chunks(self):
+        chunk_id = self.store.put('foo')
+        self.store.flush()
+        self.assertEqual(self.new_store().get(chunk_id), 'foo')
+
+    def test_discard_forgets_pending_chunks(self):
+        chunk_id = self.store.put('foo')
+        self.store.discard()
+        self.store.flush()
+        self.assertFalse(self.store.exists(chunk_id))
+        self.assertEqual(self.fs.listdir('chunks/packs'), [])
+
+    def test_get_of_missing_chunk_fails(self):
+        chunk_id = self.store.put('foo')
+        self.store.flush()
+        self.assertRaises(IOError, self.store.get, chunk_id + 1)
+        self.assertFalse(self.store.exists(chunk_id + 1))
+
+    def test_removes_pending_chunk(self):
+        foo = self.store.put('foo')
+        bar = self.store.put('bar')
+        self.store.remove(foo)
+        self.assertFalse(self.store.exists(foo))
+        self.store.flush()
+        store = self.new_store()
+        self.assertFalse(store.exists(foo))
+        self.assertEqual(store.list_chunk_ids(), [bar])
+
+    def test_removal_of_missing_chunk_fails(self):
+        chunk_id = self.store.put('foo')
+        self.store.flush()
+        self.assertRaises(OSError, self.store.remove, chunk_id + 1)
+
+    def test_removes_chunk_at_flush(self):
+        foo = self.store.put('foo')
+        bar = self.store.put('bar')
+        self.store.flush()
+        self.store.remove(foo)
+        self.assertFalse(self.store.exists(foo))
+        self.assertTrue(self.new_store().exists(foo))
+        self.store.flush()
+        store = self.new_store()
+        self.assertFalse(store.exists(foo))
+        self.assertEqual(store.get(bar), 'bar')
+
+    def test_removes_pack_when_all_chunks_are_removed(self):
+        foo = self.store.put('foo')
+        self.store.flush()
+        self.store.remove(foo)
+        self.store.flush()
+        self.assertEqual(self.fs.listdir('chunks/packs'), [])
+
+    def test_repacks_mostly_unused_pack(self):
+        big = self.store.put('big chunk')
+        small = self.store.put('x')
+        self.store.flush()
+        old_files = self.data_files()
+        self.store.remove(big)
+        self.store.flush()
+        new_files = self.data_files()
+        self.assertNotEqual(old_files, new_files)
+        filename = 'chunks/packs/%s' % new_files[0]
+        self.assertEqual(self.fs.cat(filename), 'x')
+        self.assertEqual(self.store.get(small), 'x')
+        self.assertEqual(self.new_store().get(small), 'x')
+
+    def test_rereads_index_after_repack_by_other_store(self):
+        big = self.store.put('big chunk')
+        small = self.store.put('x')
+        self.store.flush()
+        self.assertEqual(self.store.get(small), 'x')
+        other = self.new_store()
+        other.remove(big)
+        other.flush()
+        self.assertEqual(self.store.get(small), 'x')
+
@@ -0,0 +1,210 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+
+
+# Characters that have a special meaning in regular expressions.
+_special = '.^$*+?{}[]|()\\'
+
+# Patterns that can't be combined with others into one regular
+# expression: inline flags apply to the whole expression, and group
+# numbers change when patterns are combined.
+_uncombinable = re.compile(r'\(\?[iLmsux]|\\[1-9]|\(\?P=')
+
+# Python 2 allows at most 100 groups in a regular expression, so
+# patterns are combined in batches. Each pattern gets a group.
+_batch_size = 50
+
+
+def _literal(pattern):
+    '''Return the string a regular expression matches literally.
+
+    If the pattern is not just literal characters, return None.
+
+    '''
+
+    chars = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 == len(pattern) or pattern[i+1].isalnum():
+                return None
+            chars.append(pattern[i+1])
+            i += 2
+        elif c in _special:
+            return None
+        else:
+            chars.append(c)
+            i += 1
+    return ''.join(chars)
+
+
+def _required_literal(pattern):
+    '''Return the longest string any match of a pattern must contain.
+
+    Only the part of the pattern before any group, character class, or
+    alternation is considered. Return the empty string if nothing
+    useful is found.
+
+    '''
+
+    if '|' in pattern or _uncombinable.search(pattern):
+        return ''
+
+    runs = [[]]
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 == len(pattern) or pattern[i+1].isalnum():
+                runs.append([])
+                i += 2
+                continue
+            runs[-1].append(pattern[i+1])
+            i += 2
+        elif c in '([':
+            break
+        elif c in '?*{':
+            # The previous character is optional.
+            if runs[-1]:
+                runs[-1].pop()
+            runs.append([])
+            if c == '{':
+                i = pattern.find('}', i)
+                if i == -1:
+                    break
+            i += 1
+        elif c in _special:
+            runs.append([])
+            i += 1
+        else:
+            runs[-1].append(c)
+            i += 1
+    return max((''.join(run) for run in runs), key=len)
+
+
+def _ends_with_anchor(pattern):
+    '''Does a pattern end with an unescaped $?'''
+    if not pattern.endswith('$'):
+        return False
+    backslashes = len(pattern[:-1]) - len(pattern[:-1].rstrip('\\'))
+    return backslashes % 2 == 0
+
+
+class PathMatcher(object):
+
+    '''Match pathnames against a list of regular expressions.
+
+    ``search`` is true if any of the patterns matches a pathname,
+    like ``re.search``. Patterns that are plain strings, optionally
+    anchored at the start or end, such as ``\\.o$`` or ``/\\.cache/``,
+    are checked with string operations. Other patterns that contain
+    a literal string, such as ``/tmp/.*\\.bak$``, are only matched if
+    the pathname contains that string. The rest are combined into
+    as few regular expressions as possible, so that each pathname
+    is not matched against each pattern separately.
+
+    The patterns must be valid regular expressions.
+
+    '''
+
+    def __init__(self, patterns):
+        self.substrings = []
+        self.prefixes = []
+        self.suffixes = []
+        self.exact = set()
+        regexps = []
+
+        for pattern in patterns:
+            start = pattern.startswith('^')
+            body = pattern[1:] if start else pattern
+            end = _ends_with_anchor(body)
+            if end:
+                body = body[:-1]
+            literal = _literal(body)
+
+            if not literal:
+                regexps.append(pattern)
+            elif start and end:
+                self.exact.add(literal)
+            elif start:
+                self.prefixes.append(literal)
+            elif end:
+                self.suffixes.append(literal)
+            else:
+                self.substrings.append(literal)
+
+        self.prefixes = tuple(self.prefixes)
+        self.suffixes = tuple(self.suffixes)
+
+        self.guarded = []
+        unguarded = []
+        for pattern in regexps:
+            literal = _required_literal(pattern)
+            if len(literal) >= 2:
+                self.guarded.append((literal, re.compile(pattern)))
+            else:
+                unguarded.append(pattern)
+        self.regexps = self._combine(unguarded)
+
+    def _combine(self, patterns):
+        separate = [p for p in patterns if _uncombinable.search(p)]
+        combinable = [p for p in patterns if not _uncombinable.search(p)]
+
+        result = [re.compile(p) for p in separate]
+        for i in range(0, len(combinable), _batch_size):
+            batch = combinable[i:i + _batch_size]
+            try:
+                result.append(re.compile('|'.join('(?:%s)' % p
+                                                  for p in batch)))
+            except (re.error, AssertionError, OverflowError):
+                # Some combinations hit limits of the regexp engine.
+                result.extend(re.compile(p) for p in batch)
+        return result
+
+    def search(self, pathname):
+        '''Does any pattern match a pathname?'''
+
+        for s in self.substrings:
+            if s in pathname:
+                return True
+
+        # $ also matches before a newline at the very end.
+        if pathname.endswith('\n'):
+            candidates = (pathname, pathname[:-1])
+        else:
+            candidates = (pathname,)
+        for candidate in candidates:
+            if candidate in self.exact:
+                return True
+            if self.suffixes and candidate.endswith(self.suffixes):
+                return True
+
+        if self.prefixes and pathname.startswith(self.prefixes):
+            return True
+
+        for literal, regexp in self.guarded:
+            if literal in pathname and regexp.search(pathname):
+                return True
+
+        for regexp in self.regexps:
+            if regexp.search(pathname):
+                return True
+
+        return False
+
@@ -0,0 +1,119 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+import unittest
+
+import obnamlib
+
+
+class PathMatcherTests(unittest.TestCase):
+
+    patterns = [
+        r'\.o$',
+        r'/\.cache/',
+        r'^/tmp/',
+        r'^/etc/passwd$',
+        r'\$HOME',
+        r'\\$',
+        r'/build/.*\.log$',
+        r'x{2,3}y',
+        r'[0-9]+\.bak$',
+        r'(?i)\.JPG$',
+        r'(a)\1b',
+        r'foo|bar',
+        r'^$',
+    ]
+
+    pathnames = [
+        '/home/foo.o',
+        '/home/foo.o\n',
+        '/home/foo.od',
+        '/home/.cache/x',
+        '/home/.cachex/x',
+        '/home/xcache/x',
+        '/tmp/x',
+        '/var/tmp/x',
+        '/etc/passwd',
+        '/etc/passwd\n',
+        '/etc/passwd2',
+        '/x/$HOME/y',
+        '/x/\\',
+        '/x/build/a/b.log',
+        '/x/build/a/b.logx',
+        '/x/build.log',
+        '/x/xxy',
+        '/x/xy',
+        '/x/12.bak',
+        '/x/.bak',
+        '/x/photo.jpg',
+        '/x/aab',
+        '/x/ab',
+        '/x/food',
+        '/x/rebar',
+        '',
+        '/x/plain',
+    ]
+
+    def search_each(self, patterns, pathname):
+        return any(re.search(p, pathname) for p in patterns)
+
+    def assertSameAsEachPattern(self, patterns):
+        matcher = obnamlib.PathMatcher(patterns)
+        for pathname in self.pathnames:
+            self.assertEqual(
+                matcher.search(pathname),
+                self.search_each(patterns, pathname),
+                'pathname %r' % pathname)
+
+    def test_matches_nothing_without_patterns(self):
+        matcher = obnamlib.PathMatcher([])
+        self.assertFalse(matcher.search('/foo'))
+
+    def test_uses_string_operations_for_literal_patterns(self):
+        matcher = obnamlib.PathMatcher(
+            [r'\.o$', r'/\.cache/', r'^/tmp/', r'^/etc/passwd$'])
+        self.assertEqual(matcher.suffixes, ('.o',))
+        self.assertEqual(matcher.substrings, ['/.cache/'])
+        self.assertEqual(matcher.prefixes, ('/tmp/',))
+        self.assertEqual(matcher.exact, set(['/etc/passwd']))
+        self.assertEqual(matcher.guarded, [])
+        self.assertEqual(matcher.regexps, [])
+
+    def test_guards_regexp_with_literal(self):
+        matcher = obnamlib.PathMatcher([r'/build/.*\.log$'])
+        self.assertEqual([x for x, y in matcher.guarded], ['/build/'])
+
+    def test_does_not_guard_with_optional_characters(self):
+        matcher = obnamlib.PathMatcher([r'ab?', r'x{2,3}'])
+        self.assertEqual(matcher.guarded, [])
+
+    def test_matches_like_each_pattern_separately(self):
+        self.assertSameAsEachPattern(self.patterns)
+
+    def test_matches_like_each_pattern_separately_in_other_order(self):
+        self.assertSameAsEachPattern(list(reversed(self.patterns)))
+
+    def test_matches_each_pattern_alone_like_re_search(self):
+        for pattern in self.patterns:
+            self.assertSameAsEachPattern([pattern])
+
+    def test_combines_many_patterns_with_groups(self):
+        patterns = ['(x)(y)%d$' % i for i in range(200)]
+        matcher = obnamlib.PathMatcher(patterns)
+        self.assertTrue(matcher.search('/foo/xy199'))
+        self.assertFalse(matcher.search('/foo/xy200'))
+
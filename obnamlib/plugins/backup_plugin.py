@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import errno
 import gc
 import logging
@@ -30,31 +31,81 @@ import obnamlib
 import larch
 
 
-class ChunkidPool(object):
+class SerialReader(object):
 
-    '''Checksum/chunkid mappings that are pending an upload to shared trees.'''
+    '''Like obnamlib.ReadAhead, but without a background thread.'''
 
-    def __init__(self):
-        self.clear()
+    def __init__(self, iterable):
+        self._iterable = iterable
 
-    def add(self, chunkid, checksum):
-        if checksum not in self._mapping:
-            self._mapping[checksum] = []
-        self._mapping[checksum].append(chunkid)
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        pass
+
+
+class FileRegion(object):
+
+    '''Read at most a given number of bytes from an open file.'''
+
+    def __init__(self, f, length):
+        self._f = f
+        self._remaining = length
+
+    def read(self, amount):
+        data = self._f.read(min(amount, self._remaining))
+        self._remaining -= len(data)
+        return data
+
+
+class PendingUploads(object):
+
+    '''Chunks that are being uploaded in the background.
+
+    ``put`` starts an upload and returns a WorkerJob, which stands in
+    for the chunk id until ``wait`` is called on it. Chunks that are to
+    be put into the shared trees are added to the ChunkidPool only
+    when their upload has finished, since only then is their chunk id
+    known.
+
+    '''
+
+    def __init__(self, pool, chunkid_pool):
+        self._pool = pool
+        self._chunkid_pool = chunkid_pool
+        self._by_job = {}
+        self._by_checksum = {}
+
+    def put(self, put_chunk, data):
+        return self._pool.submit(put_chunk, data)
+
+    def share(self, job, checksum):
+        self._by_job[job] = checksum
+        self._by_checksum[checksum] = job
 
     def __contains__(self, checksum):
-        return checksum in self._mapping
+        return checksum in self._by_checksum
 
-    def get(self, checksum):
-        return self._mapping.get(checksum, [])
+    def wait(self, chunkid):
+        '''Return the real chunk id for a chunk id or a pending upload.'''
+        if not isinstance(chunkid, obnamlib.WorkerJob):
+            return chunkid
+        job = chunkid
+        chunkid = job.result()
+        checksum = self._by_job.pop(job, None)
+        if checksum is not None:
+            del self._by_checksum[checksum]
+            self._chunkid_pool.add(chunkid, checksum)
+        return chunkid
 
-    def clear(self):
-        self._mapping = {}
+    def wait_for_checksum(self, checksum):
+        if checksum in self._by_checksum:
+            self.wait(self._by_checksum[checksum])
 
-    def __iter__(self):
-        for checksum in self._mapping.keys():
-            for chunkid in self._mapping[checksum]:
-                yield chunkid, checksum
+    def wait_for_all(self):
+        for job in self._by_job.keys():
+            self.wait(job)
 
 
 class BackupProgress(object):
@@ -199,6 +250,79 @@ class BackupPlugin(obnamlib.ObnamPlugin):
                                   metavar='NUM',
                                   default=obnamlib.DEFAULT_CHUNKIDS_PER_GROUP,
                                   group=perf_group)
+        self.app.settings.integer(['upload-workers'],
+                                  'upload chunks to the repository with NUM '
+                                    'background threads, while reading and '
+                                    'checksumming the next chunks; '
+                                    'use 0 to do everything serially '
+                                    '(%default)',
+                                  metavar='NUM',
+                                  default=obnamlib.DEFAULT_UPLOAD_WORKERS,
+                                  group=perf_group)
+        self.app.settings.integer(['checksum-workers'],
+                                  'compute checksums of chunks with NUM '
+                                    'background threads; use 0 to compute '
+                                    'them in the main thread (%default)',
+                                  metavar='NUM',
+                                  default=obnamlib.DEFAULT_CHECKSUM_WORKERS,
+                                  group=perf_group)
+        self.app.settings.integer(['scan-workers'],
+                                  'list directories to be backed up with '
+                                    'NUM background threads, ahead of the '
+                                    'backup itself; use 0 to scan '
+                                    'serially (%default)',
+                                  metavar='NUM',
+                                  default=obnamlib.DEFAULT_SCAN_WORKERS,
+                                  group=perf_group)
+        self.app.settings.integer(['scan-queue-size'],
+                                  'list at most NUM directories ahead of '
+                                    'the backup when scanning with '
+                                    '--scan-workers (%default)',
+                                  metavar='NUM',
+                                  default=obnamlib.DEFAULT_SCAN_QUEUE_SIZE,
+                                  group=perf_group)
+        self.app.settings.string(['unchanged-cache'],
+                                 'remember which files were backed up in '
+                                    'FILE on the local disk, so that '
+                                    'files that have not changed since the '
+                                    'previous backup can be skipped without '
+                                    'looking them up in the repository '
+                                    '(default: no cache)',
+                                 metavar='FILE',
+                                 group=perf_group)
+        self.app.settings.boolean(['sparse-files'],
+                                  'find holes in sparse files, and store '
+                                    'them as holes in the backup, instead '
+                                    'of reading and backing up the zero '
+                                    'bytes; such backups can\'t be '
+                                    'restored with versions of Obnam '
+                                    'before 1.7',
+                                  group=perf_group)
+        self.app.settings.choice(['chunker'],
+                                 ['fixed', 'rabin'],
+                                 'how to split file data into chunks: '
+                                    'fixed size chunks of --chunk-size '
+                                    'bytes (the default), or content-defined '
+                                    'chunks of --chunk-size bytes on '
+                                    'average, which de-duplicate better '
+                                    'when data is inserted into the middle '
+                                    'of a file',
+                                 metavar='MODE',
+                                 group=perf_group)
+        self.app.settings.bytesize(['chunk-min-size'],
+                                   'with --chunker=rabin, make chunks at '
+                                    'least SIZE bytes long; 0 means a '
+                                    'quarter of --chunk-size (%default)',
+                                   metavar='SIZE',
+                                   default=0,
+                                   group=perf_group)
+        self.app.settings.bytesize(['chunk-max-size'],
+                                   'with --chunker=rabin, make chunks at '
+                                    'most SIZE bytes long; 0 means four '
+                                    'times --chunk-size (%default)',
+                                   metavar='SIZE',
+                                   default=0,
+                                   group=perf_group)
         self.app.settings.choice(['deduplicate'],
                                  ['fatalist', 'never', 'verify'],
                                  'find duplicate data in backed up data '
@@ -287,8 +411,17 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             self.repo.lock_shared()
             self.repo.unlock_shared()
 
+        self.app.open_chunk_cache(self.repo)
         self.errors = False
-        self.chunkid_pool = ChunkidPool()
+        gens = self.repo.list_generations()
+        self.previous_generation = gens[-1] if gens else None
+        self.unchanged_cache = self.open_unchanged_cache()
+        self.chunkid_pool = obnamlib.ChunkidPool()
+        self.upload_pool = obnamlib.WorkerPool(
+            self.app.settings['upload-workers'])
+        self.uploads = PendingUploads(self.upload_pool, self.chunkid_pool)
+        self.checksum_pool = obnamlib.WorkerPool(
+            self.app.settings['checksum-workers'])
         try:
             if not self.pretend:
                 self.progress.what('starting new generation')
@@ -300,6 +433,12 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             self.backup_roots(roots)
             self.progress.what('committing changes to repository')
             if not self.pretend:
+                self.progress.what(
+                    'committing changes to repository: '
+                    'waiting for uploads to finish')
+                self.uploads.wait_for_all()
+                self.upload_pool.close()
+                self.checksum_pool.close()
                 self.progress.what(
                     'committing changes to repository: locking shared B-trees')
                 self.repo.lock_shared()
@@ -310,11 +449,17 @@ class BackupPlugin(obnamlib.ObnamPlugin):
                 self.progress.what(
                     'committing changes to repository: '
                     'committing client')
+                new_generation = self.repo.new_generation
                 self.repo.commit_client()
                 self.progress.what(
                     'committing changes to repository: '
                     'committing shared B-trees')
                 self.repo.commit_shared()
+                if self.unchanged_cache is not None:
+                    logging.info('Unchanged file cache hits: %d' %
+                                 self.unchanged_cache.hits)
+                    self.unchanged_cache.commit(new_generation)
+            self.repo.close_chunk_cache()
             self.progress.what('closing connection to repository')
             self.repo.fs.close()
             self.progress.clear()
@@ -325,12 +470,28 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         except BaseException, e:
             logging.debug('Handling exception %s' % str(e))
             logging.debug(traceback.format_exc())
+            self.upload_pool.close()
+            self.checksum_pool.close()
+            if self.unchanged_cache is not None:
+                self.unchanged_cache.close()
             self.unlock_when_error()
+            self.repo.close_chunk_cache()
             raise
 
         if self.errors:
             raise obnamlib.Error('There were errors during the backup')
 
+    def open_unchanged_cache(self):
+        '''Open the local cache of unchanged files, if one is wanted.'''
+        filename = self.app.settings['unchanged-cache']
+        if not filename or self.pretend:
+            return None
+        return obnamlib.UnchangedFileCache(
+            os.path.expanduser(filename),
+            self.app.settings['repository'],
+            self.app.settings['client-name'],
+            self.previous_generation)
+
     def unlock_when_error(self):
         try:
             if self.repo.got_client_lock:
@@ -348,8 +509,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             logging.info('Successfully unlocked')
 
     def add_chunks_to_shared(self):
-        for chunkid, checksum in self.chunkid_pool:
-            self.repo.put_chunk_in_shared_trees(chunkid, checksum)
+        self.repo.put_chunks_in_shared_trees(list(self.chunkid_pool))
         self.chunkid_pool.clear()
 
     def add_client(self, client_name):
@@ -372,16 +532,19 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         for pattern in self.app.settings['exclude']:
             logging.debug('Exclude pattern: %s' % pattern)
 
-        self.exclude_pats = []
+        patterns = []
         for x in self.app.settings['exclude']:
             if x != '':
                 try:
-                    self.exclude_pats.append(re.compile(x))
+                    re.compile(x)
                 except re.error, e:
                     msg = (
                         'error compiling regular expression "%s": %s' % (x, e))
                     logging.error(msg)
                     self.progress.error(msg)
+                else:
+                    patterns.append(x)
+        self.exclude_matcher = obnamlib.PathMatcher(patterns)
 
     def backup_roots(self, roots):
         self.progress.what('connecting to to repository')
@@ -421,6 +584,8 @@ class BackupPlugin(obnamlib.ObnamPlugin):
                         metadata.md5 = self.backup_file_contents(pathname,
                                                                  metadata)
                     self.backup_metadata(pathname, metadata)
+                    if self.unchanged_cache is not None:
+                        self.unchanged_cache.remember(pathname)
                 except (IOError, OSError), e:
                     msg = 'Can\'t back up %s: %s' % (pathname, e.strerror)
                     self.error(msg, e)
@@ -461,6 +626,8 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         self.progress.what('making checkpoint')
         if not self.pretend:
             self.checkpoints.append(self.repo.new_generation)
+            self.progress.what('making checkpoint: waiting for uploads')
+            self.uploads.wait_for_all()
             self.progress.what('making checkpoint: backing up parents')
             self.backup_parents('.')
             self.progress.what('making checkpoint: locking shared B-trees')
@@ -473,7 +640,9 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             self.repo.commit_shared()
             self.last_checkpoint = self.repo.fs.bytes_written
             self.progress.what('making checkpoint: re-opening repository')
+            self.repo.close_chunk_cache()
             self.repo = self.app.open_repository(repofs=self.repo.fs.fs)
+            self.app.open_chunk_cache(self.repo)
             self.progress.what('making checkpoint: locking client')
             self.repo.lock_client(self.app.settings['client-name'])
             self.progress.what('making checkpoint: starting a new generation')
@@ -491,15 +660,28 @@ class BackupPlugin(obnamlib.ObnamPlugin):
 
         '''
 
-        for pathname, st in self.fs.scan_tree(root, ok=self.can_be_backed_up):
+        tree = self.fs.scan_tree(
+            root, ok=self.can_be_backed_up,
+            workers=self.app.settings['scan-workers'],
+            queue_size=self.app.settings['scan-queue-size'])
+        for pathname, st in tree:
             tracing.trace('considering %s' % pathname)
             try:
+                if self.is_unchanged_in_cache(pathname, st):
+                    tracing.trace('%s unchanged according to cache' %
+                                  pathname)
+                    self.unchanged_cache.remember(pathname)
+                    self.progress.update_progress_with_file(pathname, st)
+                    self.progress.update_progress_with_scanned(st.st_size)
+                    continue
                 metadata = obnamlib.read_metadata(self.fs, pathname, st=st)
                 self.progress.update_progress_with_file(pathname, metadata)
                 if self.needs_backup(pathname, metadata):
                     self.progress.backed_up_count += 1
                     yield pathname, metadata
                 else:
+                    if self.unchanged_cache is not None:
+                        self.unchanged_cache.remember(pathname)
                     self.progress.update_progress_with_scanned(
                         metadata.st_size)
             except GeneratorExit:
@@ -511,16 +693,19 @@ class BackupPlugin(obnamlib.ObnamPlugin):
                 msg = 'Cannot back up %s: %s' % (pathname, str(e))
                 self.error(msg, e)
 
+    def is_unchanged_in_cache(self, pathname, st):
+        return (self.unchanged_cache is not None and
+                self.unchanged_cache.is_unchanged(pathname, st))
+
     def can_be_backed_up(self, pathname, st):
         if self.app.settings['one-file-system']:
             if st.st_dev != self.root_metadata.st_dev:
                 logging.debug('Excluding (one-file-system): %s' % pathname)
                 return False
 
-        for pat in self.exclude_pats:
-            if pat.search(pathname):
-                logging.debug('Excluding (pattern): %s' % pathname)
-                return False
+        if self.exclude_matcher.search(pathname):
+            logging.debug('Excluding (pattern): %s' % pathname)
+            return False
 
         if stat.S_ISDIR(st.st_mode) and self.app.settings['exclude-caches']:
             tag_filename = 'CACHEDIR.TAG'
@@ -537,6 +722,11 @@ class BackupPlugin(obnamlib.ObnamPlugin):
 
         return True
 
+    # The metadata fields needs_backup compares.
+    needs_backup_fields = ('st_mtime_sec', 'st_mtime_nsec', 'st_mode',
+                           'st_nlink', 'st_size', 'st_uid', 'st_gid',
+                           'xattr')
+
     def needs_backup(self, pathname, current):
         '''Does a given file need to be backed up?'''
 
@@ -553,8 +743,10 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         else:
             gen = self.repo.new_generation
         tracing.trace('gen=%s' % repr(gen))
+        self.repo.prefetch_metadata(gen, os.path.dirname(pathname))
         try:
-            old = self.repo.get_metadata(gen, pathname)
+            old = self.repo.get_metadata(gen, pathname,
+                                         fields=self.needs_backup_fields)
         except obnamlib.Error, e:
             # File does not exist in the previous generation, so it
             # does need to be backed up.
@@ -620,7 +812,7 @@ class BackupPlugin(obnamlib.ObnamPlugin):
         tracing.trace('opening file for reading')
         f = self.fs.open(filename, 'r')
 
-        summer = self.repo.new_checksummer()
+        summer = self.repo.new_file_checksummer()
 
         max_intree = self.app.settings['node-size'] / 4
         if (metadata.st_size <= max_intree and
@@ -634,47 +826,255 @@ class BackupPlugin(obnamlib.ObnamPlugin):
             return summer.digest()
 
         chunk_size = int(self.app.settings['chunk-size'])
+
+        prefix_hash = None
+        if self.can_deduplicate_whole_file(metadata, chunk_size):
+            prefix_hash, md5 = self.backup_duplicate_file(
+                filename, f, metadata, chunk_size)
+            if md5 is not None:
+                f.close()
+                # Index the copy too, so that later copies are found
+                # even after the original has been removed.
+                self.repo.index_file_contents(
+                    filename, metadata.st_size, prefix_hash)
+                return md5
+            f.seek(0)
+
         chunkids = []
-        while True:
-            tracing.trace('reading some data')
-            self.progress.update_progress()
-            data = f.read(chunk_size)
-            if not data:
-                tracing.trace('end of data')
-                break
-            tracing.trace('got %d bytes of data' % len(data))
-            self.progress.update_progress_with_scanned(len(data))
-            summer.update(data)
-            if not self.pretend:
-                chunkids.append(self.backup_file_chunk(data))
+        reader = self.read_file_chunks(f, chunk_size, metadata, summer)
+        try:
+            for data, checksum in self.checksum_chunks(reader):
+                self.progress.update_progress()
+                if isinstance(data, obnamlib.Hole):
+                    tracing.trace('got hole of %d bytes' % data.size)
+                    self.progress.update_progress_with_scanned(data.size)
+                    chunkids.append(data)
+                else:
+                    tracing.trace('got %d bytes of data' % len(data))
+                    self.progress.update_progress_with_scanned(len(data))
+                    chunkids.append(self.backup_file_chunk(data, checksum))
                 if len(chunkids) >= self.app.settings['chunkids-per-group']:
                     tracing.trace('adding %d chunkids to file' % len(chunkids))
-                    self.repo.append_file_chunks(filename, chunkids)
+                    self.append_file_chunks(filename, chunkids)
                     self.app.dump_memory_profile('after appending some '
                                                     'chunkids')
                     chunkids = []
-            else:
-                self.self.update_progress_with_upload(len(data))
 
-            if not self.pretend and self.time_for_checkpoint():
-                logging.debug('making checkpoint in the middle of a file')
-                self.repo.append_file_chunks(filename, chunkids)
-                chunkids = []
-                self.make_checkpoint()
+                if self.time_for_checkpoint():
+                    logging.debug('making checkpoint in the middle of a file')
+                    self.append_file_chunks(filename, chunkids)
+                    chunkids = []
+                    self.make_checkpoint()
+        finally:
+            reader.close()
 
         tracing.trace('closing file')
         f.close()
         if chunkids:
-            assert not self.pretend
             tracing.trace('adding final %d chunkids to file' % len(chunkids))
-            self.repo.append_file_chunks(filename, chunkids)
+            self.append_file_chunks(filename, chunkids)
+        if prefix_hash is not None:
+            self.repo.index_file_contents(
+                filename, metadata.st_size, prefix_hash)
         self.app.dump_memory_profile('at end of file content backup for %s' %
                                      filename)
         tracing.trace('done backing up file contents')
         return summer.digest()
 
-    def backup_file_chunk(self, data):
-        '''Back up a chunk of data by putting it into the repository.'''
+    # Amount of data at the start of a file used for the prefix hash
+    # in the index of file contents.
+    whole_file_prefix_size = 64 * 1024
+
+    def can_deduplicate_whole_file(self, metadata, chunk_size):
+        # With --deduplicate=verify we would have to compare the whole
+        # file's data to the old file's, so we only do this for the
+        # default fatalist mode.
+        # Sparse files are not checked either, since that would mean
+        # reading all the zeroes in their holes.
+        return (self.app.settings['deduplicate'] == 'fatalist' and
+                metadata.st_size > chunk_size and
+                not self.may_have_holes(metadata))
+
+    def find_duplicate_file(self, filename, size, prefix_hash):
+        '''Find another backed up file that may have the same contents.
+
+        Return (generation, pathname, md5) or None.
+
+        '''
+
+        gens = [self.repo.new_generation]
+        if self.previous_generation is not None:
+            gens.append(self.previous_generation)
+        for gen in gens:
+            pathname = self.repo.find_file_by_contents(gen, size, prefix_hash)
+            # The most common match is the file itself. It is being
+            # backed up again because it has changed, or its metadata
+            # has, and either way reading it once to chunk it is
+            # cheaper than reading it to compare checksums first.
+            if pathname is None or pathname == filename:
+                continue
+            try:
+                old = self.repo.get_metadata(gen, pathname)
+            except obnamlib.Error:
+                continue
+            if old.isfile() and old.st_size == size and old.md5:
+                return gen, pathname, old.md5
+        return None
+
+    def backup_duplicate_file(self, filename, f, metadata, chunk_size):
+        '''Back up a file by re-using the chunks of an identical file.
+
+        Large files that have been renamed or copied are found in the
+        index of file contents, by their size and a hash of their first
+        bytes, and then checked by computing the whole-file checksum.
+        This avoids checksumming and looking up each chunk separately.
+
+        Return (prefix_hash, md5). If no identical file is found,
+        md5 is None, and the caller needs to back up the file normally.
+        Either way, the caller then adds the file to the index with
+        prefix_hash.
+
+        '''
+
+        prefix = f.read(self.whole_file_prefix_size)
+        summer = self.repo.new_checksummer()
+        summer.update(prefix)
+        prefix_hash = summer.digest()[:8]
+
+        found = self.find_duplicate_file(
+            filename, metadata.st_size, prefix_hash)
+        if found is None:
+            return prefix_hash, None
+        gen, pathname, md5 = found
+        logging.debug('Checking whether %s is a copy of %s' %
+                      (filename, pathname))
+
+        # The data only counts as scanned if it is not read again for
+        # chunking.
+        scanned = len(prefix)
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            summer.update(data)
+            scanned += len(data)
+            self.progress.update_progress()
+        if summer.digest() != md5:
+            return prefix_hash, None
+
+        chunkids = self.repo.get_file_chunks(gen, pathname)
+        if not chunkids: # pragma: no cover
+            # The old file's data was stored in the B-tree, not chunks.
+            return prefix_hash, None
+        logging.debug('Re-using chunks of %s for %s' % (pathname, filename))
+        self.repo.set_file_chunks(filename, chunkids)
+        self.progress.update_progress_with_scanned(scanned)
+        return prefix_hash, md5
+
+    def read_file_chunks(self, f, chunk_size, metadata, summer):
+        '''Return an iterator over the chunks of data in an open file.
+
+        Files bigger than a chunk are read in a background thread, so that
+        reading the next chunks overlaps with uploading the previous ones.
+        The whole-file checksum ``summer`` is updated in the same thread,
+        and is complete once all chunks have been returned.
+        The caller must call the ``close`` method of the returned object.
+
+        '''
+
+        chunker = obnamlib.new_chunker(self.app.settings)
+        extents = self.find_data_extents(f, metadata)
+
+        def hole(offset, size):
+            summer.hole(size)
+            return obnamlib.Hole(size, offset=offset)
+
+        def chunks():
+            if extents is None:
+                for data in chunker.chunks(f):
+                    summer.update(data)
+                    yield data
+                return
+
+            pos = 0
+            for offset, length in extents:
+                if offset > pos:
+                    yield hole(pos, offset - pos)
+                f.seek(offset)
+                for data in chunker.chunks(FileRegion(f, length)):
+                    summer.update(data)
+                    yield data
+                pos = offset + length
+            if metadata.st_size > pos:
+                yield hole(pos, metadata.st_size - pos)
+
+        workers = self.app.settings['upload-workers']
+        if workers > 0 and metadata.st_size > chunk_size:
+            return obnamlib.ReadAhead(chunks(), workers)
+        return SerialReader(chunks())
+
+    def find_data_extents(self, f, metadata):
+        '''Return the data extents of a sparse file, or None.
+
+        None is returned if the file has no holes, or they can't be
+        found, or --sparse-files is not used.
+
+        '''
+
+        if not self.may_have_holes(metadata):
+            return None
+        return self.fs.get_data_extents(f, metadata.st_size)
+
+    def may_have_holes(self, metadata):
+        if not self.app.settings['sparse-files']:
+            return False
+        # A file that uses as many blocks as its size requires can't
+        # have holes, so we avoid looking for them.
+        return (metadata.st_blocks is not None and
+                metadata.st_blocks * 512 < metadata.st_size)
+
+    def checksum_chunks(self, chunks):
+        '''Generate (data, checksum) pairs for chunks of data.
+
+        Checksums are computed in self.checksum_pool, a few chunks ahead
+        of the caller. The pairs are returned in the original order.
+        Holes are passed through with a checksum of None.
+
+        '''
+
+        def result(job):
+            return None if job is None else job.result()
+
+        window = 2 * self.checksum_pool.num_workers
+        pending = collections.deque()
+        for data in chunks:
+            if isinstance(data, obnamlib.Hole):
+                job = None
+            else:
+                job = self.checksum_pool.submit(self.repo.checksum, data)
+            pending.append((data, job))
+            if len(pending) > window:
+                data, job = pending.popleft()
+                yield data, result(job)
+        while pending:
+            data, job = pending.popleft()
+            yield data, result(job)
+
+    def append_file_chunks(self, filename, chunkids):
+        '''Append chunk ids to a file, once their uploads have finished.'''
+        chunkids = [self.uploads.wait(x) for x in chunkids]
+        self.repo.append_file_chunks(filename, chunkids)
+
+    def backup_file_chunk(self, data, checksum=None):
+        '''Back up a chunk of data by putting it into the repository.
+
+        If ``checksum`` is not given, it is computed here.
+
+        The chunk may be uploaded in the background. In that case,
+        a WorkerJob is returned instead of a chunk id, and the caller
+        must use ``self.uploads.wait`` to get the real chunk id.
+
+        '''
 
         def find():
             # We ignore lookup errors here intentionally. We're reading
@@ -693,12 +1093,17 @@ class BackupPlugin(obnamlib.ObnamPlugin):
 
         def put():
             self.progress.update_progress_with_upload(len(data))
-            return self.repo.put_chunk_only(data)
+            return self.uploads.put(self.repo.put_chunk_only, data)
 
         def share(chunkid):
-            self.chunkid_pool.add(chunkid, checksum)
+            self.uploads.share(chunkid, checksum)
+
+        if checksum is None:
+            checksum = self.repo.checksum(data)
 
-        checksum = self.repo.checksum(data)
+        # If a chunk with the same checksum is still being uploaded,
+        # wait for it, so that it can be found in the ChunkidPool.
+        self.uploads.wait_for_checksum(checksum)
 
         mode = self.app.settings['deduplicate']
         if mode == 'never':
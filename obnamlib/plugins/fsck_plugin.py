@@ -62,6 +62,17 @@ class CheckChunk(WorkItem):
         self.chunkids_seen.add(self.chunkid)
 
 
+class CheckHole(WorkItem):
+
+    def __init__(self, hole, checksummer):
+        self.hole = hole
+        self.checksummer = checksummer
+        self.name = 'hole of %d bytes' % hole.size
+
+    def do(self):
+        self.checksummer.hole(self.hole.size)
+
+
 class CheckFileChecksum(WorkItem):
 
     def __init__(self, filename, correct, chunkids, checksummer):
@@ -93,9 +104,12 @@ class CheckFile(WorkItem):
             self.repo.open_client(self.client_name)
         if self.metadata.isfile() and not self.settings['fsck-ignore-chunks']:
             chunkids = self.repo.get_file_chunks(self.genid, self.filename)
-            checksummer = self.repo.new_checksummer()
+            checksummer = self.repo.new_file_checksummer()
             for chunkid in chunkids:
-                yield CheckChunk(chunkid, checksummer)
+                if isinstance(chunkid, obnamlib.Hole):
+                    yield CheckHole(chunkid, checksummer)
+                else:
+                    yield CheckChunk(chunkid, checksummer)
             yield CheckFileChecksum(
                 self.name, self.metadata.md5, chunkids, checksummer)
 
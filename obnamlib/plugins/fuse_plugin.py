@@ -84,10 +84,7 @@ class ObnamFuseFile(object):
             if not stat.S_ISREG(self.metadata.st_mode):
                 raise IOError(errno.EINVAL, 'Invalid argument')
 
-            self.chunkids = None
-            self.chunksize = None
-            self.lastdata = None
-            self.lastblock = None
+            self.reader = None
         except:
             logging.error('Unexpected exception', exc_info=True)
             raise
@@ -117,64 +114,14 @@ class ObnamFuseFile(object):
             if contents is not None:
                 return contents[offset:offset+length]
 
-            # stored in chunks
-            if not self.chunkids:
-                self.chunkids = repo.get_file_chunks(gen, repopath)
-
-            if len(self.chunkids) == 1:
-                if not self.lastdata:
-                    self.lastdata = repo.get_chunk(self.chunkids[0])
-                return self.lastdata[offset:offset+length]
-            else:
-                chunkdata = None
-                if not self.chunksize:
-                    # take the cached value as the first guess for chunksize
-                    self.chunksize = self.fs.sizecache.get(gen, self.fs.chunksize)
-                    blocknum = offset/self.chunksize
-                    blockoffs = offset - blocknum*self.chunksize
-
-                    # read a chunk if guessed blocknum and chunksize make sense
-                    if blocknum < len(self.chunkids):
-                        chunkdata = repo.get_chunk(self.chunkids[blocknum])
-                    else:
-                        chunkdata = ''
-
-                    # check if chunkdata is of expected length
-                    validate = min(self.chunksize, self.metadata.st_size - blocknum*self.chunksize)
-                    if validate != len(chunkdata):
-                        if blocknum < len(self.chunkids)-1:
-                            # the length of all but last chunks is chunksize
-                            self.chunksize = len(chunkdata)
-                        else:
-                            # guessing failed, get the length of the first chunk
-                            self.chunksize = len(repo.get_chunk(self.chunkids[0]))
-                        chunkdata = None
-
-                    # save correct chunksize
-                    self.fs.sizecache[gen] = self.chunksize
-
-                if not chunkdata:
-                    blocknum = offset/self.chunksize
-                    blockoffs = offset - blocknum*self.chunksize
-                    if self.lastblock == blocknum:
-                        chunkdata = self.lastdata
-                    else:
-                        chunkdata = repo.get_chunk(self.chunkids[blocknum])
-
-                output = []
-                while True:
-                    output.append(chunkdata[blockoffs:blockoffs+length])
-                    readlength = len(chunkdata) - blockoffs
-                    if length > readlength and blocknum < len(self.chunkids)-1:
-                        length -= readlength
-                        blocknum += 1
-                        blockoffs = 0
-                        chunkdata = repo.get_chunk(self.chunkids[blocknum])
-                    else:
-                        self.lastblock = blocknum
-                        self.lastdata = chunkdata
-                        break
-                return ''.join(output)
+            # stored in chunks, of any size
+            if self.reader is None:
+                if len(self.fs.chunk_sizes) > self.fs.MAX_CHUNK_SIZE_CACHE:
+                    self.fs.chunk_sizes.clear()
+                self.reader = obnamlib.ChunkReader(
+                    repo.get_file_chunks(gen, repopath), repo.get_chunk,
+                    self.fs.chunk_sizes)
+            return self.reader.read(offset, length)
         except (OSError, IOError), e:
             logging.debug('FUSE Expected exception')
             raise
@@ -184,7 +131,7 @@ class ObnamFuseFile(object):
 
     def release(self, flags):
         logging.debug('FUSE file release %d', flags)
-        self.lastdata = None
+        self.reader = None
         return 0
 
     def fsync(self, isfsyncfile):
@@ -210,6 +157,7 @@ class ObnamFuse(fuse.Fuse):
     '''
 
     MAX_METADATA_CACHE = 512
+    MAX_CHUNK_SIZE_CACHE = 64 * 1024
 
     def sigUSR1(self):
         if self.obnam.app.settings['viewmode'] == 'multiple':
@@ -220,6 +168,7 @@ class ObnamFuse(fuse.Fuse):
             self.obnam.repo = repo
             self.rootstat, self.rootlist = self.multiple_root_list(generations)
             self.metadatacache.clear()
+            self.chunk_sizes.clear()
 
     def get_metadata(self, path):
         #logging.debug('FUSE get_metadata(%s)', path)
@@ -346,8 +295,7 @@ class ObnamFuse(fuse.Fuse):
         ObnamFuseFile.fs = self
         self.file_class = ObnamFuseFile
         self.metadatacache = {}
-        self.chunksize = self.obnam.app.settings['chunk-size']
-        self.sizecache = {}
+        self.chunk_sizes = {}
         self.rootlist = None
         self.rootstat = None
         self.init_root()
@@ -14,9 +14,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import logging
 import os
 import stat
+import sys
 import time
 import ttystatus
 
@@ -61,14 +63,56 @@ class RestorePlugin(obnamlib.ObnamPlugin):
     # The './' business is necessary because os.path.join(a,b) returns
     # just b if b is an absolute path.
 
+    # How many files to keep open when restoring in chunk order.
+    max_open_files = 64
+
     def enable(self):
         self.app.add_subcommand('restore', self.restore,
                                 arg_synopsis='[DIRECTORY]...')
         self.app.settings.string(['to'], 'where to restore')
+        self.app.settings.string(['to-tar'],
+                                 'restore into a tar archive FILE, '
+                                    'or to the standard output if FILE '
+                                    'is "-", instead of a directory',
+                                 metavar='FILE')
         self.app.settings.string_list(['generation'],
                                 'which generation to restore',
                                  default=['latest'])
 
+        perf_group = obnamlib.option_group['perf']
+        self.app.settings.integer(['restore-workers'],
+                                  'fetch chunks from the repository with '
+                                    'NUM background threads, while '
+                                    'writing earlier chunks; use 0 to '
+                                    'fetch them serially (%default)',
+                                  metavar='NUM',
+                                  default=obnamlib.DEFAULT_RESTORE_WORKERS,
+                                  group=perf_group)
+        self.app.settings.bytesize(['restore-window'],
+                                   'fetch at most SIZE bytes of chunks ahead '
+                                    'of the chunk being written (%default)',
+                                   metavar='SIZE',
+                                   default=obnamlib.DEFAULT_RESTORE_WINDOW,
+                                   group=perf_group)
+        self.app.settings.integer(['restore-file-workers'],
+                                  'restore small files with NUM background '
+                                    'threads, several files at a time; '
+                                    'use 0 to restore one file at a time '
+                                    '(%default)',
+                                  metavar='NUM',
+                                  default=obnamlib.DEFAULT_RESTORE_FILE_WORKERS,
+                                  group=perf_group)
+        self.app.settings.choice(['restore-order'],
+                                 ['tree', 'chunk'],
+                                 'order in which to restore file contents: '
+                                    'file by file, in the order of the '
+                                    'directory tree (the default), or all '
+                                    'files at once, in the order the chunks '
+                                    'are stored in the repository, fetching '
+                                    'each chunk only once even if many '
+                                    'files use it',
+                                 group=perf_group)
+
     @property
     def write_ok(self):
         return not self.app.settings['dry-run']
@@ -91,11 +135,13 @@ class RestorePlugin(obnamlib.ObnamPlugin):
         self.app.settings.require('repository')
         self.app.settings.require('client-name')
         self.app.settings.require('generation')
-        self.app.settings.require('to')
+        to_tar = self.app.settings['to-tar']
+        if not to_tar:
+            self.app.settings.require('to')
 
         logging.debug('restoring generation %s' %
                         self.app.settings['generation'])
-        logging.debug('restoring to %s' % self.app.settings['to'])
+        logging.debug('restoring to %s' % (to_tar or self.app.settings['to']))
 
         logging.debug('restoring what: %s' % repr(args))
         if not args:
@@ -108,7 +154,8 @@ class RestorePlugin(obnamlib.ObnamPlugin):
 
         self.repo = self.app.open_repository()
         self.repo.open_client(self.app.settings['client-name'])
-        if self.write_ok:
+        self.app.open_chunk_cache(self.repo)
+        if self.write_ok and not to_tar:
             self.fs = self.app.fsf.new(self.app.settings['to'], create=True)
             self.fs.connect()
         else:
@@ -116,6 +163,21 @@ class RestorePlugin(obnamlib.ObnamPlugin):
 
         self.hardlinks = Hardlinks()
 
+        # Fetch jobs only carry chunk ids; the memory used by fetched
+        # chunks is bounded by --restore-window instead.
+        self.fetch_pool = obnamlib.WorkerPool(
+            self.app.settings['restore-workers'], max_pending=1024)
+        self.file_pool = obnamlib.WorkerPool(
+            self.app.settings['restore-file-workers'])
+        self.file_jobs = collections.deque()
+        self.dirs = []
+        if (self.app.settings['restore-order'] == 'chunk' and
+            self.write_ok and not to_tar):
+            self.plan = obnamlib.RestorePlan()
+        else:
+            self.plan = None
+        self.planned = []
+
         self.errors = False
 
         generations = self.app.settings['generation']
@@ -131,12 +193,25 @@ class RestorePlugin(obnamlib.ObnamPlugin):
 
         self.app.dump_memory_profile('at beginning after setup')
 
-        for arg in args:
-            self.restore_something(gen, arg)
-            self.app.dump_memory_profile('at restoring %s' % repr(arg))
-
+        try:
+            if to_tar:
+                self.export_tar(gen, args, to_tar)
+            else:
+                for arg in args:
+                    self.restore_something(gen, arg)
+                    self.app.dump_memory_profile(
+                        'at restoring %s' % repr(arg))
+            self.finish_file_jobs(0)
+            if self.plan is not None:
+                self.restore_planned_files()
+            self.restore_dir_metadata()
+        finally:
+            self.file_pool.close()
+            self.fetch_pool.close()
+
+        self.repo.close_chunk_cache()
         self.repo.fs.close()
-        if self.write_ok:
+        if self.fs is not None:
             self.fs.close()
 
         self.app.ts.clear()
@@ -162,6 +237,8 @@ class RestorePlugin(obnamlib.ObnamPlugin):
             set_metadata = True
             if metadata.isdir():
                 self.restore_dir(gen, pathname, metadata)
+                self.finish_dir(pathname, metadata)
+                set_metadata = False
             elif metadata.islink():
                 self.restore_symlink(gen, pathname, metadata)
             elif metadata.st_nlink > 1:
@@ -171,25 +248,181 @@ class RestorePlugin(obnamlib.ObnamPlugin):
                     set_metadata = False
                 else:
                     self.hardlinks.add(pathname, metadata)
-                    self.restore_first_link(gen, pathname, metadata)
+                    if (self.plan is not None and
+                        stat.S_ISREG(metadata.st_mode)):
+                        set_metadata = not self.plan_regular_file(
+                            gen, pathname, metadata)
+                    else:
+                        self.restore_first_link(gen, pathname, metadata)
+            elif stat.S_ISREG(metadata.st_mode) and self.plan is not None:
+                set_metadata = not self.plan_regular_file(
+                    gen, pathname, metadata)
+            elif stat.S_ISREG(metadata.st_mode) and self.write_ok:
+                set_metadata = not self.start_regular_file(
+                    gen, pathname, metadata)
             else:
                 self.restore_first_link(gen, pathname, metadata)
             if set_metadata and self.write_ok:
-                try:
-                    obnamlib.set_metadata(self.fs, './' + pathname, metadata)
-                except (IOError, OSError), e:
-                    msg = ('Could not set metadata: %s: %d: %s' %
-                            (pathname, e.errno, e.strerror))
-                    logging.error(msg)
-                    self.app.ts.notify(msg)
-                    self.errors = True
+                self.report_error(self.set_file_metadata(pathname, metadata))
         except Exception, e:
-            # Reaching this code path means we've hit a bug, so we log a full traceback.
-            msg = "Failed to restore %s:" % (pathname,)
-            logging.exception(msg)
-            self.app.ts.notify(msg + " " + str(e))
+            self.report_failure(pathname, e)
+
+    def report_error(self, msg):
+        if msg is not None:
+            logging.error(msg)
+            self.app.ts.notify(msg)
             self.errors = True
 
+    def report_failure(self, pathname, e):
+        # Reaching this code path means we've hit a bug, so we log a full traceback.
+        msg = "Failed to restore %s:" % (pathname,)
+        logging.exception(msg)
+        self.app.ts.notify(msg + " " + str(e))
+        self.errors = True
+
+    def set_file_metadata(self, pathname, metadata):
+        '''Set metadata of a restored file, return error message or None.'''
+        try:
+            obnamlib.set_metadata(self.fs, './' + pathname, metadata)
+        except (IOError, OSError), e:
+            return ('Could not set metadata: %s: %d: %s' %
+                    (pathname, e.errno, e.strerror))
+        return None
+
+    def finish_dir(self, pathname, metadata):
+        '''Set metadata of a directory after the files in it are written.
+
+        The walk returns a directory after its contents, but files may
+        still be written in the background, so the directory is queued
+        behind them. In chunk order, files are written only after the
+        walk, so all directories wait until the end.
+
+        '''
+
+        if not self.write_ok:
+            pass
+        elif self.plan is not None:
+            self.dirs.append((pathname, metadata))
+        elif self.file_jobs:
+            self.file_jobs.append((pathname, metadata, None))
+        else:
+            self.report_error(self.set_file_metadata(pathname, metadata))
+
+    def restore_dir_metadata(self):
+        if self.write_ok:
+            for pathname, metadata in self.dirs:
+                self.report_error(self.set_file_metadata(pathname, metadata))
+        self.dirs = []
+
+    def export_tar(self, gen, args, filename):
+        '''Write files from a generation into a tar archive.
+
+        The archive is written as a stream, so it may go to a pipe.
+
+        '''
+
+        if not self.write_ok:
+            f = open(os.devnull, 'wb')
+        elif filename == '-':
+            f = sys.stdout
+        else:
+            f = open(filename, 'wb')
+
+        writer = obnamlib.TarWriter(f)
+        try:
+            for arg in args:
+                for pathname, metadata in self.repo.walk(gen, arg):
+                    self.file_count += 1
+                    self.app.ts['current'] = pathname
+                    try:
+                        self.export_tar_entry(writer, gen, pathname, metadata)
+                    except Exception, e:
+                        self.report_failure(pathname, e)
+                self.app.dump_memory_profile('at exporting %s' % repr(arg))
+            writer.close()
+        finally:
+            if f is sys.stdout:
+                f.flush()
+            else:
+                f.close()
+
+    def export_tar_entry(self, writer, gen, pathname, metadata):
+        # Names in tar archives are relative.
+        name = pathname.lstrip('/')
+        if not name:
+            return
+
+        if metadata.isdir():
+            writer.add_directory(name, metadata)
+        elif metadata.islink():
+            writer.add_symlink(name, metadata)
+        elif metadata.st_nlink > 1 and self.hardlinks.filename(metadata):
+            writer.add_hardlink(name, self.hardlinks.filename(metadata),
+                                metadata)
+            self.hardlinks.forget(metadata)
+        elif stat.S_ISREG(metadata.st_mode):
+            if metadata.st_nlink > 1:
+                self.hardlinks.add(name, metadata)
+            self.export_tar_file(writer, gen, pathname, name, metadata)
+        elif stat.S_ISSOCK(metadata.st_mode):
+            logging.info('Not putting socket %s into tar archive' % pathname)
+        else:
+            writer.add_special(name, metadata)
+
+    def export_tar_file(self, writer, gen, pathname, name, metadata):
+        summer = self.repo.new_file_checksummer()
+        contents = self.repo.get_file_data(gen, pathname)
+        if contents is not None:
+            summer.update(contents)
+            self.downloaded_bytes += len(contents)
+            writer.add_file(name, metadata, [contents])
+        else:
+            chunkids = self.repo.get_file_chunks(gen, pathname)
+            data = self.export_chunk_data(chunkids, summer)
+            if [x for x in chunkids if isinstance(x, obnamlib.Hole)]:
+                regions = self.sparse_regions(chunkids, metadata.st_size)
+                writer.add_sparse_file(name, metadata, regions, data)
+            else:
+                writer.add_file(name, metadata, data)
+
+        if summer.digest() != metadata.md5:
+            self.report_error('File checksum restore error: %s' % pathname)
+
+    def export_chunk_data(self, chunkids, checksummer):
+        '''Generate the data of a file's chunks, leaving out holes.'''
+        fetched = obnamlib.prefetch(self.fetch_pool, self.fetch_chunk,
+                                    chunkids,
+                                    self.app.settings['restore-window'],
+                                    size=self.fetched_size)
+        for chunkid, data, checksum in fetched:
+            if isinstance(chunkid, obnamlib.Hole):
+                checksummer.hole(chunkid.size)
+                self.app.ts['current-bytes'] += chunkid.size
+                continue
+            self.verify_chunk_checksum(checksum, chunkid)
+            checksummer.update(data)
+            self.downloaded_bytes += len(data)
+            self.app.ts['current-bytes'] += len(data)
+            yield data
+
+    def sparse_regions(self, chunkids, size):
+        '''Return (offset, length) pairs for the data in a sparse file.'''
+
+        # Holes know where they are in the file, so the data is
+        # whatever is between them, and no chunks need to be read.
+        regions = []
+        offset = 0
+        for chunkid in chunkids:
+            if isinstance(chunkid, obnamlib.Hole):
+                if chunkid.offset > offset:
+                    regions.append((offset, chunkid.offset - offset))
+                offset = chunkid.offset + chunkid.size
+        if offset < size:
+            regions.append((offset, size - offset))
+        if not regions or sum(regions[-1]) < size:
+            regions.append((size, 0))
+        return regions
+
     def restore_dir(self, gen, root, metadata):
         logging.debug('restoring dir %s' % root)
         if self.write_ok:
@@ -221,11 +454,231 @@ class RestorePlugin(obnamlib.ObnamPlugin):
             logging.error(msg)
             self.app.ts.notify(msg)
 
+    def start_regular_file(self, gen, filename, metadata):
+        '''Start restoring a regular file in the file workers.
+
+        Only files with at most one chunk are restored in the
+        background; larger files are restored right away, fetching
+        their chunks in parallel instead. The B-trees are only used
+        here, in the main thread, since they are not thread-safe.
+
+        Return True if the file was started in the background. Its
+        metadata will then be set by the worker.
+
+        '''
+
+        contents = self.repo.get_file_data(gen, filename)
+        chunkid = None
+        wanted = None
+        if contents is None:
+            chunkids = self.repo.get_file_chunks(gen, filename)
+            if len(chunkids) > 1 or (
+                    chunkids and isinstance(chunkids[0], obnamlib.Hole)):
+                self.restore_regular_file(gen, filename, metadata)
+                return False
+            if chunkids:
+                chunkid = chunkids[0]
+                try:
+                    wanted = self.repo.get_chunk_checksum(chunkid)
+                except KeyError:
+                    pass
+
+        logging.debug('restoring regular %s in background' % filename)
+        job = self.file_pool.submit(self.write_small_file, filename,
+                                    metadata, contents, chunkid, wanted)
+        self.file_jobs.append((filename, metadata, job))
+        self.finish_file_jobs(self.file_pool.max_pending)
+        return True
+
+    def write_small_file(self, filename, metadata, contents, chunkid, wanted):
+        '''Write a file from its contents or only chunk, and set metadata.
+
+        This is run in the file workers, so it does not report errors
+        itself, but returns the number of bytes fetched from the
+        repository, and a list of error messages.
+
+        '''
+
+        errors = []
+        if contents is None:
+            contents = ''
+            if chunkid is not None:
+                try:
+                    contents = self.repo.get_chunk(chunkid)
+                except obnamlib.MissingFilterError:
+                    errors.append(
+                        'Missing filter error during restore: %s' % filename)
+                else:
+                    if wanted is not None:
+                        self.verify_chunk_checksum(
+                            self.repo.checksum(contents), chunkid, wanted)
+
+        f = self.fs.open('./' + filename, 'wb')
+        f.write(contents)
+        f.close()
+
+        summer = self.repo.new_file_checksummer()
+        summer.update(contents)
+        if summer.digest() != metadata.md5:
+            errors.append('File checksum restore error: %s' % filename)
+
+        msg = self.set_file_metadata(filename, metadata)
+        if msg is not None:
+            errors.append(msg)
+        return len(contents), errors
+
+    def finish_file_jobs(self, keep):
+        '''Report on finished file jobs, waiting until at most keep are left.
+
+        Directories queued by finish_dir have no job: all files before
+        them have been written, so their metadata is set now.
+
+        '''
+
+        while self.file_jobs and (len(self.file_jobs) > keep or
+                                  self.file_jobs[0][2] is None or
+                                  self.file_jobs[0][2].done()):
+            filename, metadata, job = self.file_jobs.popleft()
+            if job is None:
+                self.report_error(self.set_file_metadata(filename, metadata))
+                continue
+            try:
+                downloaded, errors = job.result()
+            except Exception, e:
+                self.report_failure(filename, e)
+                continue
+            self.downloaded_bytes += downloaded
+            self.app.ts['current-bytes'] += downloaded
+            for msg in errors:
+                self.report_error(msg)
+
+    def plan_regular_file(self, gen, filename, metadata):
+        '''Add a regular file to the chunk order restore plan.
+
+        The file is created right away, but empty, so that hard links
+        to it can be made. Return True if the file was added to the
+        plan. Its contents and metadata are then restored by
+        restore_planned_files.
+
+        '''
+
+        if self.repo.get_file_data(gen, filename) is not None:
+            self.restore_regular_file(gen, filename, metadata)
+            return False
+        logging.debug('planning restore of %s' % filename)
+        chunkids = self.repo.get_file_chunks(gen, filename)
+        f = self.fs.open('./' + filename, 'wb')
+        f.close()
+        self.plan.add_file(chunkids)
+        self.planned.append((filename, metadata))
+        return True
+
+    def restore_planned_files(self):
+        '''Restore contents of planned files, in chunk order.
+
+        Python 2 has no pwrite, so chunks are written with seek and
+        write, keeping a few of the files open.
+
+        '''
+
+        window = self.app.settings['restore-window']
+        self.open_files = collections.OrderedDict()
+        self.zeroes = ''
+        try:
+            chunkids = self.plan.chunkids()
+            while chunkids:
+                logging.debug('fetching %d chunks for planned files' %
+                              len(chunkids))
+                fetched = obnamlib.prefetch(self.fetch_pool, self.fetch_chunk,
+                                            chunkids, window,
+                                            size=self.fetched_size)
+                self.plan.run(self.verified_chunks(fetched),
+                              self.write_planned, window)
+                chunkids = self.plan.chunkids()
+        except Exception, e:
+            self.report_failure(self.app.settings['to'], e)
+        finally:
+            for f in self.open_files.values():
+                f.close()
+            self.open_files = None
+
+        for index, (filename, metadata) in enumerate(self.planned):
+            self.app.ts['current'] = filename
+            try:
+                self.finish_planned_file(index, filename, metadata)
+            except Exception, e:
+                self.report_failure(filename, e)
+        self.plan = None
+        self.planned = []
+
+    def verified_chunks(self, fetched):
+        for chunkid, data, checksum in fetched:
+            try:
+                self.verify_chunk_checksum(checksum, chunkid)
+            except obnamlib.Error, e:
+                self.report_error(str(e))
+            self.downloaded_bytes += len(data)
+            yield chunkid, data
+
+    def open_planned_file(self, index):
+        if index in self.open_files:
+            f = self.open_files.pop(index)
+        else:
+            if len(self.open_files) >= self.max_open_files:
+                old_index, old_f = self.open_files.popitem(last=False)
+                old_f.close()
+            filename = self.planned[index][0]
+            self.app.ts['current'] = filename
+            f = self.fs.open('./' + filename, 'r+b')
+        self.open_files[index] = f
+        return f
+
+    def write_planned(self, index, offset, data):
+        self.app.ts['current-bytes'] += len(data)
+        if len(data) != len(self.zeroes):
+            self.zeroes = '\0' * len(data)
+        if data == self.zeroes:
+            # finish_planned_file extends the file to its full size,
+            # so there is no need to write zeroes.
+            return
+        f = self.open_planned_file(index)
+        f.seek(offset)
+        f.write(data)
+
+    def finish_planned_file(self, index, filename, metadata):
+        size = self.plan.file_size(index)
+        if size is not None:
+            f = self.fs.open('./' + filename, 'r+b')
+            f.truncate(size)
+            f.close()
+
+        # The contents were not written in order, so the whole file
+        # checksum is computed by reading the file back. Holes are
+        # not read.
+        summer = self.repo.new_file_checksummer()
+        f = self.fs.open('./' + filename, 'rb')
+        for offset, length, is_hole in self.plan.file_regions(index):
+            if is_hole:
+                summer.hole(length)
+                continue
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, 1024**2))
+                if not data:
+                    break
+                summer.update(data)
+                length -= len(data)
+        f.close()
+        if summer.digest() != metadata.md5:
+            self.report_error('File checksum restore error: %s' % filename)
+
+        self.report_error(self.set_file_metadata(filename, metadata))
+
     def restore_regular_file(self, gen, filename, metadata):
         logging.debug('restoring regular %s' % filename)
         if self.write_ok:
             f = self.fs.open('./' + filename, 'wb')
-            summer = self.repo.new_checksummer()
+            summer = self.repo.new_file_checksummer()
 
             try:
                 contents = self.repo.get_file_data(gen, filename)
@@ -250,12 +703,37 @@ class RestorePlugin(obnamlib.ObnamPlugin):
                 self.app.ts.notify(msg)
                 self.errors = True
 
+    def fetch_chunk(self, chunkid):
+        '''Fetch a chunk and compute its checksum.
+
+        This is run in the fetch workers. Holes are passed through.
+
+        '''
+
+        if isinstance(chunkid, obnamlib.Hole):
+            return chunkid, None, None
+        data = self.repo.get_chunk(chunkid)
+        return chunkid, data, self.repo.checksum(data)
+
+    def fetched_size(self, fetched):
+        data = fetched[1]
+        return 0 if data is None else len(data)
+
     def restore_chunks(self, f, chunkids, checksummer):
         zeroes = ''
         hole_at_end = False
-        for chunkid in chunkids:
-            data = self.repo.get_chunk(chunkid)
-            self.verify_chunk_checksum(data, chunkid)
+        fetched = obnamlib.prefetch(self.fetch_pool, self.fetch_chunk,
+                                    chunkids,
+                                    self.app.settings['restore-window'],
+                                    size=self.fetched_size)
+        for chunkid, data, checksum in fetched:
+            if isinstance(chunkid, obnamlib.Hole):
+                checksummer.hole(chunkid.size)
+                f.seek(chunkid.size, 1)
+                hole_at_end = True
+                self.app.ts['current-bytes'] += chunkid.size
+                continue
+            self.verify_chunk_checksum(checksum, chunkid)
             checksummer.update(data)
             self.downloaded_bytes += len(data)
             if len(data) != len(zeroes):
@@ -273,14 +751,14 @@ class RestorePlugin(obnamlib.ObnamPlugin):
                 f.seek(-1, 1)
                 f.write('\0')
 
-    def verify_chunk_checksum(self, data, chunkid):
-        checksum = self.repo.checksum(data)
-        try:
-            wanted = self.repo.chunklist.get_checksum(chunkid)
-        except KeyError:
-            # Chunk might not be in the tree, but that does not
-            # mean it is invalid. We'll assume it is valid.
-            return
+    def verify_chunk_checksum(self, checksum, chunkid, wanted=None):
+        if wanted is None:
+            try:
+                wanted = self.repo.get_chunk_checksum(chunkid)
+            except KeyError:
+                # Chunk might not be in the tree, but that does not
+                # mean it is invalid. We'll assume it is valid.
+                return
         if checksum != wanted:
             raise obnamlib.Error('chunk %s checksum error' % chunkid)
 
@@ -536,7 +536,7 @@ class SftpFS(obnamlib.VirtualFileSystem):
             if not chunk:
                 break
             chunks.append(chunk)
-            self.bytes_read += len(chunk)
+            self._count_read(len(chunk))
         f.close()
         return ''.join(chunks)
 
@@ -554,12 +554,30 @@ class SftpFS(obnamlib.VirtualFileSystem):
             if e.errno != errno.ENOENT and e.errno != errno.EACCES:
                 raise
             dirname = os.path.dirname(pathname)
-            self.makedirs(dirname)
+            self._create_missing_dirs(dirname)
             f = self.open(pathname, 'wx')
 
         self._write_helper(f, contents)
         f.close()
 
+    def _create_missing_dirs(self, dirname):
+        '''Like makedirs, but OK if some or all directories exist.
+
+        Several threads may be writing files into the same new
+        directory, and SFTP servers do not report a directory that
+        already exists with EEXIST, so check for it after a failure.
+
+        '''
+
+        if not dirname or self.isdir(dirname):
+            return
+        self._create_missing_dirs(os.path.dirname(dirname))
+        try:
+            self.mkdir(dirname)
+        except OSError:
+            if not self.isdir(dirname):
+                raise
+
     def _tempfile(self, dirname):
         '''Create a new file with a random name, return file handle and name.'''
 
@@ -597,7 +615,7 @@ class SftpFS(obnamlib.VirtualFileSystem):
         for pos in range(0, len(contents), self.chunk_size):
             chunk = contents[pos:pos + self.chunk_size]
             f.write(chunk)
-            self.bytes_written += len(chunk)
+            self._count_written(len(chunk))
 
 
 class SftpPlugin(obnamlib.ObnamPlugin):
@@ -166,6 +166,11 @@ class VerifyPlugin(obnamlib.ObnamPlugin):
 
     def verify_chunks(self, f, chunkids):
         for chunkid in chunkids:
+            if isinstance(chunkid, obnamlib.Hole):
+                for zeroes in chunkid.zeroes():
+                    if f.read(len(zeroes)) != zeroes:
+                        return False
+                continue
             backed_up = self.repo.get_chunk(chunkid)
             live_data = f.read(len(backed_up))
             if backed_up != live_data:
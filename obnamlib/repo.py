@@ -23,6 +23,7 @@ import random
 import re
 import stat
 import struct
+import threading
 import time
 import tracing
 
@@ -115,7 +116,9 @@ class Repository(object):
 
     The file 'metadata/format' at the root of the repository contains the
     version of the repository format it uses. The version is
-    specified using a single integer.
+    specified using a single integer. It may also name the checksum
+    algorithm for chunks and whole files, which is chosen when the
+    repository is created; the default is MD5.
 
     '''
 
@@ -123,14 +126,20 @@ class Repository(object):
 
     def __init__(self, fs, node_size, upload_queue_size, lru_size, hooks,
                  idpath_depth, idpath_bits, idpath_skip, current_time,
-                 lock_timeout, client_name):
+                 lock_timeout, client_name, pack_size=0,
+                 pack_max_chunk_size=obnamlib.DEFAULT_PACK_MAX_CHUNK_SIZE,
+                 checksum_algorithm=obnamlib.checksum_algorithms[0],
+                 file_id_cache_size=obnamlib.DEFAULT_FILE_ID_CACHE_SIZE):
 
         self.current_time = current_time
         self.setup_hooks(hooks or obnamlib.HookManager())
         self.fs = HookedFS(self, fs, self.hooks)
+        self.checksum_algorithm = self._find_checksum_algorithm(
+            fs, checksum_algorithm)
         self.node_size = node_size
         self.upload_queue_size = upload_queue_size
         self.lru_size = lru_size
+        self.file_id_cache_size = file_id_cache_size
 
         hider = hashlib.md5()
         hider.update(client_name)
@@ -151,9 +160,25 @@ class Repository(object):
         self.client = None
         self._open_shared()
         self.prev_chunkid = None
+        self._chunkid_lock = threading.Lock()
+        self.chunk_cache = None
         self.chunk_idpath = larch.IdPath('chunks', idpath_depth,
                                          idpath_bits, idpath_skip)
         self._chunks_exists = False
+        self.pack_size = pack_size
+        self.pack_max_chunk_size = pack_max_chunk_size
+        self.packs = obnamlib.PackStore(
+            fs, os.path.join(self.chunk_idpath.dirname, 'packs'), pack_size,
+            encode=self._encode_packed_chunk,
+            decode=self._decode_packed_chunk)
+
+    def _encode_packed_chunk(self, data):
+        return self.hooks.filter_write('repository-data', data, repo=self,
+                                       toplevel=self.chunk_idpath.dirname)
+
+    def _decode_packed_chunk(self, data):
+        return self.hooks.filter_read('repository-data', data, repo=self,
+                                      toplevel=self.chunk_idpath.dirname)
 
     def _open_client_list(self):
         self.clientlist = obnamlib.ClientList(self.fs, self.node_size,
@@ -170,6 +195,29 @@ class Repository(object):
                                                self.upload_queue_size,
                                                self.lru_size, self)
 
+    def _shared_trees_stamp(self, root_ids):
+        return ' '.join(str(x) for x in root_ids)
+
+    def open_chunk_cache(self, filename):
+        '''Use a local cache of the shared chunk indexes.
+
+        See obnamlib.ChunkIndexCache. The cache is used by find_chunks
+        and get_chunk_checksum.
+
+        '''
+
+        stamp = self._shared_trees_stamp(
+            [self.chunksums.newest_root_id(),
+             self.chunklist.newest_root_id()])
+        self.chunk_cache = obnamlib.ChunkIndexCache(filename, stamp)
+
+    def close_chunk_cache(self):
+        '''Stop using the local cache of the shared chunk indexes.'''
+        if self.chunk_cache is not None:
+            logging.info('Chunk index cache hits: %d' % self.chunk_cache.hits)
+            self.chunk_cache.close()
+            self.chunk_cache = None
+
     def setup_hooks(self, hooks):
         self.hooks = hooks
 
@@ -177,10 +225,19 @@ class Repository(object):
         self.hooks.new_filter('repository-data')
         self.hooks.new('repository-add-client')
 
+    def _find_checksum_algorithm(self, fs, wanted):
+        # fs is None when the App creates a Repository just to get
+        # the hooks defined.
+        if fs is not None:
+            data = self._read_format_file()
+            if data is not None:
+                return obnamlib.parse_checksum_algorithm(data)
+        return wanted
+
     def checksum(self, data):
         '''Return checksum of data.
 
-        The checksum is (currently) MD5.
+        The checksum algorithm is chosen when the repository is created.
 
         '''
 
@@ -190,7 +247,11 @@ class Repository(object):
 
     def new_checksummer(self):
         '''Return a new checksum algorithm.'''
-        return hashlib.md5()
+        return obnamlib.new_checksummer(self.checksum_algorithm)
+
+    def new_file_checksummer(self):
+        '''Return a new obnamlib.FileChecksummer for whole files.'''
+        return obnamlib.FileChecksummer(self.checksum_algorithm)
 
     def acceptable_version(self, version):
         '''Are we compatible with on-disk format?'''
@@ -306,10 +367,9 @@ class Repository(object):
 
         '''
 
-        if self.fs.exists('metadata/format'):
-            data = self.fs.cat('metadata/format', runfilters=False)
-            lines = data.splitlines()
-            line = lines[0]
+        data = self._read_format_file()
+        if data is not None:
+            line = obnamlib.parse_format_version(data)
             try:
                 version = int(line)
             except ValueError, e: # pragma: no cover
@@ -321,13 +381,20 @@ class Repository(object):
         else:
             return None
 
+    def _read_format_file(self):
+        if self.fs.exists('metadata/format'):
+            return self.fs.cat('metadata/format', runfilters=False)
+        return None
+
     def _write_format_version(self, version):
         '''Write the desired format version to the repository.'''
         tracing.trace('write format version')
         if not self.fs.exists('metadata'):
             self.fs.mkdir('metadata')
-        self.fs.overwrite_file('metadata/format', '%s\n' % version,
-                               runfilters=False)
+        self.fs.overwrite_file(
+            'metadata/format',
+            obnamlib.format_file_contents(version, self.checksum_algorithm),
+            runfilters=False)
 
     def check_format_version(self):
         '''Verify that on-disk format version is compatbile.
@@ -388,6 +455,14 @@ class Repository(object):
         self.chunksums.start_changes()
         self.chunklist.start_changes()
 
+        if self.chunk_cache is not None:
+            stamp = self._shared_trees_stamp(
+                [self.chunksums.base_root_id, self.chunklist.base_root_id])
+            if stamp != self.chunk_cache.stamp:
+                # Someone else has changed the trees since we opened them.
+                self.chunk_cache.stamp = stamp
+                self.chunk_cache.clear()
+
         # Initialize the chunks directory for encryption, etc, if it just
         # got created.
         dirname = self.chunk_idpath.dirname
@@ -401,8 +476,13 @@ class Repository(object):
 
         tracing.trace('committing shared')
         self.require_shared_lock()
+        self.packs.flush()
         self.chunklist.commit()
         self.chunksums.commit()
+        if self.chunk_cache is not None:
+            self.chunk_cache.set_stamp(self._shared_trees_stamp(
+                [self.chunksums.newest_root_id(),
+                 self.chunklist.newest_root_id()]))
         self.unlock_shared()
 
     def unlock_shared(self):
@@ -412,6 +492,9 @@ class Repository(object):
         self.lockmgr.unlock(self.shared_dirs)
         self.got_shared_lock = False
         self._open_shared()
+        if self.chunk_cache is not None and self.chunk_cache.dirty:
+            # The changes the cache knows about were not committed.
+            self.chunk_cache.clear()
 
     def lock_client(self, client_name):
         '''Lock a client for exclusive write access.
@@ -441,10 +524,9 @@ class Repository(object):
         self.current_client_id = client_id
         self.added_generations = []
         self.removed_generations = []
-        self.client = obnamlib.ClientMetadataTree(self.fs, client_dir,
-                                                  self.node_size,
-                                                  self.upload_queue_size,
-                                                  self.lru_size, self)
+        self.client = obnamlib.ClientMetadataTree(
+            self.fs, client_dir, self.node_size, self.upload_queue_size,
+            self.lru_size, self, file_id_cache_size=self.file_id_cache_size)
         self.client.init_forest()
 
     def unlock_client(self):
@@ -453,6 +535,7 @@ class Repository(object):
         self.require_client_lock()
         self.new_generation = None
         self._really_remove_generations(self.added_generations)
+        self.packs.discard()
         self.lockmgr.unlock([self.client.dirname])
         self.client = None # FIXME: This should remove uncommitted data.
         self.added_generations = []
@@ -471,6 +554,7 @@ class Repository(object):
             self.client.set_current_generation_is_checkpoint(checkpoint)
         self.added_generations = []
         self._really_remove_generations(self.removed_generations)
+        self.packs.flush()
         if commit_client:
             self.client.commit()
         self.unlock_client()
@@ -485,10 +569,9 @@ class Repository(object):
         self.current_client = client_name
         self.current_client_id = client_id
         client_dir = self.client_dir(client_id)
-        self.client = obnamlib.ClientMetadataTree(self.fs, client_dir,
-                                                  self.node_size,
-                                                  self.upload_queue_size,
-                                                  self.lru_size, self)
+        self.client = obnamlib.ClientMetadataTree(
+            self.fs, client_dir, self.node_size, self.upload_queue_size,
+            self.lru_size, self, file_id_cache_size=self.file_id_cache_size)
         self.client.init_forest()
 
     def list_generations(self):
@@ -550,6 +633,8 @@ class Repository(object):
                 else:
                     self.chunksums.remove(checksum, chunk_id,
                                           self.current_client_id)
+                    if self.chunk_cache is not None:
+                        self.chunk_cache.remove(checksum, chunk_id)
                     if not self.chunksums.chunk_is_used(checksum, chunk_id):
                         self.remove_chunk(chunk_id)
 
@@ -594,15 +679,31 @@ class Repository(object):
         self.require_open_client()
         return self.client.listdir(gen, dirname)
 
-    def get_metadata(self, gen, filename):
-        '''Return metadata for a file in a generation.'''
+    def get_metadata(self, gen, filename, fields=None):
+        '''Return metadata for a file in a generation.
+
+        If fields is given, only those fields are decoded, and the
+        others are None.
+
+        '''
 
         self.require_open_client()
         try:
             encoded = self.client.get_metadata(gen, filename)
         except KeyError:
             raise obnamlib.Error('%s does not exist' % filename)
-        return obnamlib.decode_metadata(encoded)
+        return obnamlib.decode_metadata(encoded, fields)
+
+    def prefetch_metadata(self, gen, dirname):
+        '''Read metadata for all files in a directory in a generation.
+
+        This is an optimization only: later calls to get_metadata for
+        files in the directory become cheaper.
+
+        '''
+
+        self.require_open_client()
+        self.client.prefetch_dir(gen, dirname)
 
     def create(self, filename, metadata):
         '''Create a new (empty) file in the new generation.'''
@@ -627,33 +728,56 @@ class Repository(object):
 
         Return the unique identifier of the new chunk.
 
-        '''
+        Chunks of at most pack_max_chunk_size bytes are put into pack
+        files, if pack_size is set. They are written when the pack is
+        full, or when the client is committed.
 
-        def random_chunkid():
-            return random.randint(0, obnamlib.MAX_ID)
+        This method may be called from several threads at once, as long
+        as the generation is not finished meanwhile.
+
+        '''
 
         self.require_started_generation()
 
-        if self.prev_chunkid is None:
-            self.prev_chunkid = random_chunkid()
+        if self.pack_size and len(data) <= self.pack_max_chunk_size:
+            return self.packs.put(data)
 
         while True:
-            chunkid = (self.prev_chunkid + 1) % obnamlib.MAX_ID
+            chunkid = self._allocate_chunkid()
             filename = self._chunk_filename(chunkid)
             try:
                 self.fs.write_file(filename, data)
             except OSError, e: # pragma: no cover
-                if e.errno == errno.EEXIST:
-                    self.prev_chunkid = random_chunkid()
+                # Only a chunk that is already there is a collision;
+                # anything else, such as a directory created by
+                # another thread, is a real error.
+                if e.errno == errno.EEXIST and self.fs.exists(filename):
+                    self._allocate_chunkid(restart=True)
                     continue
                 raise
             else:
                 tracing.trace('chunkid=%s', chunkid)
                 break
 
-        self.prev_chunkid = chunkid
         return chunkid
 
+    def _allocate_chunkid(self, restart=False):
+        '''Return the next unused chunk id.
+
+        Chunk ids are allocated sequentially from a random starting
+        point. If ``restart`` is true, a new random starting point is
+        chosen. Ids reserved for packed chunks are skipped.
+
+        '''
+
+        with self._chunkid_lock:
+            if self.prev_chunkid is None or restart:
+                self.prev_chunkid = random.randint(0, obnamlib.MAX_ID)
+            self.prev_chunkid = (self.prev_chunkid + 1) % obnamlib.MAX_ID
+            while obnamlib.PackStore.is_packed(self.prev_chunkid):
+                self.prev_chunkid = random.randint(0, obnamlib.MAX_ID)
+            return self.prev_chunkid
+
     def put_chunk_in_shared_trees(self, chunkid, checksum):
         '''Put the chunk into the shared trees.
 
@@ -665,21 +789,43 @@ class Repository(object):
 
         tracing.trace('chunkid=%s', chunkid)
         tracing.trace('checksum=%s', repr(checksum))
+        self.put_chunks_in_shared_trees([(chunkid, checksum)])
+
+    def put_chunks_in_shared_trees(self, pairs):
+        '''Put many chunks into the shared trees.
+
+        ``pairs`` is a list of (chunkid, checksum) pairs. This is
+        like calling ``put_chunk_in_shared_trees`` for each pair, but
+        the B-trees are updated in key order, which is much faster
+        for large numbers of chunks, so the shared lock is held for
+        a shorter time.
+
+        '''
+
+        tracing.trace('putting %d chunks in shared trees', len(pairs))
 
         self.require_started_generation()
         self.require_shared_lock()
 
-        self.chunklist.add(chunkid, checksum)
-        self.chunksums.add(checksum, chunkid, self.current_client_id)
+        self.chunklist.add_many(pairs)
+        self.chunksums.add_many([(checksum, chunkid, self.current_client_id)
+                                 for chunkid, checksum in pairs])
+        if self.chunk_cache is not None:
+            for chunkid, checksum in pairs:
+                self.chunk_cache.add(checksum, chunkid)
 
     def get_chunk(self, chunkid):
         '''Return data of chunk with given id.'''
         self.require_open_client()
+        if obnamlib.PackStore.is_packed(chunkid):
+            return self.packs.get(chunkid)
         return self.fs.cat(self._chunk_filename(chunkid))
 
     def chunk_exists(self, chunkid):
         '''Does a chunk exist in the repository?'''
         self.require_open_client()
+        if obnamlib.PackStore.is_packed(chunkid):
+            return self.packs.exists(chunkid)
         return self.fs.exists(self._chunk_filename(chunkid))
 
     def find_chunks(self, checksum):
@@ -690,7 +836,33 @@ class Repository(object):
         '''
 
         self.require_open_client()
-        return self.chunksums.find(checksum)
+        if self.chunk_cache is None:
+            return self.chunksums.find(checksum)
+        chunkids = self.chunk_cache.find(checksum)
+        if chunkids is None:
+            chunkids = self.chunksums.find(checksum)
+            self.chunk_cache.remember_find(checksum, chunkids)
+        return chunkids
+
+    def get_chunk_checksum(self, chunkid):
+        '''Return checksum of chunk with given id.
+
+        Raise KeyError if the chunk is not in the shared B-trees.
+
+        '''
+
+        self.require_open_client()
+        if self.chunk_cache is None:
+            return self.chunklist.get_checksum(chunkid)
+        checksum = self.chunk_cache.get_checksum(chunkid)
+        if checksum is None:
+            try:
+                checksum = self.chunklist.get_checksum(chunkid)
+            except KeyError:
+                self.chunk_cache.remember_checksum(chunkid, None)
+                raise
+            self.chunk_cache.remember_checksum(chunkid, checksum)
+        return checksum
 
     def list_chunks(self):
         '''Return list of ids of all chunks in repository.'''
@@ -701,6 +873,7 @@ class Repository(object):
                 if stat.S_ISREG(st.st_mode) and pat.match(pathname):
                     basename = os.path.basename(pathname)
                     result.append(int(basename, 16))
+        result.extend(self.packs.list_chunk_ids())
         return result
 
     def remove_chunk(self, chunk_id):
@@ -718,9 +891,13 @@ class Repository(object):
         self.require_open_client()
         self.require_shared_lock()
         self.chunklist.remove(chunk_id)
-        filename = self._chunk_filename(chunk_id)
+        if self.chunk_cache is not None:
+            self.chunk_cache.remove(None, chunk_id)
         try:
-            self.fs.remove(filename)
+            if obnamlib.PackStore.is_packed(chunk_id):
+                self.packs.remove(chunk_id)
+            else:
+                self.fs.remove(self._chunk_filename(chunk_id))
         except OSError:
             pass
 
@@ -749,6 +926,29 @@ class Repository(object):
         self.require_started_generation()
         self.client.append_file_chunks(filename, chunkids)
 
+    def index_file_contents(self, filename, size, prefix_hash):
+        '''Add a file to the index of file contents in new generation.
+
+        ``prefix_hash`` is a string of (up to) eight bytes computed
+        from the start of the file. See find_file_by_contents.
+
+        '''
+
+        self.require_started_generation()
+        self.client.set_contents_index(filename, size, prefix_hash)
+
+    def find_file_by_contents(self, gen, size, prefix_hash):
+        '''Find a file that may have given contents in a generation.
+
+        Return a pathname, or None. The file had the given size and
+        prefix hash when it was indexed, but may have changed or been
+        removed since; the caller must check.
+
+        '''
+
+        self.require_open_client()
+        return self.client.find_by_contents(gen, size, prefix_hash)
+
     def set_file_data(self, filename, contents): # pragma: no cover
         '''Store contents of file in B-tree instead of chunks dir.'''
         self.require_started_generation()
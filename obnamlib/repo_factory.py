@@ -62,10 +62,10 @@ class RepositoryFactory(object):
 
     def _read_existing_format(self, fs):
         f = fs.open('metadata/format', 'r')
-        line = f.readline()
+        data = f.read()
         f.close()
 
-        return line.strip()
+        return obnamlib.parse_format_version(data)
 
     def _open_repo(self, klass, fs, kwargs):
         repo = klass(**kwargs)
@@ -93,5 +93,10 @@ class RepositoryFactory(object):
         else:
             raise UnknownRepositoryFormatWanted(wanted_format)
         
-        fs.write_file('metadata/format', '%s\n' % wanted_format.format)
+        fs.write_file(
+            'metadata/format',
+            obnamlib.format_file_contents(
+                wanted_format.format,
+                kwargs.get('checksum_algorithm',
+                           obnamlib.checksum_algorithms[0])))
         return self._open_repo(impl, fs, kwargs)
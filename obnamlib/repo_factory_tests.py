@@ -51,6 +51,16 @@ class RepositoryFormatTests(unittest.TestCase):
         repo = factory.open_existing_repo(fs)
         self.assertTrue(isinstance(repo, good))
 
+    def test_accepts_good_format_with_other_checksum_algorithm(self):
+        good = obnamlib.RepositoryFormat6
+        fs = obnamlib.LocalFS(self.repodir)
+        fs.write_file(
+            'metadata/format',
+            obnamlib.format_file_contents(good.format, 'sha256'))
+        factory = obnamlib.RepositoryFactory()
+        repo = factory.open_existing_repo(fs)
+        self.assertTrue(isinstance(repo, good))
+
     def test_creates_a_new_repository(self):
         good = obnamlib.RepositoryFormat6
         fs = obnamlib.LocalFS(self.repodir)
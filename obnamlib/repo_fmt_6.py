@@ -15,7 +15,6 @@
 
 
 import errno
-import hashlib
 import larch
 import logging
 import os
@@ -97,7 +96,8 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
             idpath_depth=obnamlib.IDPATH_DEPTH,
             idpath_bits=obnamlib.IDPATH_BITS,
             idpath_skip=obnamlib.IDPATH_SKIP,
-            hooks=None):
+            hooks=None,
+            checksum_algorithm=obnamlib.checksum_algorithms[0]):
         self._lock_timeout = lock_timeout
         self._node_size = node_size
         self._upload_queue_size = upload_queue_size
@@ -105,6 +105,7 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
         self._idpath_depth = idpath_depth
         self._idpath_bits = idpath_bits
         self._idpath_skip = idpath_skip
+        self._checksum_algorithm = checksum_algorithm
 
         self._setup_hooks(hooks or obnamlib.HookManager())
         self._setup_chunks()
@@ -117,6 +118,9 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
 
     def set_fs(self, fs):
         self._fs = HookedFS(self, fs, self.hooks)
+        if fs is not None and self._fs.exists('metadata/format'):
+            self._checksum_algorithm = obnamlib.parse_checksum_algorithm(
+                self._fs.cat('metadata/format', runfilters=False))
         self._lockmgr = obnamlib.LockManager(self._fs, self._lock_timeout, '')
         self._setup_client_list()
         self._setup_client()
@@ -449,7 +453,9 @@ class RepositoryFormat6(obnamlib.RepositoryInterface):
     # Chunk indexes.
 
     def _checksum(self, data):
-        return hashlib.md5(data).hexdigest()
+        checksummer = obnamlib.new_checksummer(self._checksum_algorithm)
+        checksummer.update(data)
+        return checksummer.hexdigest()
 
     def _setup_chunk_indexes(self):
         self._got_chunk_indexes_lock = False
@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import hashlib
 import shutil
 import tempfile
 
@@ -31,3 +32,12 @@ class RepositoryFormat6Tests(obnamlib.RepositoryInterfaceTests):
     def tearDown(self):
         shutil.rmtree(self.tempdir)
 
+
+    def test_uses_checksum_algorithm_of_existing_repository(self):
+        fs = obnamlib.LocalFS(self.tempdir)
+        fs.write_file('metadata/format',
+                      obnamlib.format_file_contents(6, 'sha256'))
+        repo = obnamlib.RepositoryFormat6()
+        repo.set_fs(fs)
+        self.assertEqual(repo._checksum('data'),
+                         hashlib.sha256('data').hexdigest())
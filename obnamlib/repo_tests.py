@@ -635,6 +635,17 @@ class RepositoryChunkTests(unittest.TestCase):
         self.repo.put_chunk_in_shared_trees(chunkid, checksum)
         self.assertEqual(self.repo.find_chunks(checksum), [chunkid])
 
+    def test_puts_many_chunks_in_shared_trees(self):
+        self.repo.lock_shared()
+        pairs = []
+        for data in ['foo', 'bar', 'foobar']:
+            chunkid = self.repo.put_chunk_only(data)
+            pairs.append((chunkid, self.repo.checksum(data)))
+        self.repo.put_chunks_in_shared_trees(pairs)
+        for chunkid, checksum in pairs:
+            self.assertEqual(self.repo.find_chunks(checksum), [chunkid])
+            self.assertEqual(self.repo.get_chunk_checksum(chunkid), checksum)
+
     def test_find_chunks_finds_nothing_if_nothing_is_put(self):
         self.assertEqual(self.repo.find_chunks('checksum'), [])
 
@@ -659,6 +670,102 @@ class RepositoryChunkTests(unittest.TestCase):
             chunkids.append(self.repo.put_chunk_only('data'))
         self.assertEqual(sorted(self.repo.list_chunks()), sorted(chunkids))
 
+    def test_uses_md5_by_default(self):
+        self.assertEqual(self.repo.checksum_algorithm, 'md5')
+        self.assertEqual(self.repo.checksum('data'),
+                         hashlib.md5('data').hexdigest())
+
+    def test_keeps_checksum_algorithm_of_existing_repository(self):
+        repo = obnamlib.Repository(self.fs, obnamlib.DEFAULT_NODE_SIZE,
+                                   obnamlib.DEFAULT_UPLOAD_QUEUE_SIZE,
+                                   obnamlib.DEFAULT_LRU_SIZE, None,
+                                   obnamlib.IDPATH_DEPTH,
+                                   obnamlib.IDPATH_BITS,
+                                   obnamlib.IDPATH_SKIP,
+                                   time.time, 0, '',
+                                   checksum_algorithm='sha256')
+        self.assertEqual(repo.checksum_algorithm, 'md5')
+
+    def test_records_checksum_algorithm_of_new_repository(self):
+        fs = obnamlib.LocalFS(os.path.join(self.tempdir, 'new'), create=True)
+        repo = obnamlib.Repository(fs, obnamlib.DEFAULT_NODE_SIZE,
+                                   obnamlib.DEFAULT_UPLOAD_QUEUE_SIZE,
+                                   obnamlib.DEFAULT_LRU_SIZE, None,
+                                   obnamlib.IDPATH_DEPTH,
+                                   obnamlib.IDPATH_BITS,
+                                   obnamlib.IDPATH_SKIP,
+                                   time.time, 0, '',
+                                   checksum_algorithm='sha256')
+        repo.lock_root()
+        repo.commit_root()
+        self.assertEqual(
+            obnamlib.parse_checksum_algorithm(fs.cat('metadata/format')),
+            'sha256')
+        self.assertEqual(repo.checksum('data'),
+                         hashlib.sha256('data').hexdigest())
+        self.assertEqual(repo.get_format_version(), repo.format_version)
+        repo.check_format_version()
+
+    def test_older_versions_reject_other_checksum_algorithm(self):
+        fs = obnamlib.LocalFS(os.path.join(self.tempdir, 'new'), create=True)
+        repo = obnamlib.Repository(fs, obnamlib.DEFAULT_NODE_SIZE,
+                                   obnamlib.DEFAULT_UPLOAD_QUEUE_SIZE,
+                                   obnamlib.DEFAULT_LRU_SIZE, None,
+                                   obnamlib.IDPATH_DEPTH,
+                                   obnamlib.IDPATH_BITS,
+                                   obnamlib.IDPATH_SKIP,
+                                   time.time, 0, '',
+                                   checksum_algorithm='sha256')
+        repo.lock_root()
+        repo.commit_root()
+        # This is how older versions of Obnam read the format version.
+        first_line = fs.cat('metadata/format').splitlines()[0]
+        self.assertNotEqual(int(first_line), repo.format_version)
+
+    def test_find_chunks_uses_chunk_cache(self):
+        self.repo.open_chunk_cache(os.path.join(self.tempdir, 'cache'))
+        self.repo.lock_shared()
+        checksum = self.repo.checksum('data')
+        self.assertEqual(self.repo.find_chunks(checksum), [])
+        chunkid = self.repo.put_chunk_only('data')
+        self.repo.put_chunk_in_shared_trees(chunkid, checksum)
+        self.assertEqual(self.repo.find_chunks(checksum), [chunkid])
+        self.assertEqual(self.repo.get_chunk_checksum(chunkid), checksum)
+        self.assertEqual(self.repo.chunk_cache.hits, 2)
+        self.repo.close_chunk_cache()
+
+    def test_puts_small_chunk_into_pack(self):
+        self.repo.pack_size = 1024
+        self.repo.pack_max_chunk_size = 4
+        self.repo.lock_shared()
+        chunkid = self.repo.put_chunk_only('data')
+        self.assertTrue(obnamlib.PackStore.is_packed(chunkid))
+        self.assertEqual(self.repo.get_chunk(chunkid), 'data')
+        self.assertEqual(self.repo.list_chunks(), [chunkid])
+
+    def test_does_not_put_large_chunk_into_pack(self):
+        self.repo.pack_size = 1024
+        self.repo.pack_max_chunk_size = 4
+        self.repo.lock_shared()
+        chunkid = self.repo.put_chunk_only('large')
+        self.assertFalse(obnamlib.PackStore.is_packed(chunkid))
+
+    def test_removes_packed_chunk(self):
+        self.repo.pack_size = 1024
+        self.repo.lock_shared()
+        chunkid = self.repo.put_chunk_only('chunk')
+        self.repo.remove_chunk(chunkid)
+        self.assertFalse(self.repo.chunk_exists(chunkid))
+
+    def test_commit_writes_packed_chunks(self):
+        self.repo.pack_size = 1024
+        self.repo.lock_shared()
+        chunkid = self.repo.put_chunk_only('chunk')
+        self.repo.commit_client()
+        self.repo.commit_shared()
+        self.repo.open_client('client_name')
+        self.assertEqual(self.repo.get_chunk(chunkid), 'chunk')
+
 
 class RepositoryGetSetChunksTests(unittest.TestCase):
 
@@ -33,6 +33,9 @@ class RepositoryTree(object):
     After init_forest or start_changes, self.forest is the opened forest.
     Unlike self.tree, it will not go away after commit.
 
+    When start_changes creates self.tree, self.base_root_id is the id of
+    the root node of the tree it is a copy of, or None.
+
     '''
 
     def __init__(self, fs, dirname, key_bytes, node_size, upload_queue_size,
@@ -47,6 +50,7 @@ class RepositoryTree(object):
         self.forest = None
         self.forest_allows_writes = False
         self.tree = None
+        self.base_root_id = None
         self.keep_just_one_tree = False
 
     def init_forest(self, allow_writes=False):
@@ -91,13 +95,35 @@ class RepositoryTree(object):
 
         if self.tree is None and create_tree:
             if self.forest.trees:
+                self.base_root_id = self.forest.trees[-1].root.id
                 self.tree = self.forest.new_tree(self.forest.trees[-1])
                 tracing.trace('use newest tree %s (of %d)', self.tree.root.id,
                                 len(self.forest.trees))
             else:
+                self.base_root_id = None
                 self.tree = self.forest.new_tree()
                 tracing.trace('new tree root id %s', self.tree.root.id)
 
+    def insert_sorted(self, pairs):
+        '''Insert many key/value pairs into the tree being changed.
+
+        The pairs are inserted in key order, rather than in the order
+        given. Consecutive keys then mostly go into the same leaf node,
+        so each node is copied and modified once, instead of once per
+        key, and stays in the node cache while it is being filled.
+
+        '''
+
+        self.start_changes()
+        for key, value in sorted(pairs):
+            self.tree.insert(key, value)
+
+    def newest_root_id(self):
+        '''Return id of root node of newest tree, or None.'''
+        if self.init_forest() and self.forest.trees:
+            return self.forest.trees[-1].root.id
+        return None
+
     def commit(self):
         tracing.trace('committing')
         if self.forest:
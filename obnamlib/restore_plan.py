@@ -0,0 +1,169 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import obnamlib
+
+
+class _PlannedFile(object):
+
+    def __init__(self, entries):
+        self.entries = entries
+        # offsets[i] is the offset of entries[i]; it is known once the
+        # sizes of all earlier entries are.
+        self.offsets = [0]
+        self.done = [isinstance(x, obnamlib.Hole) for x in entries]
+
+
+class RestorePlan(object):
+
+    '''Restore the contents of many files in chunk order.
+
+    Files are added to the plan with their lists of chunk ids, as
+    returned by ``Repository.get_file_chunks``. Each chunk is then
+    fetched only once, even if it is used in several places, and the
+    chunks are fetched in the order of their ids, which is roughly the
+    order they were stored in.
+
+    The size of a chunk is only known once it has been fetched, and
+    the offset of a chunk in a file depends on the sizes of the chunks
+    before it. A chunk whose offset is not known yet is kept in memory
+    until it is, as long as at most ``max_bytes`` are kept. Chunks that
+    don't fit are dropped, and ``chunkids`` returns them again, to be
+    fetched again after all others. By then, all sizes are known.
+
+    Use it like this::
+
+        chunkids = plan.chunkids()
+        while chunkids:
+            plan.run(fetch(chunkids), write, max_bytes)
+            chunkids = plan.chunkids()
+
+    where ``fetch`` generates (chunkid, data) pairs, in the given
+    order, and ``write(index, offset, data)`` writes to the file
+    with the index returned by ``add_file``.
+
+    '''
+
+    def __init__(self):
+        self.files = []
+        self._uses = {}
+        self._remaining = {}
+        self._sizes = {}
+        self._buffered = {}
+        self._buffered_bytes = 0
+
+    def add_file(self, chunkids):
+        '''Add a file to the plan, and return its index.'''
+        index = len(self.files)
+        self.files.append(_PlannedFile(chunkids))
+        for pos, chunkid in enumerate(chunkids):
+            if not isinstance(chunkid, obnamlib.Hole):
+                self._uses.setdefault(chunkid, []).append((index, pos))
+                self._remaining[chunkid] = self._remaining.get(chunkid, 0) + 1
+        self._resolve(index, None)
+        return index
+
+    def chunkids(self):
+        '''Return sorted ids of chunks that still need to be fetched.'''
+        return sorted(chunkid
+                      for chunkid, count in self._remaining.iteritems()
+                      if count > 0)
+
+    def file_size(self, index):
+        '''Return size of a file, or None if it is not known yet.'''
+        f = self.files[index]
+        if len(f.offsets) == len(f.entries) + 1:
+            return f.offsets[-1]
+        return None
+
+    def file_regions(self, index):
+        '''Return (offset, length, is_hole) triples for a file's contents.
+
+        Adjacent chunks are joined into one region. The file's size
+        must be known.
+
+        '''
+
+        f = self.files[index]
+        assert self.file_size(index) is not None
+        regions = []
+        for pos, entry in enumerate(f.entries):
+            is_hole = isinstance(entry, obnamlib.Hole)
+            length = f.offsets[pos + 1] - f.offsets[pos]
+            if regions and not is_hole and not regions[-1][2]:
+                offset, old_length, old_is_hole = regions[-1]
+                regions[-1] = (offset, old_length + length, False)
+            else:
+                regions.append((f.offsets[pos], length, is_hole))
+        return regions
+
+    def run(self, fetched, write, max_bytes):
+        '''Write fetched chunks to all the places they are used in.'''
+        for chunkid, data in fetched:
+            self._sizes[chunkid] = len(data)
+            self._buffer(chunkid, data)
+            for index, pos in self._uses[chunkid]:
+                self._resolve(index, write)
+                f = self.files[index]
+                if pos < len(f.offsets) and not f.done[pos]:
+                    self._write(index, pos, write)
+            if self._buffered_bytes > max_bytes:
+                self._unbuffer(chunkid)
+        # Whatever is still buffered will be fetched again.
+        for chunkid in self._buffered.keys():
+            self._unbuffer(chunkid)
+
+    def _buffer(self, chunkid, data):
+        if chunkid not in self._buffered:
+            self._buffered[chunkid] = data
+            self._buffered_bytes += len(data)
+
+    def _unbuffer(self, chunkid):
+        if chunkid in self._buffered:
+            self._buffered_bytes -= len(self._buffered.pop(chunkid))
+
+    def _size(self, entry):
+        if isinstance(entry, obnamlib.Hole):
+            return entry.size
+        return self._sizes.get(entry)
+
+    def _resolve(self, index, write):
+        '''Find offsets of entries in a file, as far as sizes are known.
+
+        Write entries whose offset becomes known, if they have been
+        buffered.
+
+        '''
+
+        f = self.files[index]
+        while len(f.offsets) <= len(f.entries):
+            size = self._size(f.entries[len(f.offsets) - 1])
+            if size is None:
+                break
+            f.offsets.append(f.offsets[-1] + size)
+            pos = len(f.offsets) - 1
+            if (write is not None and pos < len(f.entries) and
+                not f.done[pos] and f.entries[pos] in self._buffered):
+                self._write(index, pos, write)
+
+    def _write(self, index, pos, write):
+        f = self.files[index]
+        chunkid = f.entries[pos]
+        write(index, f.offsets[pos], self._buffered[chunkid])
+        f.done[pos] = True
+        self._remaining[chunkid] -= 1
+        if self._remaining[chunkid] == 0:
+            self._unbuffer(chunkid)
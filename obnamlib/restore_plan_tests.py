@@ -0,0 +1,92 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import obnamlib
+
+
+class RestorePlanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = obnamlib.RestorePlan()
+        self.chunks = {
+            1: 'aaa',
+            2: 'bb',
+            3: 'c',
+            4: 'dddd',
+        }
+        self.files = {}
+        self.fetched = []
+
+    def fetch(self, chunkids):
+        for chunkid in chunkids:
+            self.fetched.append(chunkid)
+            yield chunkid, self.chunks[chunkid]
+
+    def write(self, index, offset, data):
+        f = self.files.setdefault(index, bytearray())
+        if len(f) < offset + len(data):
+            f.extend('\0' * (offset + len(data) - len(f)))
+        f[offset:offset + len(data)] = data
+
+    def restore(self, max_bytes):
+        chunkids = self.plan.chunkids()
+        while chunkids:
+            self.plan.run(self.fetch(chunkids), self.write, max_bytes)
+            chunkids = self.plan.chunkids()
+
+    def test_does_nothing_for_empty_plan(self):
+        self.restore(1024)
+        self.assertEqual(self.fetched, [])
+
+    def test_restores_files(self):
+        a = self.plan.add_file([3, 1])
+        b = self.plan.add_file([2, 4, 1])
+        self.restore(1024)
+        self.assertEqual(str(self.files[a]), 'caaa')
+        self.assertEqual(str(self.files[b]), 'bbddddaaa')
+        self.assertEqual(self.plan.file_size(a), 4)
+        self.assertEqual(self.plan.file_size(b), 9)
+
+    def test_fetches_each_chunk_once_in_id_order(self):
+        self.plan.add_file([4, 1, 4])
+        self.plan.add_file([1, 3])
+        self.restore(1024)
+        self.assertEqual(self.fetched, [1, 3, 4])
+
+    def test_refetches_chunks_that_do_not_fit_in_memory(self):
+        a = self.plan.add_file([4, 1])
+        self.restore(0)
+        self.assertEqual(str(self.files[a]), 'ddddaaa')
+        self.assertEqual(self.fetched, [1, 4, 1])
+
+    def test_skips_holes(self):
+        a = self.plan.add_file([obnamlib.Hole(5), 3, obnamlib.Hole(2)])
+        self.restore(1024)
+        self.assertEqual(str(self.files[a]), '\0' * 5 + 'c')
+        self.assertEqual(self.plan.file_size(a), 8)
+
+    def test_returns_regions_of_data_and_holes(self):
+        a = self.plan.add_file([obnamlib.Hole(5), 3, 1, obnamlib.Hole(2), 4])
+        self.restore(1024)
+        self.assertEqual(self.plan.file_regions(a),
+                         [(0, 5, True), (5, 4, False), (9, 2, True),
+                          (11, 4, False)])
+
+    def test_file_size_is_unknown_before_restore(self):
+        a = self.plan.add_file([1])
+        self.assertEqual(self.plan.file_size(a), None)
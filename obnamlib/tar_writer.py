@@ -0,0 +1,231 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import stat
+
+import obnamlib
+
+
+BLOCK_SIZE = 512
+
+REGTYPE = '0'
+LNKTYPE = '1'
+SYMTYPE = '2'
+CHRTYPE = '3'
+BLKTYPE = '4'
+DIRTYPE = '5'
+FIFOTYPE = '6'
+PAXTYPE = 'x'
+
+
+def _padding(size):
+    return '\0' * (-size % BLOCK_SIZE)
+
+
+def _pax_record(keyword, value):
+    # The length at the start of the record includes itself.
+    length = len(keyword) + len(value) + 3
+    n = p = 0
+    while True:
+        n = length + len(str(p))
+        if n == p:
+            break
+        p = n
+    return '%d %s=%s\n' % (p, keyword, value)
+
+
+class TarWriter(object):
+
+    '''Write a tar archive in POSIX pax format, as a stream.
+
+    Entries are written to the file-like object ``f`` as they are
+    added, and file contents are given as iterables of strings, so
+    that the whole archive never needs to be in memory, and ``f`` can
+    be a pipe.
+
+    Values that do not fit into the fixed size fields of a tar header,
+    such as long names, sub-second timestamps, and extended attributes,
+    are put in pax extended headers. Sparse files are written in the
+    GNU pax sparse format 1.0, which GNU tar and bsdtar understand.
+
+    '''
+
+    def __init__(self, f):
+        self.f = f
+
+    def close(self):
+        '''Write the end of archive marker. Does not close the file.'''
+        self.f.write('\0' * (2 * BLOCK_SIZE))
+
+    def add_directory(self, name, metadata):
+        self._write_header(name.rstrip('/') + '/', DIRTYPE, metadata)
+
+    def add_symlink(self, name, metadata):
+        self._write_header(name, SYMTYPE, metadata, linkname=metadata.target)
+
+    def add_hardlink(self, name, target, metadata):
+        '''Add a hard link to an earlier entry, named target.'''
+        self._write_header(name, LNKTYPE, metadata, linkname=target)
+
+    def add_special(self, name, metadata):
+        '''Add a FIFO or device file.
+
+        Obnam does not back up device numbers, so devices get zeroes.
+
+        '''
+
+        if stat.S_ISFIFO(metadata.st_mode):
+            typeflag = FIFOTYPE
+        elif stat.S_ISCHR(metadata.st_mode):
+            typeflag = CHRTYPE
+        elif stat.S_ISBLK(metadata.st_mode):
+            typeflag = BLKTYPE
+        else:
+            raise obnamlib.Error(
+                'Can\'t put %s in a tar archive (mode %o)' %
+                (name, metadata.st_mode))
+        self._write_header(name, typeflag, metadata)
+
+    def add_file(self, name, metadata, data):
+        '''Add a regular file, with contents from an iterable of strings.'''
+        self._write_header(name, REGTYPE, metadata, size=metadata.st_size)
+        self._write_data(name, data, metadata.st_size)
+
+    def add_sparse_file(self, name, metadata, regions, data):
+        '''Add a sparse regular file.
+
+        ``regions`` is a list of (offset, length) pairs for the parts
+        of the file that are not holes. If the file ends in a hole,
+        the last region should be (size of file, 0). ``data`` gives
+        the contents of the regions, one after the other.
+
+        '''
+
+        sparse_map = '%d\n' % len(regions) + ''.join(
+            '%d\n%d\n' % region for region in regions)
+        sparse_map += _padding(len(sparse_map))
+        data_size = sum(length for offset, length in regions)
+
+        dirname, basename = os.path.split(name)
+        self._write_header(
+            os.path.join(dirname, 'GNUSparseFile.0', basename), REGTYPE,
+            metadata, size=len(sparse_map) + data_size,
+            extra=[('GNU.sparse.major', '1'),
+                   ('GNU.sparse.minor', '0'),
+                   ('GNU.sparse.name', name),
+                   ('GNU.sparse.realsize', str(metadata.st_size))])
+        self.f.write(sparse_map)
+        self._write_data(name, data, data_size)
+
+    def _write_data(self, name, data, size):
+        # The archive must stay valid, even if there is the wrong amount
+        # of data, or getting it fails, so pad or cut it to size.
+        written = 0
+        try:
+            for chunk in data:
+                if written + len(chunk) > size:
+                    chunk = chunk[:size - written]
+                self.f.write(chunk)
+                written += len(chunk)
+        finally:
+            remaining = size - written
+            while remaining > 0:
+                n = min(remaining, 1024**2)
+                self.f.write('\0' * n)
+                remaining -= n
+            self.f.write(_padding(size))
+        if written != size:
+            raise obnamlib.Error(
+                'Contents of %s have the wrong size for tar archive' % name)
+
+    def _write_header(self, name, typeflag, metadata, size=0, linkname='',
+                      extra=None):
+        pax = list(extra or [])
+
+        if len(name) > 100:
+            pax.append(('path', name))
+        if len(linkname or '') > 100:
+            pax.append(('linkpath', linkname))
+
+        mtime = metadata.st_mtime_sec or 0
+        if metadata.st_mtime_nsec or mtime < 0:
+            pax.append(('mtime', '%d.%09d' %
+                        (mtime, metadata.st_mtime_nsec or 0)))
+
+        uid = metadata.st_uid or 0
+        gid = metadata.st_gid or 0
+        for key, value, width in [('size', size, 12),
+                                  ('uid', uid, 8),
+                                  ('gid', gid, 8)]:
+            if value >= 8**(width - 1):
+                pax.append((key, str(value)))
+
+        for key, value in [('uname', metadata.username),
+                           ('gname', metadata.groupname)]:
+            if value and len(value) > 32:
+                pax.append((key, value))
+
+        if metadata.xattr:
+            for xattr_name, value in obnamlib.decode_xattr_blob(
+                    metadata.xattr):
+                pax.append(('SCHILY.xattr.' + xattr_name, value))
+
+        if pax:
+            records = ''.join(_pax_record(k, v) for k, v in pax)
+            dirname, basename = os.path.split(name.rstrip('/'))
+            pax_name = os.path.join(dirname, 'PaxHeaders.0', basename)
+            self.f.write(self._header(pax_name, PAXTYPE, 0644, 0, 0,
+                                      len(records), 0, '', '', ''))
+            self.f.write(records + _padding(len(records)))
+
+        self.f.write(self._header(
+            name, typeflag, stat.S_IMODE(metadata.st_mode or 0),
+            uid, gid, size, max(0, mtime),
+            linkname or '', metadata.username or '',
+            metadata.groupname or ''))
+
+    def _header(self, name, typeflag, mode, uid, gid, size, mtime,
+                linkname, uname, gname):
+        def number(value, width):
+            if value >= 8**(width - 1):
+                value = 0
+            return '%0*o\0' % (width - 1, value)
+
+        def string(value, width):
+            return value[:width].ljust(width, '\0')
+
+        fields = [
+            string(name, 100),
+            number(mode, 8),
+            number(uid, 8),
+            number(gid, 8),
+            number(size, 12),
+            number(mtime, 12),
+            ' ' * 8,
+            typeflag,
+            string(linkname, 100),
+            'ustar\0', '00',
+            string(uname, 32),
+            string(gname, 32),
+            number(0, 8),
+            number(0, 8),
+            string('', 155),
+        ]
+        header = ''.join(fields)
+        header += _padding(len(header))
+        checksum = '%06o\0 ' % sum(ord(c) for c in header)
+        return header[:148] + checksum + header[156:]
@@ -0,0 +1,133 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import stat
+import StringIO
+import struct
+import tarfile
+import unittest
+
+import obnamlib
+
+
+class TarWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.f = StringIO.StringIO()
+        self.writer = obnamlib.TarWriter(self.f)
+
+    def metadata(self, mode, **kwargs):
+        return obnamlib.Metadata(st_mode=mode, st_mtime_sec=1234567890,
+                                 st_mtime_nsec=0, st_uid=1000, st_gid=100,
+                                 username='user', groupname='group',
+                                 **kwargs)
+
+    def read_archive(self):
+        self.writer.close()
+        self.f.seek(0)
+        return tarfile.open(fileobj=self.f, mode='r:')
+
+    def test_writes_empty_archive(self):
+        tf = self.read_archive()
+        self.assertEqual(tf.getmembers(), [])
+        self.assertEqual(len(self.f.getvalue()), 1024)
+
+    def test_writes_directory(self):
+        self.writer.add_directory('dir', self.metadata(stat.S_IFDIR | 0755))
+        info = self.read_archive().getmember('dir')
+        self.assertTrue(info.isdir())
+        self.assertEqual(info.mode, 0755)
+        self.assertEqual(info.mtime, 1234567890)
+        self.assertEqual(info.uname, 'user')
+        self.assertEqual(info.gid, 100)
+
+    def test_writes_regular_file(self):
+        metadata = self.metadata(stat.S_IFREG | 0644, st_size=12)
+        self.writer.add_file('dir/file', metadata, ['hello, ', 'world'])
+        tf = self.read_archive()
+        info = tf.getmember('dir/file')
+        self.assertTrue(info.isfile())
+        self.assertEqual(tf.extractfile(info).read(), 'hello, world')
+
+    def test_keeps_archive_valid_if_data_is_short(self):
+        metadata = self.metadata(stat.S_IFREG | 0644, st_size=10)
+        self.assertRaises(obnamlib.Error, self.writer.add_file,
+                          'file', metadata, ['short'])
+        self.writer.add_directory('dir', self.metadata(stat.S_IFDIR | 0755))
+        tf = self.read_archive()
+        self.assertEqual(tf.getnames(), ['file', 'dir'])
+        self.assertEqual(tf.extractfile('file').read(), 'short' + '\0' * 5)
+
+    def test_writes_symlink(self):
+        metadata = self.metadata(stat.S_IFLNK | 0777, target='target')
+        self.writer.add_symlink('link', metadata)
+        info = self.read_archive().getmember('link')
+        self.assertTrue(info.issym())
+        self.assertEqual(info.linkname, 'target')
+
+    def test_writes_hardlink(self):
+        metadata = self.metadata(stat.S_IFREG | 0644, st_size=0)
+        self.writer.add_file('first', metadata, [])
+        self.writer.add_hardlink('second', 'first', metadata)
+        info = self.read_archive().getmember('second')
+        self.assertTrue(info.islnk())
+        self.assertEqual(info.linkname, 'first')
+
+    def test_writes_fifo(self):
+        self.writer.add_special('fifo', self.metadata(stat.S_IFIFO | 0600))
+        self.assertTrue(self.read_archive().getmember('fifo').isfifo())
+
+    def test_refuses_socket(self):
+        self.assertRaises(obnamlib.Error, self.writer.add_special,
+                          'socket', self.metadata(stat.S_IFSOCK | 0600))
+
+    def test_writes_long_names(self):
+        name = '/'.join(['x' * 50] * 5)
+        metadata = self.metadata(stat.S_IFLNK | 0777, target='y' * 200)
+        self.writer.add_symlink(name, metadata)
+        info = self.read_archive().getmember(name)
+        self.assertEqual(info.linkname, 'y' * 200)
+
+    def test_writes_subsecond_mtime(self):
+        metadata = self.metadata(stat.S_IFDIR | 0755)
+        metadata.st_mtime_nsec = 500000000
+        self.writer.add_directory('dir', metadata)
+        info = self.read_archive().getmember('dir')
+        self.assertEqual(info.pax_headers['mtime'], '1234567890.500000000')
+
+    def test_writes_xattrs(self):
+        names = 'user.foo\0'
+        blob = (struct.pack('!Q', len(names)) + names +
+                struct.pack('!Q', 3) + 'bar')
+        metadata = self.metadata(stat.S_IFDIR | 0755, xattr=blob)
+        self.writer.add_directory('dir', metadata)
+        info = self.read_archive().getmember('dir')
+        self.assertEqual(info.pax_headers['SCHILY.xattr.user.foo'], 'bar')
+
+    def test_writes_sparse_file(self):
+        metadata = self.metadata(stat.S_IFREG | 0644, st_size=3000)
+        self.writer.add_sparse_file('dir/sparse', metadata,
+                                    [(1000, 3), (2000, 2), (3000, 0)],
+                                    ['abc', 'de'])
+        tf = self.read_archive()
+        info = tf.getmembers()[0]
+        self.assertEqual(info.pax_headers['GNU.sparse.name'], 'dir/sparse')
+        self.assertEqual(info.pax_headers['GNU.sparse.realsize'], '3000')
+        self.assertEqual(info.pax_headers['GNU.sparse.major'], '1')
+        data = tf.extractfile(info).read()
+        self.assertEqual(data[:512].rstrip('\0'),
+                         '3\n1000\n3\n2000\n2\n3000\n0\n')
+        self.assertEqual(data[512:], 'abcde')
@@ -0,0 +1,165 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import anydbm
+import hashlib
+import logging
+import os
+import random
+import stat
+import struct
+
+
+class UnchangedFileCache(object):
+
+    '''A local cache of files that are unchanged since the latest backup.
+
+    A backup needs to find out, for every file, whether it has changed
+    since the previous generation. Looking that up in the per-client
+    B-tree is expensive, when almost all files are unchanged. This cache
+    lives on the local disk, and remembers the lstat results of files
+    that were put into a generation. If a file's inode, pathname, mtime,
+    ctime, size and mode are still the same, it does not need to be
+    backed up again. Any change to ownership, permissions, link count,
+    or extended attributes changes the ctime as well.
+
+    The cache is only valid for the generation it was built for. Every
+    record is tagged with a random identifier of the backup run that
+    wrote it, and ``commit`` records which generation that run created.
+    When the cache is opened, records from other runs are ignored, unless
+    the previous run created the generation the new backup is based on.
+    A backup that fails before it commits thus invalidates the whole
+    cache.
+
+    Records of a run are written to a new file next to the cache,
+    which ``commit`` renames over the old one. The cache thus only
+    ever holds the files in the latest generation, and does not keep
+    growing as files come and go.
+
+    Use ``is_unchanged`` to check a file, and ``remember`` once the file
+    has been put into the new generation, unchanged or not.
+
+    '''
+
+    header_key = 'header'
+    record_format = '!QqQqQqQ'
+
+    def __init__(self, filename, repository, client_name, base_generation):
+        self.filename = filename
+        self._new_filename = filename + '.new'
+        self._identity = [repository, client_name]
+        self._db = anydbm.open(filename, 'c')
+        self._valid_run = self._find_valid_run(base_generation)
+        if self._valid_run is None:
+            logging.debug('Unchanged file cache %s is not valid for '
+                          'generation %s, starting a new one' %
+                          (filename, base_generation))
+        self._run = random.getrandbits(64)
+        self._candidates = {}
+        self.hits = 0
+
+        # Until the new generation is committed, the cache is not valid
+        # for anything.
+        self._db[self.header_key] = ''
+        if self._valid_run is None:
+            self._db.close()
+            self._db = None
+        self._new_db = anydbm.open(self._new_filename, 'n')
+
+    def _find_valid_run(self, base_generation):
+        if base_generation is None or self.header_key not in self._db:
+            return None
+        header = self._db[self.header_key].split('\0')
+        if header[:-2] != self._identity:
+            return None
+        generation, run = header[-2:]
+        if generation != str(base_generation):
+            return None
+        return int(run)
+
+    def _key(self, pathname, st):
+        return (struct.pack('!QQ', st.st_dev, st.st_ino) +
+                hashlib.md5(pathname).digest()[:8])
+
+    def _record(self, run, st):
+        return struct.pack(self.record_format, run,
+                           st.st_mtime_sec, st.st_mtime_nsec,
+                           st.st_ctime_sec, st.st_ctime_nsec,
+                           st.st_size, st.st_mode)
+
+    def is_unchanged(self, pathname, st):
+        '''Is a file unchanged since the generation the cache is valid for?
+
+        ``st`` is the file's lstat result; it must include ctime, which
+        the usual Metadata objects do not.
+
+        '''
+
+        if stat.S_ISDIR(st.st_mode):
+            return False
+        if getattr(st, 'st_ctime_sec', None) is None:
+            return False
+
+        key = self._key(pathname, st)
+        self._candidates[pathname] = (key, st)
+        if self._valid_run is None:
+            return False
+        try:
+            old = self._db[key]
+        except KeyError:
+            return False
+        if old != self._record(self._valid_run, st):
+            return False
+        self.hits += 1
+        return True
+
+    def remember(self, pathname):
+        '''Remember that a file checked with is_unchanged is in new generation.'''
+        if pathname in self._candidates:
+            key, st = self._candidates.pop(pathname)
+            self._new_db[key] = self._record(self._run, st)
+
+    def commit(self, generation):
+        '''Mark the cache as valid for a newly committed generation.'''
+        header = self._identity + [str(generation), str(self._run)]
+        self._new_db[self.header_key] = '\0'.join(header)
+        self._close_dbs()
+        # Some dbm implementations add suffixes to the filename, or
+        # use several files, so rename whatever was created.
+        for new_name in self._new_files():
+            suffix = new_name[len(self._new_filename):]
+            os.rename(new_name, self.filename + suffix)
+
+    def close(self):
+        '''Close the cache without committing.'''
+        self._close_dbs()
+        for new_name in self._new_files():
+            os.remove(new_name)
+
+    def _close_dbs(self):
+        for db in [self._db, self._new_db]:
+            if db is not None:
+                db.close()
+        self._db = None
+        self._new_db = None
+        self._candidates = {}
+
+    def _new_files(self):
+        dirname, basename = os.path.split(self._new_filename)
+        return [os.path.join(dirname, x)
+                for x in os.listdir(dirname or '.')
+                if x == basename or x.startswith(basename + '.')]
+
@@ -0,0 +1,147 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import anydbm
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import obnamlib
+
+
+class UnchangedFileCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache')
+        self.st = obnamlib.StatResult(
+            st_dev=1, st_ino=2, st_mode=stat.S_IFREG | 0644,
+            st_mtime_sec=3, st_mtime_nsec=4,
+            st_ctime_sec=5, st_ctime_nsec=6,
+            st_size=7)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def open_cache(self, base_generation, client_name='client'):
+        return obnamlib.UnchangedFileCache(
+            self.filename, 'repo', client_name, base_generation)
+
+    def make_cache_for_generation(self, generation):
+        cache = self.open_cache(None)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.remember('/foo')
+        cache.commit(generation)
+
+    def test_nothing_is_unchanged_in_new_cache(self):
+        cache = self.open_cache(None)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
+    def test_remembered_file_is_unchanged(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42)
+        self.assertTrue(cache.is_unchanged('/foo', self.st))
+        self.assertEqual(cache.hits, 1)
+        cache.close()
+
+    def test_file_is_not_unchanged_if_not_remembered(self):
+        cache = self.open_cache(None)
+        cache.is_unchanged('/foo', self.st)
+        cache.commit(42)
+        cache = self.open_cache(42)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
+    def test_other_pathname_is_not_unchanged(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42)
+        self.assertFalse(cache.is_unchanged('/bar', self.st))
+        cache.close()
+
+    def test_changed_ctime_is_not_unchanged(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42)
+        self.st.st_ctime_nsec += 1
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
+    def test_directory_is_never_unchanged(self):
+        self.st.st_mode = stat.S_IFDIR | 0755
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
+    def test_cache_is_invalid_for_other_generation(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(43)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
+    def test_cache_is_invalid_for_other_client(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42, client_name='other')
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
+    def test_uncommitted_run_invalidates_cache(self):
+        self.make_cache_for_generation(42)
+        self.open_cache(42).close()
+        cache = self.open_cache(42)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
+    def test_keeps_only_records_of_latest_run(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42)
+        bar = obnamlib.StatResult(
+            st_dev=1, st_ino=3, st_mode=stat.S_IFREG | 0644,
+            st_mtime_sec=3, st_mtime_nsec=4,
+            st_ctime_sec=5, st_ctime_nsec=6,
+            st_size=7)
+        self.assertFalse(cache.is_unchanged('/bar', bar))
+        cache.remember('/bar')
+        cache.commit(43)
+        db = anydbm.open(self.filename, 'r')
+        self.assertEqual(len(db.keys()), 2)
+        db.close()
+        cache = self.open_cache(43)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        self.assertTrue(cache.is_unchanged('/bar', bar))
+        cache.close()
+
+    def test_close_removes_records_of_uncommitted_run(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42)
+        self.assertTrue(cache.is_unchanged('/foo', self.st))
+        cache.remember('/foo')
+        cache.close()
+        self.assertEqual(
+            [x for x in os.listdir(self.tempdir)
+             if not x.startswith('cache') or '.new' in x],
+            [])
+
+    def test_records_from_earlier_runs_are_ignored(self):
+        self.make_cache_for_generation(42)
+        cache = self.open_cache(42)
+        cache.commit(43)
+        cache = self.open_cache(43)
+        self.assertFalse(cache.is_unchanged('/foo', self.st))
+        cache.close()
+
@@ -16,9 +16,12 @@
 
 
 import errno
+import heapq
 import logging
 import os
 import stat
+import threading
+import time
 import urlparse
 
 import obnamlib
@@ -51,8 +54,18 @@ class VirtualFileSystem(object):
         self.baseurl = baseurl
         self.bytes_read = 0
         self.bytes_written = 0
+        # Chunks may be written from several threads at once.
+        self._bytes_lock = threading.Lock()
         logging.debug('VFS: __init__: baseurl=%s' % self.baseurl)
 
+    def _count_read(self, num_bytes):
+        with self._bytes_lock:
+            self.bytes_read += num_bytes
+
+    def _count_written(self, num_bytes):
+        with self._bytes_lock:
+            self.bytes_written += num_bytes
+
     def log_stats(self):
         logging.debug(
             'VFS: baseurl=%s read=%d written=%d' %
@@ -195,6 +208,17 @@ class VirtualFileSystem(object):
     def symlink(self, source, destination):
         '''Like os.symlink.'''
 
+    def get_data_extents(self, f, size):
+        '''Return the parts of an open file that contain data.
+
+        The result is a list of (offset, length) pairs for the parts
+        of the first ``size`` bytes of the file that are not holes,
+        or None if the holes in the file can't be found out.
+
+        '''
+
+        return None
+
     def open(self, pathname, mode):
         '''Open a file, like the builtin open() or file() function.
 
@@ -206,6 +230,22 @@ class VirtualFileSystem(object):
     def cat(self, pathname):
         '''Return the contents of a file.'''
 
+    def cat_range(self, pathname, offset, length):
+        '''Return ``length`` bytes of a file, starting at ``offset``.
+
+        The result is shorter if the file ends before that.
+
+        '''
+
+        f = self.open(pathname, 'rb')
+        try:
+            f.seek(offset)
+            data = f.read(length)
+        finally:
+            f.close()
+        self._count_read(len(data))
+        return data
+
     def write_file(self, pathname, contents):
         '''Write a new file.
 
@@ -222,7 +262,7 @@ class VirtualFileSystem(object):
         '''Like write_file, but overwrites existing file.'''
 
     def scan_tree(self, dirname, ok=None, dirst=None, log=logging.error,
-                  error_handler=None):
+                  error_handler=None, workers=0, queue_size=None):
         '''Scan a tree for files.
 
         Return a generator that returns ``(pathname, stat_result)``
@@ -246,8 +286,22 @@ class VirtualFileSystem(object):
         called once for every problem, giving the name and exception
         as arguments.
 
+        If ``workers`` is greater than zero, directories are listed
+        in that many background threads, ahead of the caller, and
+        at most ``queue_size`` listings are running or kept waiting.
+        The result is the same as when scanning serially, but ``ok``
+        may be called for entries well before they are returned.
+
         '''
 
+        if workers > 0:
+            return self._scan_tree_parallel(
+                dirname, ok, dirst, log, error_handler, workers,
+                queue_size or 2 * workers)
+        return self._scan_tree_serially(
+            dirname, ok, dirst, log, error_handler)
+
+    def _scan_tree_serially(self, dirname, ok, dirst, log, error_handler):
         error_handler = error_handler or (lambda name, e: None)
 
         try:
@@ -281,6 +335,132 @@ class VirtualFileSystem(object):
 
         yield dirname, dirst
 
+    def _scan_tree_parallel(self, dirname, ok, dirst, log, error_handler,
+                            workers, queue_size):
+        # Directory listings are done by a WorkerPool. Directories that
+        # are known, but not yet listed, are kept in a frontier, keyed
+        # by their place in the scan order: the key of a directory is
+        # its parent's key plus its own index among the parent's
+        # sub-directories, so keys sort in depth-first order.
+        #
+        # Whenever a worker is idle, the directory in the frontier that
+        # will be needed soonest is listed. Finished listings are
+        # looked at right away, so that their sub-directories join the
+        # frontier before we get to them. Errors in a listing are only
+        # reported when we get to it, as when scanning serially.
+        #
+        # At most queue_size listings may be running or waiting to be
+        # used. If there is no room, a finished listing that is needed
+        # later is dropped, and its directory goes back to the
+        # frontier, so that listings of shallow siblings don't keep
+        # all the slots while we go deep into a tree. A directory that
+        # wasn't listed ahead of time is listed when we get to it.
+
+        error_handler = error_handler or (lambda name, e: None)
+        pool = obnamlib.WorkerPool(workers, max_pending=queue_size)
+        frontier = []
+        unlisted = set()
+        jobs = {}
+
+        def split(dirname, key, pairs):
+            subdirs = []
+            files = []
+            errors = []
+            for name, st in pairs:
+                pathname = os.path.join(dirname, name)
+                if isinstance(st, BaseException):
+                    errors.append((pathname, st))
+                elif ok is None or ok(pathname, st):
+                    if stat.S_ISDIR(st.st_mode):
+                        if pathname not in jobs and pathname not in unlisted:
+                            heapq.heappush(
+                                frontier, (key + (len(subdirs),), pathname))
+                            unlisted.add(pathname)
+                        subdirs.append((pathname, st))
+                    else:
+                        files.append((pathname, st))
+            return subdirs, files, errors
+
+        def make_room(key):
+            done = [(job[0], pathname)
+                    for pathname, job in jobs.iteritems()
+                    if job[1].done()]
+            if done:
+                job_key, pathname = max(done)
+                if job_key > key:
+                    del jobs[pathname]
+                    heapq.heappush(frontier, (job_key, pathname))
+                    unlisted.add(pathname)
+                    return True
+            return False
+
+        def prefetch():
+            running = 0
+            for pathname, job in jobs.items():
+                if not job[1].done():
+                    running += 1
+                elif job[2] is None:
+                    try:
+                        pairs = job[1].result()
+                    except OSError:
+                        continue
+                    job[2] = split(pathname, job[0], pairs)
+
+            while frontier and running < workers:
+                key, pathname = heapq.heappop(frontier)
+                if pathname not in unlisted:
+                    continue
+                if len(jobs) >= queue_size and not make_room(key):
+                    heapq.heappush(frontier, (key, pathname))
+                    break
+                unlisted.remove(pathname)
+                job = pool.submit(self.listdir2, pathname)
+                jobs[pathname] = [key, job, None]
+                running += 1
+
+        def scan(dirname, key, dirst):
+            unlisted.discard(dirname)
+            job = jobs.pop(dirname, None)
+            if job is not None and job[2] is not None:
+                subdirs, files, errors = job[2]
+            else:
+                try:
+                    if job is None:
+                        pairs = self.listdir2(dirname)
+                    else:
+                        pairs = job[1].result()
+                except OSError, e:
+                    log('listdir failed: %s: %s' % (e.filename, e.strerror))
+                    error_handler(dirname, e)
+                    pairs = []
+                subdirs, files, errors = split(dirname, key, pairs)
+            for pathname, e in errors:
+                error_handler(pathname, e)
+
+            prefetch()
+            for i, (pathname, st) in enumerate(subdirs):
+                for t in scan(pathname, key + (i,), st):
+                    yield t
+
+            for t in files:
+                yield t
+
+            if dirst is None:
+                try:
+                    dirst = self.lstat(dirname)
+                except OSError, e:
+                    log('lstat for dir failed: %s: %s' %
+                        (e.filename, e.strerror))
+                    return
+
+            yield dirname, dirst
+
+        try:
+            for t in scan(dirname, (), dirst):
+                yield t
+        finally:
+            pool.close()
+
 
 class VfsFactory:
 
@@ -614,6 +794,22 @@ class VfsTests(object): # pragma: no cover
         self.fs.cat('foo')
         self.assertEqual(self.fs.bytes_read, 3)
 
+    def test_cat_range_reads_part_of_file(self):
+        self.fs.write_file('foo', 'foobar')
+        self.assertEqual(self.fs.cat_range('foo', 2, 3), 'oba')
+
+    def test_cat_range_stops_at_end_of_file(self):
+        self.fs.write_file('foo', 'foobar')
+        self.assertEqual(self.fs.cat_range('foo', 4, 10), 'ar')
+
+    def test_cat_range_updates_bytes_read(self):
+        self.fs.write_file('foo', 'foobar')
+        self.fs.cat_range('foo', 2, 3)
+        self.assertEqual(self.fs.bytes_read, 3)
+
+    def test_cat_range_fails_for_nonexistent_file(self):
+        self.assertRaises(IOError, self.fs.cat_range, 'foo', 0, 1)
+
     def test_write_fails_if_file_exists_already(self):
         self.fs.write_file('foo', 'bar')
         self.assertRaises(OSError, self.fs.write_file, 'foo', 'foobar')
@@ -685,3 +881,69 @@ class VfsTests(object): # pragma: no cover
         pathnames = [pathname for pathname, st in result]
         self.assertEqual(sorted(pathnames), sorted(self.dirs))
 
+    def test_scan_tree_in_parallel_returns_same_as_serially(self):
+        self.set_up_scan_tree()
+        for dirname in self.dirs[1:]:
+            self.fs.write_file(os.path.join(dirname, 'file'), '')
+        serial = list(self.fs.scan_tree(self.basepath))
+        parallel = list(self.fs.scan_tree(self.basepath, workers=2,
+                                          queue_size=1))
+        self.assertEqual([pathname for pathname, st in parallel],
+                         [pathname for pathname, st in serial])
+
+    def test_scan_tree_in_parallel_filters_away_unwanted(self):
+        def ok(pathname, st):
+            return stat.S_ISDIR(st.st_mode)
+        self.set_up_scan_tree()
+        result = list(self.fs.scan_tree(self.basepath, ok=ok, workers=2))
+        pathnames = [pathname for pathname, st in result]
+        self.assertEqual(sorted(pathnames), sorted(self.dirs))
+
+    def test_scan_tree_in_parallel_returns_nothing_if_listdir_fails(self):
+        self.set_up_scan_tree()
+        def raiser(dirname):
+            raise OSError(123, 'oops', dirname)
+        def logerror(msg):
+            pass
+        self.fs.listdir2 = raiser
+        result = list(self.fs.scan_tree(self.basepath, log=logerror,
+                                        workers=2))
+        self.assertEqual([pathname for pathname, st in result],
+                         [self.basepath])
+
+    def test_scan_tree_in_parallel_lists_deep_tree_concurrently(self):
+        # A binary tree of directories, six levels deep, and some empty
+        # directories after it, which are listed early. Count how many
+        # listings run at once deep in the tree.
+        dirnames = ['a', 'b']
+        for depth in range(5):
+            dirnames += [os.path.join(dirname, x)
+                         for dirname in dirnames if dirname.count('/') == depth
+                         for x in ['a', 'b']]
+        dirnames += ['z%d' % i for i in range(10)]
+        for dirname in dirnames:
+            self.fs.mkdir(os.path.join(self.basepath, dirname))
+
+        serial = list(self.fs.scan_tree(self.basepath))
+
+        lock = threading.Lock()
+        counts = {'now': 0, 'max': 0}
+        real_listdir2 = self.fs.listdir2
+        def listdir2(dirname):
+            deep = dirname[len(self.basepath):].count('/') > 2
+            with lock:
+                counts['now'] += 1
+                if deep:
+                    counts['max'] = max(counts['max'], counts['now'])
+            time.sleep(0.01)
+            with lock:
+                counts['now'] -= 1
+            return real_listdir2(dirname)
+        self.fs.listdir2 = listdir2
+
+        parallel = list(self.fs.scan_tree(self.basepath, workers=4,
+                                          queue_size=8))
+        self.assertEqual([pathname for pathname, st in parallel],
+                         [pathname for pathname, st in serial])
+        self.assertEqual(counts['max'], 4)
+
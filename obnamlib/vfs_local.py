@@ -146,29 +146,20 @@ class LocalFS(obnamlib.VirtualFileSystem):
         self.maybe_crash()
 
     def lstat(self, pathname):
+        return self._make_stat_result(
+            pathname, obnamlib._obnam.lstat(self.join(pathname)))
+
+    def _make_stat_result(self, pathname, fields):
         (ret, dev, ino, mode, nlink, uid, gid, rdev, size, blksize, blocks,
          atime_sec, atime_nsec, mtime_sec, mtime_nsec,
-         ctime_sec, ctime_nsec) = obnamlib._obnam.lstat(self.join(pathname))
+         ctime_sec, ctime_nsec) = fields
         if ret != 0:
             raise OSError(ret, os.strerror(ret), pathname)
-        return obnamlib.Metadata(
-                    st_dev=dev,
-                    st_ino=ino,
-                    st_mode=mode,
-                    st_nlink=nlink,
-                    st_uid=uid,
-                    st_gid=gid,
-                    st_rdev=rdev,
-                    st_size=size,
-                    st_blksize=blksize,
-                    st_blocks=blocks,
-                    st_atime_sec=atime_sec,
-                    st_atime_nsec=atime_nsec,
-                    st_mtime_sec=mtime_sec,
-                    st_mtime_nsec=mtime_nsec,
-                    st_ctime_sec=ctime_sec,
-                    st_ctime_nsec=ctime_nsec
-                )
+        return obnamlib.StatResult(dev, ino, mode, nlink, uid, gid, rdev,
+                                   size, blksize, blocks,
+                                   atime_sec, atime_nsec,
+                                   mtime_sec, mtime_nsec,
+                                   ctime_sec, ctime_nsec)
 
     def get_username(self, uid):
         return pwd.getpwuid(uid)[0]
@@ -239,6 +230,12 @@ class LocalFS(obnamlib.VirtualFileSystem):
         os.symlink(existing, self.join(new))
         self.maybe_crash()
 
+    def get_data_extents(self, f, size):
+        ret = obnamlib._obnam.data_extents(f.fileno(), size)
+        if type(ret) is int:
+            raise OSError(ret, os.strerror(ret), f.name)
+        return ret
+
     def open(self, pathname, mode):
         tracing.trace('pathname=%s', pathname)
         tracing.trace('mode=%s', mode)
@@ -290,7 +287,7 @@ class LocalFS(obnamlib.VirtualFileSystem):
             if not chunk:
                 break
             chunks.append(chunk)
-            self.bytes_read += len(chunk)
+            self._count_read(len(chunk))
         f.close()
         data = ''.join(chunks)
         return data
@@ -348,7 +345,12 @@ class LocalFS(obnamlib.VirtualFileSystem):
         dirname = os.path.dirname(path)
         if not os.path.exists(dirname):
             tracing.trace('os.makedirs(%s)' % dirname)
-            os.makedirs(dirname)
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                # Another thread may have created it meanwhile.
+                if e.errno != errno.EEXIST or not os.path.isdir(dirname):
+                    raise
 
         fd, tempname = tempfile.mkstemp(dir=dirname)
         os.close(fd)
@@ -359,7 +361,7 @@ class LocalFS(obnamlib.VirtualFileSystem):
             chunk = contents[pos:pos+self.chunk_size]
             f.write(chunk)
             pos += len(chunk)
-            self.bytes_written += len(chunk)
+            self._count_written(len(chunk))
         f.close()
         return tempname
 
@@ -367,19 +369,21 @@ class LocalFS(obnamlib.VirtualFileSystem):
         return os.listdir(self.join(dirname))
 
     def listdir2(self, dirname):
+        # _obnam reads the directory and lstats every entry relative to
+        # it in one go. Things come back in inode order, for speed when
+        # doing namei lookups when backing up.
+        ret = obnamlib._obnam.listdir2(self.join(dirname))
+        if type(ret) is int:
+            raise OSError(ret, os.strerror(ret), dirname)
+
         result = []
-        for name in self.listdir(dirname):
+        for fields in ret:
+            name = fields[0]
             try:
-                st = self.lstat(os.path.join(dirname, name))
+                st = self._make_stat_result(
+                    os.path.join(dirname, name), fields[1:])
             except OSError, e: # pragma: no cover
                 st = e
-                ino = -1
-            else:
-                ino = st.st_ino
-            result.append((ino, name, st))
-
-        # We sort things in inode order, for speed when doing namei lookups
-        # when backing up.
-        result.sort()
-        return [(name, st) for ino, name, st in result]
+            result.append((name, st))
+        return result
 
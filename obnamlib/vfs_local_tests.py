@@ -49,6 +49,54 @@ class LocalFSTests(obnamlib.VfsTests, unittest.TestCase):
         root = 'wheel' if platform.system() == 'FreeBSD' else 'root'
         self.assertEqual(self.fs.get_groupname(0), root)
 
+    def test_listdir2_returns_entries_in_inode_order(self):
+        for i in range(10):
+            self.fs.write_file('file%d' % i, '')
+        inodes = [st.st_ino for name, st in self.fs.listdir2('.')]
+        self.assertEqual(inodes, sorted(inodes))
+
+    def test_listdir2_returns_same_as_lstat(self):
+        self.fs.write_file('foo', 'data')
+        self.fs.symlink('foo', 'bar')
+        for name, st in self.fs.listdir2('.'):
+            self.assertEqual(st, self.fs.lstat(name))
+
+    def test_write_file_works_if_directory_is_created_meanwhile(self):
+        real_makedirs = os.makedirs
+
+        def makedirs(dirname):
+            # Pretend another thread created the directory first.
+            real_makedirs(dirname)
+            real_makedirs(dirname)
+
+        os.makedirs = makedirs
+        try:
+            self.fs.write_file('foo/bar', 'data')
+        finally:
+            os.makedirs = real_makedirs
+        self.assertEqual(self.fs.cat('foo/bar'), 'data')
+
+    def test_get_data_extents_of_normal_file(self):
+        self.fs.write_file('foo', 'data')
+        f = self.fs.open('foo', 'r')
+        extents = self.fs.get_data_extents(f, 4)
+        f.close()
+        self.assert_(extents in [None, [(0, 4)]], extents)
+
+    def test_get_data_extents_finds_hole(self):
+        f = self.fs.open('foo', 'w')
+        f.seek(1024**2)
+        f.write('data')
+        f.close()
+        f = self.fs.open('foo', 'r')
+        extents = self.fs.get_data_extents(f, 1024**2 + 4)
+        self.assertEqual(f.tell(), 0)
+        f.close()
+        if extents is not None:
+            self.assertEqual(len(extents), 1)
+            offset, length = extents[0]
+            self.assertEqual(offset + length, 1024**2 + 4)
+
 
 class XAttrTests(unittest.TestCase):
     '''Tests for extended attributes.'''
@@ -0,0 +1,214 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import Queue
+import sys
+import threading
+
+
+class WorkerJob(object):
+
+    '''A job submitted to a WorkerPool.
+
+    Call ``result`` to wait for the job to finish and to get its
+    return value. If the job raised an exception, ``result`` raises
+    it again in the caller's thread.
+
+    '''
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._finished = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._value = self.func(*self.args, **self.kwargs)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        # Drop references to arguments, which may be large chunks of data,
+        # so that memory use is bounded by the jobs not yet run.
+        self.func = self.args = self.kwargs = None
+        self._finished.set()
+
+    def done(self):
+        '''Has the job finished?'''
+        return self._finished.is_set()
+
+    def result(self):
+        '''Wait for job to finish, then return its result.'''
+        # Waiting with a timeout keeps the main thread interruptible
+        # with control-C. A timed wait polls, sleeping longer each
+        # time, up to 50 ms, so a short timeout also keeps us from
+        # oversleeping after the job has finished.
+        while not self._finished.is_set():
+            self._finished.wait(0.01)
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+        return self._value
+
+
+class WorkerPool(object):
+
+    '''Run jobs in a bounded number of background threads.
+
+    At most ``max_pending`` jobs may be waiting for a worker at a
+    time; ``submit`` blocks until there is room. This bounds the amount
+    of memory used by data attached to jobs.
+
+    If ``num_workers`` is zero, there are no background threads, and
+    ``submit`` runs the job immediately in the calling thread. This
+    makes it easy to fall back to fully serial operation.
+
+    '''
+
+    def __init__(self, num_workers, max_pending=None):
+        self.num_workers = max(0, num_workers)
+        self.max_pending = max_pending or 2 * max(1, self.num_workers)
+        self._queue = Queue.Queue(maxsize=self.max_pending)
+        self._threads = []
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def submit(self, func, *args, **kwargs):
+        '''Submit a job, return WorkerJob instance for it.'''
+        job = WorkerJob(func, args, kwargs)
+        if self._threads:
+            self._queue.put(job)
+        else:
+            job.run()
+        return job
+
+    def close(self):
+        '''Wait for all submitted jobs to finish, and stop the workers.'''
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+def prefetch(pool, func, items, max_bytes, size=len):
+    '''Run ``func`` on each item in a WorkerPool, generate results in order.
+
+    Jobs are submitted ahead of the consumer, but only as many as fit
+    in ``max_bytes``, guessing that each result is as large as the
+    largest one so far, as measured by ``size``. Until the first
+    non-empty result is known, there is one job per worker, so that
+    empty results, such as holes in a sparse file, do not let the
+    whole rest of the items be submitted at once. At least one job is
+    always in flight.
+
+    '''
+
+    items = iter(items)
+    pending = collections.deque()
+    biggest = None
+    exhausted = False
+    while True:
+        if pool.num_workers == 0:
+            limit = 1
+        elif biggest is None:
+            limit = pool.num_workers
+        else:
+            limit = max(1, max_bytes / max(1, biggest))
+        while not exhausted and len(pending) < limit:
+            try:
+                item = items.next()
+            except StopIteration:
+                exhausted = True
+            else:
+                pending.append(pool.submit(func, item))
+        if not pending:
+            break
+        result = pending.popleft().result()
+        result_size = size(result)
+        if result_size > 0:
+            biggest = max(biggest, result_size)
+        yield result
+
+
+class ReadAhead(object):
+
+    '''Iterate over an iterable in a background thread.
+
+    Up to ``max_pending`` items are produced ahead of the consumer.
+    Exceptions raised by the iterable are raised again in the consumer's
+    thread, when the consumer gets to that point.
+
+    The consumer must call ``close`` if it stops iterating early, so that
+    the background thread can go away.
+
+    '''
+
+    def __init__(self, iterable, max_pending):
+        self._iterable = iterable
+        self._queue = Queue.Queue(maxsize=max(1, max_pending))
+        self._stopped = False
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stopped:
+            try:
+                self._queue.put(item, timeout=0.1)
+            except Queue.Full:
+                pass
+            else:
+                return True
+        return False
+
+    def _produce(self):
+        try:
+            for item in self._iterable:
+                if not self._put(('item', item)):
+                    return
+        except BaseException:
+            self._put(('error', sys.exc_info()))
+        else:
+            self._put(('end', None))
+
+    def __iter__(self):
+        while True:
+            kind, value = self._queue.get()
+            if kind == 'item':
+                yield value
+            elif kind == 'error':
+                exc_type, exc_value, exc_tb = value
+                raise exc_type, exc_value, exc_tb
+            else:
+                break
+
+    def close(self):
+        '''Stop the background thread.'''
+        self._stopped = True
+        self._thread.join()
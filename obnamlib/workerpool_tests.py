@@ -0,0 +1,141 @@
+# Copyright 2014  Lars Wirzenius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+import obnamlib
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def tearDown(self):
+        if hasattr(self, 'pool'):
+            self.pool.close()
+
+    def test_runs_job_immediately_without_workers(self):
+        self.pool = obnamlib.WorkerPool(0)
+        job = self.pool.submit(lambda x: x + 1, 41)
+        self.assertTrue(job.done())
+        self.assertEqual(job.result(), 42)
+
+    def test_runs_job_in_worker_thread(self):
+        self.pool = obnamlib.WorkerPool(2)
+        job = self.pool.submit(threading.current_thread)
+        self.assertNotEqual(job.result(), threading.current_thread())
+
+    def test_returns_results_for_all_jobs(self):
+        self.pool = obnamlib.WorkerPool(4, max_pending=2)
+        jobs = [self.pool.submit(lambda i: i * 2, i) for i in range(100)]
+        self.assertEqual([job.result() for job in jobs],
+                         [i * 2 for i in range(100)])
+
+    def test_reraises_exception_from_job(self):
+        def fail():
+            raise ValueError('oops')
+        self.pool = obnamlib.WorkerPool(1)
+        job = self.pool.submit(fail)
+        self.assertRaises(ValueError, job.result)
+
+    def test_close_waits_for_jobs(self):
+        self.pool = obnamlib.WorkerPool(2)
+        jobs = [self.pool.submit(lambda: 1) for i in range(10)]
+        self.pool.close()
+        self.assertTrue(all(job.done() for job in jobs))
+
+    def test_forgets_job_arguments_after_run(self):
+        self.pool = obnamlib.WorkerPool(0)
+        job = self.pool.submit(len, 'data')
+        self.assertEqual(job.args, None)
+
+
+class PrefetchTests(unittest.TestCase):
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_returns_results_in_order(self):
+        self.pool = obnamlib.WorkerPool(4)
+        results = obnamlib.prefetch(self.pool, lambda i: str(i) * 10,
+                                    range(100), 100)
+        self.assertEqual(list(results), [str(i) * 10 for i in range(100)])
+
+    def test_works_without_workers(self):
+        self.pool = obnamlib.WorkerPool(0)
+        results = obnamlib.prefetch(self.pool, lambda i: 'x', range(3), 1)
+        self.assertEqual(list(results), ['x', 'x', 'x'])
+
+    def test_returns_nothing_for_no_items(self):
+        self.pool = obnamlib.WorkerPool(2)
+        self.assertEqual(list(obnamlib.prefetch(self.pool, len, [], 10)), [])
+
+    def test_keeps_results_within_window(self):
+        started = []
+        def func(i):
+            started.append(i)
+            return 'x' * 10
+        self.pool = obnamlib.WorkerPool(4)
+        results = obnamlib.prefetch(self.pool, func, range(100), 30)
+        for i, result in enumerate(results):
+            if i > 0:
+                self.assertTrue(len(started) <= i + 3)
+
+    def test_empty_first_results_do_not_open_window(self):
+        started = []
+        def func(i):
+            started.append(i)
+            return '' if i < 3 else 'x' * 10
+        self.pool = obnamlib.WorkerPool(4)
+        results = obnamlib.prefetch(self.pool, func, range(100), 30)
+        for i, result in enumerate(results):
+            self.assertTrue(len(started) <= i + 4)
+
+    def test_reraises_exception_from_job(self):
+        def fail(i):
+            raise ValueError('oops')
+        self.pool = obnamlib.WorkerPool(2)
+        results = obnamlib.prefetch(self.pool, fail, range(3), 10)
+        self.assertRaises(ValueError, list, results)
+
+
+class ReadAheadTests(unittest.TestCase):
+
+    def test_returns_all_items_in_order(self):
+        ra = obnamlib.ReadAhead(iter(range(100)), 3)
+        self.assertEqual(list(ra), range(100))
+        ra.close()
+
+    def test_returns_nothing_for_empty_iterable(self):
+        ra = obnamlib.ReadAhead([], 3)
+        self.assertEqual(list(ra), [])
+        ra.close()
+
+    def test_reraises_exception_from_iterable(self):
+        def gen():
+            yield 1
+            raise ValueError('oops')
+        ra = obnamlib.ReadAhead(gen(), 3)
+        it = iter(ra)
+        self.assertEqual(it.next(), 1)
+        self.assertRaises(ValueError, it.next)
+        ra.close()
+
+    def test_close_stops_producer_early(self):
+        ra = obnamlib.ReadAhead(iter(range(10000)), 1)
+        it = iter(ra)
+        self.assertEqual(it.next(), 0)
+        ra.close()
+        self.assertFalse(ra._thread.is_alive())